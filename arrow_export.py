@@ -0,0 +1,141 @@
+"""
+Export of time series and logs to Arrow, pandas and Parquet
+
+Builds typed pyarrow tables straight from the parsed responses of activity_time_series,
+body_time_series, heart_rate_intraday and the sleep endpoints, converting each column with numpy
+in one pass instead of looping over rows. Tables of several responses are combined with
+concat(), which only collects their chunks and copies no data.
+"""
+import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from intraday_cache import seconds_of_day
+from sleep_stages import STAGES, decode
+
+def _series(entries: list, value_type: pa.DataType) -> pa.Table:
+  dates = np.array([entry["dateTime"] for entry in entries], dtype="datetime64[D]")
+  values = np.array([entry["value"] for entry in entries], dtype=object).astype(np.float64)
+  return pa.table({"date": pa.array(dates, pa.date32()), "value": pa.array(values).cast(value_type, safe=False)})
+
+def _series_entries(res: dict, prefix: str) -> tuple:
+  for key, entries in res.items():
+    if key.startswith(prefix) and not key.endswith("-intraday"):
+      return key[len(prefix):].replace("tracker-", ""), entries
+  raise KeyError(f"The response does not contain a {prefix}* time series")
+
+def activity_time_series_table(res: dict) -> pa.Table:
+  """
+  Returns a table with date and value columns for an activity_time_series response
+
+  Parameters:
+    res: The parsed response
+  """
+  resource, entries = _series_entries(res, "activities-")
+  value_type = pa.int64() if resource in ("steps", "floors", "calories", "caloriesBMR", "activityCalories") or resource.startswith("minutes") else pa.float64()
+  return _series(entries, value_type).replace_schema_metadata({"resource": resource})
+
+def body_time_series_table(res: dict) -> pa.Table:
+  """
+  Returns a table with date and value columns for a body_time_series response
+
+  Parameters:
+    res: The parsed response
+  """
+  resource, entries = _series_entries(res, "body-")
+  return _series(entries, pa.float64()).replace_schema_metadata({"resource": resource})
+
+def heart_rate_intraday_table(res: dict, date: str = None) -> pa.Table:
+  """
+  Returns a table with time (timestamp[s]) and heart_rate columns for a single day heart_rate_intraday response
+
+  Parameters:
+    res: The parsed response
+    date: (optional) The day of the response, by default the dateTime of its summary
+  """
+  if date is None:
+    date = res["activities-heart"][0]["dateTime"]
+  dataset = res["activities-heart-intraday"]["dataset"]
+  seconds = seconds_of_day([point["time"] for point in dataset]).astype("timedelta64[s]")
+  times = np.datetime64(date, "s") + seconds
+  values = np.fromiter((point["value"] for point in dataset), np.int16, len(dataset))
+  return pa.table({"time": pa.array(times, pa.timestamp("s")), "heart_rate": pa.array(values)})
+
+def sleep_logs_table(res: dict) -> pa.Table:
+  """
+  Returns a table with one row per sleep log of a sleep_log, sleep_logs_range or sleep_logs_list response
+
+  Parameters:
+    res: The parsed response
+  """
+  logs = res.get("sleep", [])
+  def column(key: str, dtype) -> np.ndarray:
+    return np.array([log.get(key) for log in logs], dtype=dtype)
+  return pa.table({
+    "log_id": pa.array(column("logId", np.int64)),
+    "date_of_sleep": pa.array(column("dateOfSleep", "datetime64[D]"), pa.date32()),
+    "start_time": pa.array(column("startTime", "datetime64[ms]"), pa.timestamp("ms")),
+    "end_time": pa.array(column("endTime", "datetime64[ms]"), pa.timestamp("ms")),
+    "duration": pa.array(column("duration", np.int64)),
+    "efficiency": pa.array(column("efficiency", np.int16)),
+    "is_main_sleep": pa.array(column("isMainSleep", bool)),
+    "minutes_asleep": pa.array(column("minutesAsleep", np.int32)),
+    "minutes_awake": pa.array(column("minutesAwake", np.int32)),
+    "time_in_bed": pa.array(column("timeInBed", np.int32)),
+    "type": pa.array([log.get("type") for log in logs], pa.string()).dictionary_encode(),
+  })
+
+def sleep_stages_table(res: dict) -> pa.Table:
+  """
+  Returns a table with one row per merged stage interval of every sleep log of a sleep response
+
+  Parameters:
+    res: The parsed response
+  """
+  timelines = [decode(log) for log in res.get("sleep", [])]
+  if not timelines:
+    return pa.table({"log_id": pa.array([], pa.int64()), "start_time": pa.array([], pa.timestamp("s")),
+      "seconds": pa.array([], pa.int32()), "stage": pa.DictionaryArray.from_arrays(pa.array([], pa.int8()), STAGES)})
+  lengths = [len(timeline) for timeline in timelines]
+  log_ids = np.repeat(np.array([timeline.log_id for timeline in timelines], np.int64), lengths)
+  starts = np.concatenate([timeline.start + timeline.offsets.astype("timedelta64[s]") for timeline in timelines])
+  durations = np.concatenate([timeline.durations for timeline in timelines])
+  stages = np.concatenate([timeline.stages for timeline in timelines]).astype(np.int8)
+  return pa.table({"log_id": pa.array(log_ids), "start_time": pa.array(starts, pa.timestamp("s")),
+    "seconds": pa.array(durations), "stage": pa.DictionaryArray.from_arrays(pa.array(stages), pa.array(STAGES))})
+
+def concat(tables: list) -> pa.Table:
+  """
+  Combines the tables of several responses, e.g. one heart_rate_intraday table per day, into one
+  chunked table without copying their data
+
+  Parameters:
+    tables: Tables with the same schema
+  """
+  return pa.concat_tables(tables)
+
+def to_pandas(table: pa.Table):
+  """Returns a pandas DataFrame of a table"""
+  return table.to_pandas()
+
+def write_parquet(tables, path: str) -> int:
+  """
+  Writes tables to a Parquet file one at a time, so an iterator of per-day tables never needs to
+  be held in memory at once, and returns the number of rows written
+
+  Parameters:
+    tables: An iterable of tables with the same schema
+    path: The Parquet file
+  """
+  writer = None
+  rows = 0
+  try:
+    for table in tables:
+      if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+      writer.write_table(table)
+      rows += table.num_rows
+  finally:
+    if writer is not None:
+      writer.close()
+  return rows
@@ -0,0 +1,153 @@
+"""
+Offline benchmarks for the helper modules. Run with: python benchmarks.py [name ...]
+"""
+import sys, json, time, tracemalloc
+
+def _retained(build) -> tuple:
+  """Returns the result of build() and the number of bytes it keeps alive"""
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  result = build()
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return result, after - before
+
+def _sleep_log_list(nights: int) -> str:
+  logs = []
+  for night in range(nights):
+    stages = [{"dateTime": f"2021-09-{night % 28 + 1:02d}T23:{minute % 60:02d}:00.000", "level": level, "seconds": 300 + minute}
+      for minute, level in enumerate(["wake", "light", "deep", "light", "rem"] * 6)]
+    logs.append({"dateOfSleep": f"2021-09-{night % 28 + 1:02d}", "duration": 27600000, "efficiency": 94,
+      "endTime": "2021-09-08T07:03:30.000", "infoCode": 0, "isMainSleep": True, "logId": 26589710670 + night,
+      "minutesAfterWakeup": 0, "minutesAsleep": 404, "minutesAwake": 56, "minutesToFallAsleep": 0,
+      "startTime": "2021-09-07T23:23:30.000", "timeInBed": 460, "type": "stages",
+      "levels": {"data": stages, "shortData": stages[:4], "summary": {}}})
+  return json.dumps({"sleep": logs})
+
+def _activity_log_list(entries: int) -> str:
+  return json.dumps({"activities": [{"activeDuration": 1536000, "activityLevel": [], "activityName": "Walk",
+    "activityTypeId": 90013, "averageHeartRate": 94, "calories": 204, "duration": 1536000, "elevationGain": 0,
+    "lastModified": "2021-09-08T13:34:55.000Z", "logId": 21537078 + i, "logType": "auto_detected",
+    "manualValuesSpecified": {"calories": False, "distance": False, "steps": False}, "originalDuration": 1536000,
+    "originalStartTime": "2021-09-08T13:12:23.000-07:00", "startTime": "2021-09-08T13:12:23.000-07:00",
+    "steps": 1799, "tcxLink": "https://api.fitbit.com/1/user/-/activities/21537078.tcx"} for i in range(entries)]})
+
+def bench_records() -> None:
+  """Memory kept alive by raw response dicts versus records.py records"""
+  import records
+  for name, text, parse in [
+      ("activity logs", _activity_log_list(20000), records.activity_logs),
+      ("sleep logs", _sleep_log_list(2000), records.sleep_logs)]:
+    _, raw = _retained(lambda: json.loads(text))
+    _, typed = _retained(lambda: parse(json.loads(text)))
+    print(f"{name:>14}: dicts {raw / 2**20:7.1f} MiB, records {typed / 2**20:7.1f} MiB ({raw / typed:.1f}x smaller)")
+
+def bench_sleep_stages() -> None:
+  """Decoding and per-stage totals for many user-nights"""
+  import sleep_stages
+  res = json.loads(_sleep_log_list(20000))
+  started = time.perf_counter()
+  totals = sleep_stages.cohort_totals(sleep_stages.decode_all(res))
+  print(f"decoded {len(totals)} nights in {time.perf_counter() - started:.2f}s")
+
+def bench_heart_rate() -> None:
+  """Zones, training load and recovery over a year of 1sec heart rate"""
+  import numpy as np
+  import heart_rate
+  samples = 365 * 86400
+  times = 1609459200 + np.arange(samples, dtype=np.int64)
+  bpm = (70 + 50 * np.abs(np.sin(np.arange(samples) / 3000))).astype(np.float32)
+  max_hr = heart_rate.max_heart_rate(35)
+  bounds = heart_rate.zones(max_hr, resting_hr=60)
+  for name, metric in [
+      ("time in zones", lambda: heart_rate.time_in_zones(times, bpm, bounds)),
+      ("daily time in zones", lambda: heart_rate.daily_time_in_zones(times, bpm, bounds)),
+      ("banister trimp", lambda: heart_rate.banister_trimp(times, bpm, max_hr, 60)),
+      ("edwards trimp", lambda: heart_rate.edwards_trimp(times, bpm, bounds)),
+      ("recovery", lambda: heart_rate.recovery(times, bpm, times[0], times[0] + 7200))]:
+    started = time.perf_counter()
+    metric()
+    print(f"{name:>20}: {time.perf_counter() - started:.3f}s for {samples} samples")
+
+def _peak(run) -> tuple:
+  """Returns the result of run(), its peak traced memory and its duration"""
+  tracemalloc.start()
+  started = time.perf_counter()
+  result = run()
+  elapsed = time.perf_counter() - started
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, peak, elapsed
+
+def bench_json_stream() -> None:
+  """Peak memory of res.json() versus a streaming projection of a 1sec heart rate day"""
+  import io
+  import numpy as np
+  import json_stream
+  from intraday_cache import seconds_of_day
+  body = json.dumps({"activities-heart": [{"dateTime": "2021-09-08", "value": {"restingHeartRate": 61}}],
+    "activities-heart-intraday": {"dataset": [{"time": f"{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}", "value": 60 + second % 90}
+    for second in range(86400)], "datasetInterval": 1, "datasetType": "second"}}).encode("utf-8")
+  def full():
+    points = json.loads(body)["activities-heart-intraday"]["dataset"]
+    return seconds_of_day([point["time"] for point in points]), np.array([point["value"] for point in points], np.float32)
+  for name, run in [
+      ("res.json() + arrays", full),
+      ("json_stream.dataset", lambda: json_stream.dataset(io.BytesIO(body), "activities-heart-intraday.dataset")),
+      ("json_stream.first", lambda: json_stream.first(io.BytesIO(body), "activities-heart.0.value.restingHeartRate"))]:
+    _, peak, elapsed = _peak(run)
+    print(f"{name:>20}: peak {peak / 2**20:6.1f} MiB, {elapsed:.2f}s for {len(body) / 2**20:.1f} MiB of JSON")
+
+def bench_history_store() -> None:
+  """Disk footprint and read time of a year of synced days in history_store versus raw JSON"""
+  import os, random, datetime, tempfile
+  import numpy as np
+  import history_store
+  from intraday_cache import seconds_of_day
+  rng = random.Random(0)
+  def heart_rate(date: str) -> dict:
+    bpm, dataset = 60, []
+    for minute in range(1440):
+      bpm = max(45, min(170, bpm + rng.randint(-3, 3)))
+      dataset.append({"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": bpm})
+    return {"activities-heart": [{"dateTime": date, "value": {"customHeartRateZones": [], "restingHeartRate": 61}}],
+      "activities-heart-intraday": {"dataset": dataset, "datasetInterval": 1, "datasetType": "minute"}}
+  sleep = json.loads(_sleep_log_list(1))
+  days = [(datetime.date(2021, 1, 1) + datetime.timedelta(days=day)).isoformat() for day in range(365)]
+  texts = {}
+  with tempfile.TemporaryDirectory() as root:
+    store = history_store.HistoryStore(os.path.join(root, "history.db"))
+    for date in days:
+      texts[date] = json.dumps(heart_rate(date))
+      store.put("U", "heart_rate_intraday", date, json.loads(texts[date]))
+      sleep["sleep"][0]["logId"] += 1
+      store.put("U", "sleep_log", date, sleep)
+    raw = sum(len(text) for text in texts.values()) + len(json.dumps(sleep)) * len(days)
+    stats = store.stats()
+    print(f"raw JSON {raw / 2**20:.1f} MiB, stored {stats['stored_bytes'] / 2**20:.2f} MiB ({raw / stats['stored_bytes']:.0f}x), "
+      f"{stats['blocks']} blocks for {stats['entries']} entries")
+    started = time.perf_counter()
+    for text in texts.values():
+      points = json.loads(text)["activities-heart-intraday"]["dataset"]
+      seconds_of_day([point["time"] for point in points]), np.array([point["value"] for point in points], np.float32)
+    print(f"{'json.loads + arrays':>24}: {time.perf_counter() - started:.2f}s for {len(days)} days")
+    for name, read in [("HistoryStore.dataset", store.dataset), ("HistoryStore.get", store.get)]:
+      started = time.perf_counter()
+      for date in days:
+        read("U", "heart_rate_intraday", date)
+      print(f"{name:>24}: {time.perf_counter() - started:.2f}s for {len(days)} days")
+    store.close()
+
+BENCHMARKS = {
+  "records": bench_records,
+  "sleep_stages": bench_sleep_stages,
+  "heart_rate": bench_heart_rate,
+  "json_stream": bench_json_stream,
+  "history_store": bench_history_store,
+}
+
+if __name__ == "__main__":
+  for name in sys.argv[1:] or BENCHMARKS:
+    started = time.perf_counter()
+    BENCHMARKS[name]()
+    print(f"[{name}] {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,193 @@
+"""
+Record/replay transports for fitbit.API
+
+A Recorder sends requests with a real transport and appends every request/response pair (headers,
+rate limit headers, body and timing) to a gzip-compressed JSON lines cassette, with tokens,
+authorization headers and the user's ID redacted. Every entry is its own gzip member, so a cassette
+whose recording process died is readable up to its last complete entry. A Player answers requests
+from a cassette without a network, either as fast as possible or with the recorded pacing and
+latencies, so that sessions can be profiled and regression-tested offline:
+
+  api = fitbit.API(transport=cassette.Recorder("session.jsonl.gz"))
+  ...
+  api = fitbit.API(transport=cassette.Player("session.jsonl.gz"), access_token="replay")
+"""
+import re, gzip, zlib, json, time, datetime, threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+import requests
+from requests.structures import CaseInsensitiveDict
+
+REDACTED = "REDACTED"
+
+SENSITIVE_KEYS = {"access_token", "refresh_token", "code", "id_token", "client_secret"}
+SENSITIVE_HEADERS = {"authorization", "cookie", "set-cookie"}
+
+_USER_PATH = re.compile(r"/user/([^/]+)/")
+
+def request_key(method: str, url: str, params: dict = None) -> str:
+  """
+  Returns the key a request is matched on when replaying: the method, the path with the user ID
+  replaced by "-" and the sorted query parameters without sensitive values
+
+  Parameters:
+    method: The HTTP method
+    url: The absolute url of the request
+    params: (optional) The query parameters
+  """
+  path = _USER_PATH.sub("/user/-/", urlsplit(url).path)
+  query = "&".join(f"{key}={REDACTED if key in SENSITIVE_KEYS else value}" for key, value in sorted((params or {}).items()))
+  return f"{method.upper()} {path}?{query}"
+
+def _redact_json(value):
+  if isinstance(value, dict):
+    return {key: REDACTED if key in SENSITIVE_KEYS else _redact_json(item) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_redact_json(item) for item in value]
+  return value
+
+def _redact_headers(headers) -> dict:
+  return {key: REDACTED if key.lower() in SENSITIVE_HEADERS else value for key, value in headers.items()}
+
+class Recorder:
+
+  def __init__(self, path: str, transport=requests.request, *, user_id: str = None):
+    """
+    Parameters:
+      path: The cassette file, appended to if it already exists
+      transport: (optional) The transport that actually sends the requests
+      user_id: (optional) The ID of an already authorized user, e.g. api.user_id. User IDs are also
+        taken from request paths and token responses, and every one is replaced by "-" wherever it
+        appears in the recorded bodies.
+    """
+    self.path = path
+    self.transport = transport
+    self.user_ids = {user_id} if user_id and user_id != "-" else set()
+    self.__lock = threading.Lock()
+    self.__file = open(path, "ab")
+    self.__started = time.perf_counter()
+
+  @property
+  def user_id(self) -> str:
+    """A user ID seen by the recorder, or None"""
+    return next(iter(self.user_ids), None)
+
+  def __redact_body(self, text: str) -> str:
+    try:
+      text = json.dumps(_redact_json(json.loads(text)), separators=(",", ":"))
+    except ValueError:
+      pass
+    for user_id in self.user_ids:
+      text = text.replace(user_id, "-")
+    return text
+
+  def __call__(self, method: str, url: str, **kwargs) -> requests.Response:
+    match = _USER_PATH.search(url)
+    if match and match.group(1) != "-":
+      self.user_ids.add(match.group(1))
+    started = time.perf_counter()
+    res = self.transport(method, url, **kwargs)
+    elapsed = time.perf_counter() - started
+    params = kwargs.get("params") or {}
+    if "user_id" in res.text[:4096]:
+      try:
+        user_id = res.json().get("user_id")
+      except (ValueError, AttributeError):
+        user_id = None
+      if user_id:
+        self.user_ids.add(user_id)
+    entry = {
+      "key": request_key(method, url, params),
+      "method": method.upper(),
+      "url": _USER_PATH.sub("/user/-/", url),
+      "params": {key: REDACTED if key in SENSITIVE_KEYS else value for key, value in params.items()},
+      "request_headers": _redact_headers(kwargs.get("headers") or {}),
+      "data": _redact_json(kwargs.get("data") or {}),
+      "status": res.status_code,
+      "headers": _redact_headers(res.headers),
+      "body": self.__redact_body(res.text),
+      "offset": started - self.__started,
+      "elapsed": elapsed,
+    }
+    member = gzip.compress((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+    with self.__lock:
+      self.__file.write(member)
+      self.__file.flush()
+    return res
+
+  def close(self) -> None:
+    """Closes the cassette file"""
+    with self.__lock:
+      self.__file.close()
+
+def load(path: str) -> list:
+  """
+  Returns the recorded entries of a cassette file in the order they were recorded. A gzip member cut
+  off by a crash while recording ends the cassette instead of failing the load.
+  """
+  with open(path, "rb") as file:
+    data = file.read()
+  entries = []
+  while data:
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+      text = decompressor.decompress(data)
+    except zlib.error:
+      break
+    if not decompressor.eof:
+      break
+    entries.extend(json.loads(line) for line in text.decode("utf-8").splitlines() if line.strip())
+    data = decompressor.unused_data
+  return entries
+
+class Player:
+
+  def __init__(self, path: str, *, realtime: bool = False, repeat: bool = False):
+    """
+    Parameters:
+      path: The cassette file
+      realtime: (optional) If true, the recorded session's pacing is reproduced: a response is returned
+        no earlier than its recorded offset from the first entry plus its latency after the first
+        request, and never sooner than its recorded latency
+      repeat: (optional) If true, the last recorded response of a request is replayed again once the
+        recorded ones are used up, instead of raising a LookupError
+    """
+    self.realtime = realtime
+    self.repeat = repeat
+    self.entries = load(path)
+    self.__queues = defaultdict(deque)
+    self.__last = {}
+    self.__started = None
+    self.__first = self.entries[0]["offset"] if self.entries else 0.0
+    self.__lock = threading.Lock()
+    for entry in self.entries:
+      self.__queues[entry["key"]].append(entry)
+
+  def __call__(self, method: str, url: str, **kwargs) -> requests.Response:
+    key = request_key(method, url, kwargs.get("params"))
+    with self.__lock:
+      if self.__started is None:
+        self.__started = time.perf_counter()
+      queue = self.__queues.get(key)
+      if queue:
+        entry = self.__last[key] = queue.popleft()
+      elif self.repeat and key in self.__last:
+        entry = self.__last[key]
+      else:
+        raise LookupError(f"No recorded response for {key}")
+    if self.realtime:
+      due = self.__started + entry["offset"] - self.__first + entry["elapsed"] - time.perf_counter()
+      time.sleep(max(entry["elapsed"], due))
+    res = requests.Response()
+    res.status_code = entry["status"]
+    res.headers = CaseInsensitiveDict(entry["headers"])
+    res._content = entry["body"].encode("utf-8")
+    res.encoding = "utf-8"
+    res.url = url
+    res.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+    return res
+
+  def remaining(self) -> int:
+    """Returns the number of recorded responses that have not been replayed"""
+    with self.__lock:
+      return sum(len(queue) for queue in self.__queues.values())
@@ -0,0 +1,126 @@
+"""
+Adaptive concurrency control for outgoing requests
+
+AdaptiveLimit is a concurrency limit that finds its own level with AIMD: every response that comes
+back without an error and within tolerance times the lowest latency seen raises the limit by about
+one per round trip, while a 5xx, a 429, a connection error or a latency spike cuts it by the backoff
+factor, at most once per round trip. The Fitbit-Rate-Limit-Remaining header caps the limit of a
+user, so no more requests are in flight than the user's budget allows.
+
+AdaptiveConcurrency is a transport for fitbit.API that applies one limit to every request and one
+per user, so a shared transport can serve many API instances from a thread pool:
+
+  transport = AdaptiveConcurrency()
+  apis = [fitbit.API(transport=transport, ...) for ...]
+"""
+import re, time, threading
+import requests
+
+_USER = re.compile(r"/user/([^/]+)/")
+
+class AdaptiveLimit:
+
+  def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 64, backoff: float = 0.7, tolerance: float = 1.5):
+    """
+    Parameters:
+      initial: (optional) The concurrency to start with
+      minimum: (optional) The lowest the limit is cut to
+      maximum: (optional) The highest the limit grows to
+      backoff: (optional) The factor the limit is multiplied by on an error or latency spike
+      tolerance: (optional) How many times the lowest latency seen a response may take before it
+        counts as a latency spike
+    """
+    self.limit = float(initial)
+    self.minimum = minimum
+    self.maximum = maximum
+    self.backoff = backoff
+    self.tolerance = tolerance
+    self.in_flight = 0
+    self.baseline = None
+    self.latency = None
+    self.__decreased = 0.0
+    self.__condition = threading.Condition()
+
+  def acquire(self, timeout: float = None) -> bool:
+    """Waits until fewer requests than the limit are in flight and counts one more, False on timeout"""
+    with self.__condition:
+      if not self.__condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+        return False
+      self.in_flight += 1
+      return True
+
+  def release(self, latency: float, ok: bool, remaining: int = None) -> None:
+    """
+    Counts a request as finished and adapts the limit to its outcome
+
+    Parameters:
+      latency: Seconds the request took
+      ok: False for a 5xx, a 429 or a connection error
+      remaining: (optional) The requests the rate limit still allows
+    """
+    with self.__condition:
+      in_flight = self.in_flight
+      self.in_flight -= 1
+      self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+      # The lowest latency seen drifts up slowly, so that a slower server becomes the new normal
+      if self.baseline is None or latency < self.baseline:
+        self.baseline = latency
+      else:
+        self.baseline += 0.001 * (latency - self.baseline)
+      now = time.monotonic()
+      if not ok or latency > self.tolerance * self.baseline:
+        # One cut per round trip, since every request in flight during a spike reports it
+        if now - self.__decreased > self.latency:
+          self.limit = max(self.minimum, self.limit * self.backoff)
+          self.__decreased = now
+      elif 2 * in_flight >= self.limit:
+        # Only grow a limit that is being used
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      if remaining is not None:
+        self.limit = max(self.minimum, min(self.limit, remaining))
+      self.__condition.notify_all()
+
+class AdaptiveConcurrency:
+
+  def __init__(self, transport=None, *, initial: int = 4, maximum: int = 64, user_initial: int = 2, user_maximum: int = 8, **options):
+    """
+    Parameters:
+      transport: (optional) The transport requests are sent with, requests.request by default
+      initial: (optional) The initial limit of all requests
+      maximum: (optional) The highest limit of all requests
+      user_initial: (optional) The initial limit of the requests of each user
+      user_maximum: (optional) The highest limit of the requests of each user
+      options: (optional) minimum, backoff and tolerance of AdaptiveLimit
+    """
+    self.transport = transport or requests.request
+    self.options = options
+    self.user_initial = user_initial
+    self.user_maximum = user_maximum
+    self.limit = AdaptiveLimit(initial, maximum=maximum, **options)
+    self.users = {}
+    self.__lock = threading.Lock()
+
+  def user_limit(self, user_id: str) -> AdaptiveLimit:
+    """Returns the limit of a user's requests, creating it on first use"""
+    with self.__lock:
+      if user_id not in self.users:
+        self.users[user_id] = AdaptiveLimit(self.user_initial, maximum=self.user_maximum, **self.options)
+      return self.users[user_id]
+
+  def __call__(self, method: str, url: str, **kwargs) -> requests.Response:
+    match = _USER.search(url)
+    limits = [self.user_limit(match.group(1)), self.limit] if match else [self.limit]
+    # Always the user's limit first, so that threads never wait for each other's slots in opposite orders
+    for limit in limits:
+      limit.acquire()
+    started = time.perf_counter()
+    res = None
+    try:
+      res = self.transport(method, url, **kwargs)
+      return res
+    finally:
+      latency = time.perf_counter() - started
+      ok = res is not None and res.status_code < 500 and res.status_code != 429
+      remaining = res.headers.get("Fitbit-Rate-Limit-Remaining") if res is not None else None
+      for limit in limits:
+        limit.release(latency, ok, int(remaining) if remaining is not None and limit is not self.limit else None)
@@ -0,0 +1,284 @@
+"""
+Declarative registry of the Fitbit Web API endpoints
+
+ENDPOINTS describes every endpoint method of fitbit.API: its HTTP method, path template (and so
+its API version), the allowed values and formats of its parameters, the longest date range it
+accepts and the collection it belongs to. install() wraps the methods of fitbit.API so that their
+arguments are checked against the table before any request is sent, raising ValueError for a typo
+instead of spending a request of the rate limit on a 400. split_range() and match() expose the same
+metadata for range splitting and caching.
+
+Path templates use {name} for a parameter and [...] for a part that is only present for some
+arguments, e.g. [tracker/] in activity_time_series.
+"""
+import re, datetime, inspect, functools
+
+PERIODS = ("1d", "7d", "30d", "1w", "1m", "3m", "6m", "1y", "max")
+# The periods of the body log lists, which cover at most 31 days
+LOG_PERIODS = ("1d", "7d", "1w", "1m")
+ACTIVITY_RESOURCES = ("calories", "caloriesBMR", "steps", "distance", "floors", "elevation", "minutesSedentary",
+  "minutesLightlyActive", "minutesFairlyActive", "minutesVeryActive", "activityCalories")
+INTRADAY_RESOURCES = ("calories", "steps", "distance", "floors", "elevation")
+COLLECTIONS = ("", "activities", "body", "foods", "sleep")
+
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_DATE_TIME = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2})?)?")
+_TIME = re.compile(r"([01]\d|2[0-3]):[0-5]\d")
+_TIME_SECONDS = re.compile(r"([01]\d|2[0-3]):[0-5]\d(:[0-5]\d)?")
+
+def _is_date(value) -> bool:
+  if not isinstance(value, str) or not _DATE.fullmatch(value):
+    return False
+  try:
+    datetime.date.fromisoformat(value)
+  except ValueError:
+    return False
+  return True
+
+# The formats parameters are checked against, by name, with the description used in errors
+FORMATS = {
+  "date": (_is_date, "a date in the format yyyy-MM-dd"),
+  "date_or_today": (lambda value: value == "today" or _is_date(value), "a date in the format yyyy-MM-dd or today"),
+  "date_time": (lambda value: isinstance(value, str) and bool(_DATE_TIME.fullmatch(value)) and _is_date(value[:10]),
+    "a date in the format yyyy-MM-dd or yyyy-MM-ddTHH:mm:ss"),
+  "end_or_period": (lambda value: value in PERIODS or value == "today" or _is_date(value),
+    f"a date in the format yyyy-MM-dd or one of the periods {', '.join(PERIODS)}"),
+  "end_or_log_period": (lambda value: value in LOG_PERIODS or value == "today" or _is_date(value),
+    f"a date in the format yyyy-MM-dd or one of the periods {', '.join(LOG_PERIODS)}"),
+  "end_or_1d": (lambda value: value in ("1d", "today") or _is_date(value), "a date in the format yyyy-MM-dd or 1d"),
+  "time": (lambda value: isinstance(value, str) and bool(_TIME.fullmatch(value)), "a time in the format HH:mm"),
+  "time_seconds": (lambda value: isinstance(value, str) and bool(_TIME_SECONDS.fullmatch(value)), "a time in the format HH:mm:ss"),
+  "limit": (lambda value: isinstance(value, int) and 1 <= value <= 100, "an integer from 1 to 100"),
+}
+
+class Endpoint:
+
+  __slots__ = ("name", "method", "path", "params", "range", "max_days", "collection", "pattern")
+
+  def __init__(self, name: str, method: str, path: str, params: dict = None, range: tuple = None, max_days: int = None, collection: str = None):
+    """
+    Parameters:
+      name: The name of the fitbit.API method
+      method: GET, POST or DELETE
+      path: The path template
+      params: (optional) The format name or tuple of allowed values of every checked parameter
+      range: (optional) The names of the start and end parameters of a date range
+      max_days: (optional) The most days, inclusive, a date range may cover
+      collection: (optional) The Subscriptions API collection the data belongs to
+    """
+    self.name = name
+    self.method = method
+    self.path = path
+    self.params = params or {}
+    self.range = range
+    self.max_days = max_days
+    self.collection = collection
+    pattern = re.escape(path).replace(r"\[", "(?:").replace(r"\]", ")?")
+    self.pattern = re.compile(re.sub(r"\\\{\w+\\\}", "[^/]+", pattern))
+
+  @property
+  def version(self) -> str:
+    """The API version of the endpoint, e.g. 1, 1.1 or 1.2"""
+    return self.path.split("/")[1]
+
+  @property
+  def cacheable(self) -> bool:
+    """Whether responses can be cached, i.e. the endpoint only reads data"""
+    return self.method == "GET"
+
+  def validate(self, arguments: dict) -> None:
+    """
+    Raises ValueError if an argument does not have an allowed value or format, or a date range is
+    reversed or longer than max_days
+
+    Parameters:
+      arguments: The arguments of a call by parameter name
+    """
+    for param, rule in self.params.items():
+      value = arguments.get(param)
+      if value is None:
+        continue
+      if isinstance(rule, tuple):
+        if value not in rule:
+          raise ValueError(f"{self.name}: {param} must be one of {', '.join(repr(option) for option in rule)}, not {value!r}")
+      elif not FORMATS[rule][0](value):
+        raise ValueError(f"{self.name}: {param} must be {FORMATS[rule][1]}, not {value!r}")
+    if self.range is not None:
+      start, end = (arguments.get(param) for param in self.range)
+      if _is_date(start) and _is_date(end):
+        days = (datetime.date.fromisoformat(end) - datetime.date.fromisoformat(start)).days + 1
+        if days < 1:
+          raise ValueError(f"{self.name}: the range {start} to {end} ends before it starts")
+        if self.max_days is not None and days > self.max_days:
+          raise ValueError(f"{self.name}: the range {start} to {end} covers {days} days, at most {self.max_days} are allowed")
+
+def _endpoints(*endpoints) -> dict:
+  return {endpoint.name: endpoint for endpoint in endpoints}
+
+ENDPOINTS = _endpoints(
+  # Activity
+  Endpoint("activity_types", "GET", "/1/activities.json"),
+  Endpoint("activity_type", "GET", "/1/activities/{activity_id}.json"),
+  Endpoint("lifetime_stats", "GET", "/1/user/{user_id}/activities.json", collection="activities"),
+  Endpoint("activity_summary", "GET", "/1/user/{user_id}/activities/date/{date}.json", {"date": "date_or_today"}, collection="activities"),
+  Endpoint("activity_log_list", "GET", "/1/user/{user_id}/activities/list.json",
+    {"date": "date_time", "date_type": ("before", "after"), "sort": ("asc", "desc"), "limit": "limit"}, collection="activities"),
+  Endpoint("log_activity", "POST", "/1/user/{user_id}/activities.json",
+    {"id_type": ("id", "name"), "start_time": "time_seconds", "date": "date"}, collection="activities"),
+  Endpoint("delete_activity_log", "DELETE", "/1/user/{user_id}/activities/{activity_log_id}.json", collection="activities"),
+  Endpoint("activity_tcx", "GET", "/1/user/{user_id}/activities/{log_id}.tcx", collection="activities"),
+  Endpoint("frequent_activities", "GET", "/1/user/{user_id}/activities/frequent.json", collection="activities"),
+  Endpoint("recent_activity_types", "GET", "/1/user/{user_id}/activities/recent.json", collection="activities"),
+  Endpoint("favorite_activities", "GET", "/1/user/{user_id}/activities/favorite.json", collection="activities"),
+  Endpoint("add_favorite_activity", "POST", "/1/user/{user_id}/activities/favorite/{activity_id}.json", collection="activities"),
+  Endpoint("delete_favorite_activity", "DELETE", "/1/user/{user_id}/activities/favorite/{activity_id}.json", collection="activities"),
+  Endpoint("activity_goals", "GET", "/1/user/{user_id}/activities/goals/{period}.json", {"period": ("daily", "weekly")}, collection="activities"),
+  Endpoint("update_activity_goals", "POST", "/1/user/{user_id}/activities/goals/{period}.json",
+    {"period": ("daily", "weekly"), "type": ("activeMinutes", "activeZoneMinutes", "caloriesOut", "distance", "floors", "steps")}, collection="activities"),
+  Endpoint("activity_intraday", "GET", "/1/user/{user_id}/activities/{resource_path}/date/{base_date}/{end_or_1d}/{detail_level}[/time/{start_time}/{end_time}].json",
+    {"resource_path": INTRADAY_RESOURCES, "base_date": "date_or_today", "end_or_1d": "end_or_1d",
+    "detail_level": ("1min", "5min", "15min"), "start_time": "time", "end_time": "time"},
+    range=("base_date", "end_or_1d"), max_days=1, collection="activities"),
+  Endpoint("activity_time_series", "GET", "/1/user/{user_id}/activities/[tracker/]{resource_path}/date/{base_date}/{end_or_period}.json",
+    {"resource_path": ACTIVITY_RESOURCES, "base_date": "date_or_today", "end_or_period": "end_or_period"},
+    range=("base_date", "end_or_period"), max_days=1095, collection="activities"),
+  # Body and Weight
+  Endpoint("body_logs", "GET", "/1/user/{user_id}/body/log/{resource_path}/date/{base_date}[/{end_or_period}].json",
+    {"resource_path": ("weight", "fat"), "base_date": "date_or_today", "end_or_period": "end_or_log_period"},
+    range=("base_date", "end_or_period"), max_days=31, collection="body"),
+  Endpoint("log_body", "POST", "/1/user/{user_id}/body/log/{resource_path}.json",
+    {"resource_path": ("weight", "fat"), "date": "date", "time": "time_seconds"}, collection="body"),
+  Endpoint("delete_body_log", "DELETE", "/1/user/{user_id}/body/log/{resource_path}/{body_log_id}.json", {"resource_path": ("weight", "fat")}, collection="body"),
+  Endpoint("body_goals", "GET", "/1/user/{user_id}/body/log/{goal_type}/goal.json", {"goal_type": ("weight", "fat")}, collection="body"),
+  Endpoint("update_body_fat_goal", "POST", "/1/user/{user_id}/body/log/fat/goal.json", collection="body"),
+  Endpoint("update_body_weight_goal", "POST", "/1/user/{user_id}/body/log/weight/goal.json", {"start_date": "date"}, collection="body"),
+  Endpoint("body_time_series", "GET", "/1/user/{user_id}/body/{resource_path}/date/{base_date}/{end_or_period}.json",
+    {"resource_path": ("bmi", "fat", "weight"), "base_date": "date_or_today", "end_or_period": "end_or_period"},
+    range=("base_date", "end_or_period"), max_days=1095, collection="body"),
+  # Devices
+  Endpoint("devices", "GET", "/1/user/{user_id}/devices.json"),
+  Endpoint("alarms", "GET", "/1/user/{user_id}/devices/tracker/{tracker_id}/alarms.json"),
+  Endpoint("add_alarm", "POST", "/1/user/{user_id}/devices/tracker/{tracker_id}/alarms.json"),
+  Endpoint("update_alarm", "POST", "/1/user/{user_id}/devices/tracker/{tracker_id}/alarms/{alarm_id}.json"),
+  Endpoint("delete_alarm", "DELETE", "/1/user/{user_id}/devices/tracker/{tracker_id}/alarms/{alarm_id}.json"),
+  # Food and Water
+  Endpoint("food_locales", "GET", "/1/foods/locales.json"),
+  Endpoint("food_goals", "GET", "/1/user/{user_id}/foods/log/goal.json", collection="foods"),
+  Endpoint("update_food_goal", "POST", "/1/user/{user_id}/foods/log/goal.json",
+    {"goal_type": ("calories", "intensity"), "personalized": ("true", "false")}, collection="foods"),
+  Endpoint("food_logs", "GET", "/1/user/{user_id}/foods/log/date/{date}.json", {"date": "date_or_today"}, collection="foods"),
+  Endpoint("water_logs", "GET", "/1/user/{user_id}/foods/log/water/date/{date}.json", {"date": "date_or_today"}, collection="foods"),
+  Endpoint("water_goal", "GET", "/1/user/{user_id}/foods/log/water/goal.json", collection="foods"),
+  Endpoint("update_water_goal", "POST", "/1/user/{user_id}/foods/log/water/goal.json", collection="foods"),
+  Endpoint("log_food", "POST", "/1/user/{user_id}/foods/log.json", {"date": "date"}, collection="foods"),
+  Endpoint("delete_food_log", "DELETE", "/1/user/{user_id}/foods/log/{food_log_id}.json", collection="foods"),
+  Endpoint("edit_food_log", "POST", "/1/user/{user_id}/foods/log/{food_log_id}.json", collection="foods"),
+  Endpoint("log_water", "POST", "/1/user/{user_id}/foods/log/water.json", {"date": "date", "unit": ("ml", "fl oz", "cup")}, collection="foods"),
+  Endpoint("delete_water_log", "DELETE", "/1/user/{user_id}/foods/log/water/{water_log_id}.json", collection="foods"),
+  Endpoint("update_water_log", "POST", "/1/user/{user_id}/foods/log/water/{water_log_id}.json", {"unit": ("ml", "fl oz", "cup")}, collection="foods"),
+  Endpoint("favorite_foods", "GET", "/1/user/{user_id}/foods/log/favorite.json", collection="foods"),
+  Endpoint("frequent_foods", "GET", "/1/user/{user_id}/foods/log/frequent.json", collection="foods"),
+  Endpoint("add_favorite_food", "POST", "/1/user/{user_id}/foods/log/favorite/{food_id}.json", collection="foods"),
+  Endpoint("delete_favorite_food", "DELETE", "/1/user/{user_id}/foods/log/favorite/{food_id}.json", collection="foods"),
+  Endpoint("meals", "GET", "/1/user/{user_id}/meals.json", collection="foods"),
+  Endpoint("create_meal", "POST", "/1/user/{user_id}/meals.json", collection="foods"),
+  Endpoint("edit_meal", "POST", "/1/user/{user_id}/meals/{meal_id}.json", collection="foods"),
+  Endpoint("delete_meal", "DELETE", "/1/user/{user_id}/meals/{meal_id}.json", collection="foods"),
+  Endpoint("recent_foods", "GET", "/1/user/{user_id}/foods/log/recent.json", collection="foods"),
+  Endpoint("create_food", "POST", "/1/user/{user_id}/foods.json", collection="foods"),
+  Endpoint("delete_custom_food", "DELETE", "/1/user/{user_id}/foods/{food_id}.json", collection="foods"),
+  Endpoint("food", "GET", "/1/foods/{food_id}.json"),
+  Endpoint("food_units", "GET", "/1/foods/units.json"),
+  Endpoint("search_foods", "GET", "/1/foods/search.json"),
+  Endpoint("food_or_water_time_series", "GET", "/1/user/{user_id}/foods/log/{resource_path}/date/{base_date}/{end_or_period}.json",
+    {"resource_path": ("caloriesIn", "water"), "base_date": "date_or_today", "end_or_period": "end_or_period"},
+    range=("base_date", "end_or_period"), max_days=1095, collection="foods"),
+  # Friends
+  Endpoint("friends", "GET", "/1.1/user/{user_id}/friends.json"),
+  Endpoint("friends_leaderboard", "GET", "/1.1/user/{user_id}/leaderboard/friends.json"),
+  Endpoint("friend_invitations", "GET", "/1.1/user/{user_id}/friends/invitations.json"),
+  Endpoint("invite_friends", "POST", "/1.1/user/{user_id}/friends/invitations", {"id_type": ("email", "id")}),
+  Endpoint("friend_invitation", "POST", "/1.1/user/{user_id}/friends/invitations/{from_user_id}", {"accept": ("true", "false")}),
+  # Heart Rate
+  Endpoint("heart_rate_intraday", "GET", "/1/user/{user_id}/activities/heart/date/{base_date}/{end_or_1d}/{detail_level}[/time/{start_time}/{end_time}].json",
+    {"base_date": "date_or_today", "end_or_1d": "end_or_1d", "detail_level": ("1sec", "1min", "5min", "15min"),
+    "start_time": "time", "end_time": "time"}, range=("base_date", "end_or_1d"), max_days=1, collection="activities"),
+  Endpoint("heart_rate_time_series", "GET", "/1/user/{user_id}/activities/heart/date/{base_date}/{end_or_period}.json",
+    {"base_date": "date_or_today", "end_or_period": "end_or_period"}, range=("base_date", "end_or_period"), max_days=365, collection="activities"),
+  # Sleep
+  Endpoint("delete_sleep_log", "DELETE", "/1.2/user/{user_id}/sleep/{log_id}.json", collection="sleep"),
+  Endpoint("sleep_log", "GET", "/1.2/user/{user_id}/sleep/date/{date}.json", {"date": "date_or_today"}, collection="sleep"),
+  Endpoint("sleep_logs_range", "GET", "/1.2/user/{user_id}/sleep/date/{base_date}/{end_date}.json",
+    {"base_date": "date_or_today", "end_date": "date_or_today"}, range=("base_date", "end_date"), max_days=100, collection="sleep"),
+  Endpoint("sleep_logs_list", "GET", "/1.2/user/{user_id}/sleep/list.json",
+    {"date": "date_time", "date_type": ("before", "after"), "sort": ("asc", "desc"), "limit": "limit"}, collection="sleep"),
+  Endpoint("sleep_goal", "GET", "/1.2/user/{user_id}/sleep/goal.json", collection="sleep"),
+  Endpoint("update_sleep_goal", "POST", "/1.2/user/{user_id}/sleep/goal.json", collection="sleep"),
+  Endpoint("log_sleep", "POST", "/1.2/user/{user_id}/sleep.json", {"start_time": "time", "date": "date"}, collection="sleep"),
+  # Subscriptions
+  Endpoint("subscriptions", "GET", "/1/user/{user_id}/[{collection_path}/]apiSubscriptions.json", {"collection_path": COLLECTIONS}),
+  Endpoint("add_subscription", "POST", "/1/user/{user_id}/[{collection_path}/]apiSubscriptions/{subscription_id}.json", {"collection_path": COLLECTIONS}),
+  Endpoint("delete_subscription", "DELETE", "/1/user/{user_id}/[{collection_path}/]apiSubscriptions/{subscription_id}.json", {"collection_path": COLLECTIONS}),
+  # User
+  Endpoint("badges", "GET", "/1/user/{user_id}/badges.json"),
+  Endpoint("profile", "GET", "/1/user/{user_id}/profile.json"),
+  Endpoint("update_profile", "POST", "/1/user/{user_id}/profile.json"),
+)
+
+# Endpoints with fewer placeholders first, so that e.g. foods/log/water.json is not taken for foods/log/{food_log_id}.json
+_BY_SPECIFICITY = sorted(ENDPOINTS.values(), key=lambda endpoint: endpoint.path.count("{"))
+
+def match(method: str, path: str) -> Endpoint:
+  """
+  Returns the endpoint a request was sent to, or None
+
+  Parameters:
+    method: The HTTP method of the request
+    path: The path of the request, without the query string
+  """
+  for endpoint in _BY_SPECIFICITY:
+    if endpoint.method == method and endpoint.pattern.fullmatch(path):
+      return endpoint
+  return None
+
+def split_range(name: str, base_date: str, end_date: str) -> list:
+  """
+  Returns (start, end) date pairs that cover a date range in as few requests to an endpoint as its
+  max_days allows
+
+  Parameters:
+    name: The name of the endpoint, e.g. sleep_logs_range
+    base_date: The first date in the format yyyy-MM-dd
+    end_date: The last date in the format yyyy-MM-dd
+  """
+  step = ENDPOINTS[name].max_days
+  start, end = datetime.date.fromisoformat(base_date), datetime.date.fromisoformat(end_date)
+  chunks = []
+  while start <= end:
+    last = min(end, start + datetime.timedelta(days=step - 1)) if step else end
+    chunks.append((start.isoformat(), last.isoformat()))
+    start = last + datetime.timedelta(days=1)
+  return chunks
+
+def validated(function, endpoint: Endpoint):
+  """Returns an endpoint method that validates its arguments before calling function"""
+  signature = inspect.signature(function)
+  names = list(signature.parameters)[1:]
+  defaults = {name: parameter.default for name, parameter in signature.parameters.items() if parameter.default is not inspect.Parameter.empty}
+  @functools.wraps(function)
+  def method(self, *args, **kwargs):
+    arguments = dict(defaults)
+    arguments.update(zip(names, args))
+    arguments.update(kwargs)
+    endpoint.validate(arguments)
+    return function(self, *args, **kwargs)
+  method.endpoint = endpoint
+  return method
+
+def install(cls) -> None:
+  """
+  Wraps the endpoint methods of a class, i.e. fitbit.API, with validation against ENDPOINTS. The API
+  has no async methods, so only the sync methods are wrapped.
+  """
+  for name, endpoint in ENDPOINTS.items():
+    setattr(cls, name, validated(getattr(cls, name), endpoint))
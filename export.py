@@ -0,0 +1,372 @@
+"""
+Streaming export of users' data to NDJSON, CSV or Parquet
+
+Exports the resources of every user in a token store (the coordination database of sync_workers)
+over a date range. The calls of each user are planned by planner.plan() and sent with
+API.streaming(), and the records are projected out of each response with json_stream as it
+arrives, so memory stays constant however long the range or fine the detail. Every record is one
+row of COLUMNS. Rows are written in chunks, to one file per user for NDJSON and CSV and to one part
+file per chunk for Parquet, and after every chunk a checkpoint file records how far into the plan
+the rows on disk go together with the size of the files. A rerun with the same checkpoint truncates
+anything written after it and continues with the next call, so an interrupted or rate-limited
+export resumes without losing or duplicating rows. Like a sync worker, the export holds the lease
+on a user in the token store while it uses the user's tokens, and skips users leased by others:
+
+  python -m fitbit export --tokens sync.db --resources steps,heart,sleep --start 2019-01-01 --end 2021-09-08 \\
+    --detail 1min --format parquet --output export --checkpoint export/checkpoint.json
+"""
+import os, io, csv, sys, json, time, uuid, hashlib, argparse, datetime
+import requests
+import fitbit, planner, json_stream
+from sync_workers import Coordinator
+
+COLUMNS = ("user_id", "resource", "date", "time", "value")
+FORMATS = ("ndjson", "csv", "parquet")
+
+def _number(value):
+  return None if value is None else float(value)
+
+def rows(user_id: str, call: planner.Call, res) -> iter:
+  """
+  Yields the COLUMNS tuples of a response, reading it as a stream
+
+  Parameters:
+    user_id: The encoded ID of the user
+    call: The planned call the response belongs to
+    res: The response, ideally requested with API.streaming(), or its parsed data
+  """
+  source = json.dumps(res) if isinstance(res, dict) else res
+  resource = call.resource
+  if call.method in ("activity_time_series", "body_time_series"):
+    prefix = "activities" if call.method == "activity_time_series" else "body"
+    for entry in json_stream.select(source, f"{prefix}-{resource}.*"):
+      yield user_id, resource, entry["dateTime"], None, _number(entry["value"])
+  elif call.method == "heart_rate_time_series":
+    for entry in json_stream.select(source, "activities-heart.*"):
+      if "restingHeartRate" in entry["value"]:
+        yield user_id, resource, entry["dateTime"], None, _number(entry["value"]["restingHeartRate"])
+  elif call.method in ("activity_intraday", "heart_rate_intraday"):
+    for point in json_stream.select(source, f"activities-{resource}-intraday.dataset.*"):
+      yield user_id, resource, call.dates[0], point["time"], _number(point["value"])
+  elif call.method == "sleep_logs_range":
+    for log in json_stream.select(source, "sleep.*"):
+      yield user_id, resource, log["dateOfSleep"], log["startTime"][11:19], _number(log["minutesAsleep"])
+  elif call.method == "body_logs":
+    for log in json_stream.select(source, f"{resource}.*"):
+      yield user_id, resource, log["date"], log.get("time"), _number(log.get(resource))
+  else:
+    raise ValueError(f"{call.method} has no export format")
+
+class _TextWriter:
+  """Appends rows to one file per user, truncated to the size in the checkpoint on resume"""
+
+  extension = None
+
+  def __init__(self, directory: str, user_id: str, state: dict):
+    self.path = os.path.join(directory, f"{user_id}.{self.extension}")
+    self.file = open(self.path, "a+b")
+    self.file.truncate(state.get("size", 0))
+    self.file.seek(0, os.SEEK_END)
+    self.buffer = []
+
+  def write(self, row: tuple) -> None:
+    self.buffer.append(row)
+
+  def flush(self) -> dict:
+    """Writes the buffered rows and returns the state to store in the checkpoint"""
+    if self.buffer:
+      self.file.write(self.encode(self.buffer).encode("utf-8"))
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.buffer.clear()
+    return {"size": self.file.tell()}
+
+  def close(self) -> None:
+    self.file.close()
+
+class NDJSONWriter(_TextWriter):
+
+  extension = "ndjson"
+
+  def encode(self, rows: list) -> str:
+    return "".join(json.dumps(dict(zip(COLUMNS, row)), separators=(",", ":")) + "\n" for row in rows)
+
+class CSVWriter(_TextWriter):
+
+  extension = "csv"
+
+  def encode(self, rows: list) -> str:
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\n")
+    if self.file.tell() == 0:
+      writer.writerow(COLUMNS)
+    writer.writerows(rows)
+    return text.getvalue()
+
+class ParquetWriter:
+  """Writes every chunk to a new part file; parts not in the checkpoint are deleted on resume"""
+
+  def __init__(self, directory: str, user_id: str, state: dict):
+    import pyarrow as pa, pyarrow.parquet as pq
+    self.pa, self.pq = pa, pq
+    self.directory = directory
+    self.user_id = user_id
+    self.parts = list(state.get("parts", []))
+    for name in os.listdir(directory):
+      if name.startswith(f"{user_id}-") and name.endswith(".parquet") and name not in self.parts:
+        os.remove(os.path.join(directory, name))
+    self.schema = pa.schema([("user_id", pa.string()), ("resource", pa.string()), ("date", pa.date32()),
+      ("time", pa.string()), ("value", pa.float64())])
+    self.buffer = []
+
+  def write(self, row: tuple) -> None:
+    self.buffer.append(row)
+
+  def flush(self) -> dict:
+    if self.buffer:
+      columns = list(zip(*self.buffer))
+      columns[2] = [datetime.date.fromisoformat(date) for date in columns[2]]
+      table = self.pa.table([self.pa.array(column, field.type) for column, field in zip(columns, self.schema)], schema=self.schema)
+      name = f"{self.user_id}-{len(self.parts):05d}.parquet"
+      self.pq.write_table(table, os.path.join(self.directory, name))
+      self.parts.append(name)
+      self.buffer.clear()
+    return {"parts": list(self.parts)}
+
+  def close(self) -> None:
+    pass
+
+WRITERS = {"ndjson": NDJSONWriter, "csv": CSVWriter, "parquet": ParquetWriter}
+
+class Checkpoint:
+
+  def __init__(self, path: str = None):
+    """
+    Parameters:
+      path: (optional) The checkpoint file, created on the first save. Without one nothing is resumable.
+    """
+    self.path = path
+    self.users = {}
+    if path and os.path.exists(path):
+      with open(path) as file:
+        self.users = json.load(file)
+
+  def user(self, user_id: str) -> dict:
+    """
+    Returns the progress of a user: the digest of the plan, the index of the next call of the plan,
+    the calls that failed by index and the state of the writer
+    """
+    return self.users.setdefault(user_id, {"plan": None, "cursor": 0, "failed": {}, "writer": {}})
+
+  def save(self) -> None:
+    """Replaces the checkpoint file atomically"""
+    if not self.path:
+      return
+    temporary = f"{self.path}.tmp"
+    with open(temporary, "w") as file:
+      json.dump(self.users, file, separators=(",", ":"))
+    os.replace(temporary, self.path)
+
+def _digest(plan: planner.Plan) -> str:
+  """Identifies the calls of a plan, so that a checkpoint's cursor is only applied to the plan it counts"""
+  digest = hashlib.blake2b(digest_size=16)
+  for call in plan.calls:
+    digest.update(f"{call.method}{json.dumps(call.args)}\n".encode("utf-8"))
+  return digest.hexdigest()
+
+def _send(api: fitbit.API, call: planner.Call, wait: bool, hold=None):
+  """
+  Sends a call, refreshing an expired token once and waiting out 429s if wait is set, and returns the
+  streamed response, which may have another error status, or None if the budget is used up or hold()
+  tells that the user's tokens may no longer be used
+  """
+  refreshed = False
+  while True:
+    if hold is not None and not hold():
+      return None
+    budget = planner.remaining_budget(api)
+    if budget == 0:
+      if not wait:
+        return None
+      time.sleep(max(0.0, api.rate_limit["reset"] - time.time()))
+    with api.streaming():
+      res = getattr(api, call.method)(*call.args)
+    if res.status_code == 401 and not refreshed:
+      res.close()
+      api.refresh_if_stale(api.access_token)
+      refreshed = True
+      continue
+    if res.status_code == 429:
+      res.close()
+      if not wait:
+        return None
+      time.sleep(max(0.0, api.rate_limit["reset"] - time.time()) if api.rate_limit else 60.0)
+      continue
+    return res
+
+def export_user(api: fitbit.API, plan: planner.Plan, directory: str, format: str, checkpoint: Checkpoint,
+    chunk_rows: int = 10000, wait: bool = False, hold=None) -> dict:
+  """
+  Exports the calls of a plan for one user, resuming from and updating the checkpoint, and returns
+  the rows and requests written, the calls that failed and whether the end of the plan was reached.
+  A call answered with an error status, e.g. a 403 for intraday data the app may not read, is
+  recorded in the checkpoint and skipped; one that failed with a server error is retried on the
+  next run.
+
+  Parameters:
+    api: The fitbit.API instance of the user
+    plan: The planned calls
+    directory: The output directory
+    format: ndjson, csv or parquet
+    checkpoint: The export's Checkpoint
+    chunk_rows: (optional) Rows buffered before they are written and the checkpoint is saved
+    wait: (optional) Whether to wait for the rate limit to reset instead of stopping when the budget is used up
+    hold: (optional) Called before every request, e.g. to renew a lease on the user; if it returns
+      False the export of the user stops as if the budget was used up
+  """
+  progress = checkpoint.user(api.user_id)
+  digest = _digest(plan)
+  if progress["plan"] is None:
+    progress["plan"] = digest
+  elif progress["plan"] != digest:
+    raise ValueError(f"The checkpoint of user {api.user_id} belongs to another plan; export the same resources, "
+      "dates and detail or use a new checkpoint")
+  writer = WRITERS[format](directory, api.user_id, progress["writer"])
+  failed = progress["failed"]
+  counts = {"rows": 0, "requests": 0, "failed": 0, "complete": False}
+  def save():
+    progress["writer"] = writer.flush()
+    checkpoint.save()
+  def run(index: int) -> bool:
+    """Exports one call and returns False if the budget is used up"""
+    call = plan.calls[index]
+    res = _send(api, call, wait, hold)
+    if res is None:
+      return False
+    counts["requests"] += 1
+    if res.status_code >= 400:
+      failed[str(index)] = {"status": res.status_code, "error": res.text[:200]}
+      res.close()
+      return True
+    failed.pop(str(index), None)
+    buffered = len(writer.buffer)
+    for row in rows(api.user_id, call, res):
+      writer.write(row)
+    counts["rows"] += len(writer.buffer) - buffered
+    return True
+  try:
+    # Calls that failed with a server error on an earlier run are retried before the plan continues
+    retries = [int(index) for index, failure in failed.items() if failure["status"] >= 500]
+    if all(run(index) for index in retries):
+      while progress["cursor"] < len(plan.calls):
+        if not run(progress["cursor"]):
+          break
+        progress["cursor"] += 1
+        if len(writer.buffer) >= chunk_rows:
+          save()
+      else:
+        counts["complete"] = True
+    save()
+  finally:
+    writer.close()
+  counts["failed"] = len(failed)
+  return counts
+
+def export(store: Coordinator, resources: list, start: str, end: str, directory: str, *, detail="day", format: str = "ndjson",
+    checkpoint: str = None, chunk_rows: int = 10000, wait: bool = False, users: list = None, api_options: dict = None,
+    lease: float = 300.0, worker_id: str = None) -> dict:
+  """
+  Exports the resources of every user in a token store and returns the counts of export_user() by
+  user. A user whose tokens are rejected or whose export fails otherwise gets the exception as error
+  instead, and the export continues with the next user. A user leased by a sync worker or another
+  holder of the tokens is left for the next run and marked skipped.
+
+  Parameters:
+    store: The token store, a sync_workers.Coordinator; refreshed tokens are saved back to it
+    resources: The resources to export, see planner.strategy()
+    start: The first date in the format yyyy-MM-dd
+    end: The last date in the format yyyy-MM-dd
+    directory: The output directory, created if needed
+    detail: (optional) day or an intraday detail level, or a dict of them by resource
+    format: (optional) ndjson, csv or parquet
+    checkpoint: (optional) The checkpoint file to resume from and update
+    chunk_rows: (optional) Rows buffered before they are written
+    wait: (optional) Whether to wait for rate limits to reset instead of leaving the rest to the next run
+    users: (optional) The IDs of the users to export, by default every user that is not revoked
+    api_options: (optional) Keyword arguments for every fitbit.API, e.g. a transport
+    lease: (optional) Seconds of the lease taken on a user in the token store, renewed before every request
+    worker_id: (optional) The ID the leases are taken under, by default a random one
+  """
+  if format not in WRITERS:
+    raise ValueError(f"format must be one of {', '.join(FORMATS)}, not {format!r}")
+  known = store.users()
+  if users:
+    missing = sorted(set(users) - set(known))
+    if missing:
+      raise ValueError(f"Not in the token store or revoked: {', '.join(missing)}")
+  os.makedirs(directory, exist_ok=True)
+  progress = Checkpoint(checkpoint)
+  plan = planner.plan(resources, start, end, detail)
+  worker_id = worker_id or f"export-{uuid.uuid4().hex[:12]}"
+  results = {}
+  for user_id in users or known:
+    hold = lambda: store.acquire(user_id, worker_id, lease)
+    # A sync worker holding the lease may refresh the user's single-use refresh token at any moment
+    if not hold():
+      results[user_id] = {"skipped": True}
+      continue
+    try:
+      tokens, expires_at = store.tokens(user_id)
+      api = fitbit.API(user_id=tokens.user_id, access_token=tokens.access_token, refresh_token=tokens.refresh_token,
+        expires_at=expires_at, **(api_options or {}))
+      try:
+        results[user_id] = export_user(api, plan, directory, format, progress, chunk_rows, wait, hold)
+      except fitbit.TokenError as error:
+        if error.revoked:
+          store.revoke(user_id)
+        results[user_id] = {"error": error}
+      except (requests.RequestException, OSError) as error:
+        results[user_id] = {"error": error}
+      finally:
+        # Refresh tokens are single use, so a refresh must be stored even if the export failed afterwards
+        if api.tokens != tokens:
+          store.save_tokens(*api.credentials)
+    finally:
+      store.release(user_id, worker_id)
+  return results
+
+def main(argv: list = None) -> dict:
+  parser = argparse.ArgumentParser(prog="python -m fitbit export", description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--tokens", required=True, help="the token store, a sync_workers coordination database")
+  parser.add_argument("--resources", default="steps,heart,sleep,weight", help="comma separated resources")
+  parser.add_argument("--start", required=True, help="the first date in the format yyyy-MM-dd")
+  parser.add_argument("--end", default=datetime.date.today().isoformat(), help="the last date in the format yyyy-MM-dd")
+  parser.add_argument("--detail", default="day", help="day or an intraday detail level, e.g. 1min")
+  parser.add_argument("--format", choices=FORMATS, default="ndjson")
+  parser.add_argument("--output", required=True, help="the output directory")
+  parser.add_argument("--checkpoint", help="the checkpoint file, by default checkpoint.json in the output directory")
+  parser.add_argument("--users", help="comma separated user IDs, by default every user in the token store")
+  parser.add_argument("--chunk-rows", type=int, default=10000, help="rows written at a time")
+  parser.add_argument("--wait", action="store_true", help="wait for rate limits to reset instead of stopping")
+  args = parser.parse_args(argv)
+  store = Coordinator(args.tokens)
+  try:
+    results = export(store, args.resources.split(","), args.start, args.end, args.output, detail=args.detail, format=args.format,
+      checkpoint=args.checkpoint or os.path.join(args.output, "checkpoint.json"), chunk_rows=args.chunk_rows, wait=args.wait,
+      users=args.users.split(",") if args.users else None)
+  finally:
+    store.close()
+  for user_id, counts in results.items():
+    if "error" in counts:
+      print(f"{user_id}: failed, {counts['error']}")
+      continue
+    if counts.get("skipped"):
+      print(f"{user_id}: skipped, leased by a sync worker, rerun to export")
+      continue
+    status = "complete" if counts["complete"] else "rate limited, rerun to resume"
+    failed = f", {counts['failed']} calls failed" if counts["failed"] else ""
+    print(f"{user_id}: {counts['rows']} rows from {counts['requests']} requests{failed}, {status}")
+  return results
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
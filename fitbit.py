@@ -1,5 +1,10 @@
-import requests, pyperclip, base64, os, json
+import requests, pyperclip, base64, os, json, time, threading, contextvars
+import endpoints
 from typing import Union
+from contextlib import nullcontext, contextmanager
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 class Fitbit:
 
@@ -12,6 +17,64 @@ class Fitbit:
   
   scope = ["activity", "nutrition", "heartrate", "location", "nutrition", "profile", "settings", "sleep", "social", "weight"]
 
+Tokens = namedtuple("Tokens", ["user_id", "access_token", "refresh_token"])
+
+# The API instances streaming in the current context, so that api.streaming() affects neither other
+# threads nor the other API instances of the same thread
+_streaming = contextvars.ContextVar("fitbit_streaming", default=frozenset())
+
+class TokenError(Exception):
+  """
+  Raised when the token endpoint rejects an authorization code or refresh token. error_type is the
+  errorType of the first error in the response, e.g. invalid_grant for a revoked refresh token.
+  """
+
+  def __init__(self, res):
+    try:
+      errors = res.json().get("errors") or [{}]
+    except ValueError:
+      errors = [{}]
+    self.status = res.status_code
+    self.error_type = errors[0].get("errorType")
+    super().__init__(f"{self.status} {self.error_type}: {errors[0].get('message', res.text)}")
+
+  @property
+  def revoked(self) -> bool:
+    """
+    Whether the refresh token can no longer be used and the user has to authorize again. Other errors,
+    e.g. a 401 invalid_client for wrong app credentials, say nothing about the user's grant.
+    """
+    return self.error_type in ("invalid_grant", "invalid_token")
+
+class DaySnapshot:
+  """
+  The merged result of API.day_snapshot. Each attribute holds the return value of the corresponding
+  endpoint method, or None if that call failed, in which case the exception is kept in errors. A
+  call fails if it raises, returns a response with an error status in debug mode, or returns a body
+  with errors, e.g. a 429 or an expired token.
+  """
+
+  parts = ("activity", "heart_rate", "sleep", "food", "water", "weight")
+
+  def __init__(self, date: str):
+    self.date = date
+    self.activity = None
+    self.heart_rate = None
+    self.sleep = None
+    self.food = None
+    self.water = None
+    self.weight = None
+    self.errors = {}
+
+  @property
+  def complete(self) -> bool:
+    """Whether every part of the snapshot was retrieved"""
+    return not self.errors
+
+  def __repr__(self) -> str:
+    retrieved = [part for part in DaySnapshot.parts if part not in self.errors]
+    return f"DaySnapshot(date={self.date!r}, retrieved={retrieved}, failed={list(self.errors)})"
+
 class API:
 
   token_url = "https://api.fitbit.com/oauth2/token"
@@ -32,54 +95,171 @@ class API:
     """Returns the base64 encoding of the user's client_id and client_secret"""
     return base64.b64encode(f"{Fitbit.client_id}:{Fitbit.client_secret}".encode('ascii')).decode('ascii') 
           
-  def __init__(self, *, debug=False):
+  def __init__(self, *, debug=False, transport=None, user_id: str = None, access_token: str = None, refresh_token: str = None, pool_size: int = 10, tracer=None, expires_at: float = None):
+    """
+    An API instance can be shared by many threads: the tokens and their expiry are swapped together
+    in one assignment, token requests are serialized, and the default transport is a requests.Session,
+    created on first use, whose connection pool is shared by all threads.
+
+    Parameters:
+      debug: (optional) If true, endpoint methods return the requests.Response instead of its data
+      transport: (optional) A callable with the signature of requests.request that sends every request,
+        e.g. a cassette.Recorder or cassette.Player
+      user_id: (optional) The encoded ID of an already authorized user
+      access_token: (optional) The user's access token; if given, the interactive authorization is skipped
+      refresh_token: (optional) The user's refresh token
+      pool_size: (optional) The number of connections kept open by the default transport
+      tracer: (optional) A tracing.Tracer that records a span for every request and composite operation
+      expires_at: (optional) The time.time() at which the given access_token expires, if known
+    """
     self.debug = debug
     self.client = API.encoded_client()
-    self.get_access_token("auth")
+    self.rate_limit = None
+    self.pool_size = pool_size
+    self.transport = transport or self.__send
+    self.tracer = tracer
+    self.__session = None
+    self.__session_lock = threading.Lock()
+    self.__token_lock = threading.RLock()
+    # The tokens and their expiry are replaced together, so no thread sees new tokens with an old expiry
+    self.__credentials = (Tokens(user_id or "-", access_token, refresh_token), expires_at)
+    if access_token is None:
+      self.get_access_token("auth")
+
+  def span(self, name: str, **attributes):
+    """
+    Returns a context manager that records a span with the instance's tracer, or does nothing without one
+
+    Parameters:
+      name: The name of the operation
+      attributes: Initial attributes of the span
+    """
+    if self.tracer is None:
+      return nullcontext()
+    return self.tracer.span(name, **attributes)
+
+  @contextmanager
+  def streaming(self):
+    """
+    Within the block, endpoint methods of this instance called by this thread return the
+    requests.Response with its body not yet read, so that it can be decoded incrementally with json_stream
+    """
+    token = _streaming.set(_streaming.get() | {self})
+    try:
+      yield
+    finally:
+      _streaming.reset(token)
+
+  @property
+  def session(self) -> requests.Session:
+    """The requests.Session of the default transport, created on first use"""
+    with self.__session_lock:
+      if self.__session is None:
+        self.__session = requests.Session()
+        self.__session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+      return self.__session
+
+  def __send(self, method: str, url: str, **kwargs) -> requests.Response:
+    return self.session.request(method, url, **kwargs)
+
+  @property
+  def credentials(self) -> tuple:
+    """The Tokens and the time.time() at which the access token expires, read together as one consistent pair"""
+    return self.__credentials
+
+  @property
+  def tokens(self) -> Tokens:
+    """The user_id, access_token and refresh_token, read together as one consistent tuple"""
+    return self.__credentials[0]
+
+  @property
+  def expires_at(self) -> float:
+    """The time.time() at which the access token expires, or None if unknown"""
+    return self.__credentials[1]
+
+  @property
+  def user_id(self) -> str:
+    return self.tokens.user_id
+
+  @property
+  def access_token(self) -> str:
+    return self.tokens.access_token
+
+  @property
+  def refresh_token(self) -> str:
+    return self.tokens.refresh_token
 
   def __set_user_and_tokens(self, res) -> None:
-    assert res.status_code == 200
+    if res.status_code != 200:
+      raise TokenError(res)
     data = res.json()
-    self.user_id = data["user_id"]
-    self.access_token = data["access_token"]
-    self.refresh_token = data["refresh_token"]
+    expires_at = time.time() + data["expires_in"] if "expires_in" in data else None
+    self.__credentials = (Tokens(data["user_id"], data["access_token"], data["refresh_token"]), expires_at)
       
   def authenticate(self, auth_code: str) -> dict:
     """
     Uses an auth_code to authenticate the user and stores instance info in
     self.user_id, self.access_token, and self.refresh_token
     """
-    res = requests.post(API.token_url, 
-      params={
-        "code": auth_code, "grant_type": "authorization_code", 
-        "client_id": Fitbit.client_id, "redirect_uri": Fitbit.redirect_uri}, 
-      headers={
-        "Authorization": f"Basic {self.client}", 
-        "Content-Type": "application/x-www-form-urlencoded"})
-    self.__set_user_and_tokens(res)
+    with self.span("token.authenticate"), self.__token_lock:
+      res = self.transport("POST", API.token_url,
+        params={
+          "code": auth_code, "grant_type": "authorization_code", 
+          "client_id": Fitbit.client_id, "redirect_uri": Fitbit.redirect_uri}, 
+        headers={
+          "Authorization": f"Basic {self.client}", 
+          "Content-Type": "application/x-www-form-urlencoded"})
+      self.__set_user_and_tokens(res)
     if self.debug:
       return res
     return res.json()
 
   def refresh(self) -> dict:
     """Uses a refresh_token and sets instance info with a new access_token and refresh_token"""
-    res = requests.post(API.token_url,
-      params={
-        "grant_type": "refresh_token", "refresh_token": self.refresh_token},
-      headers={
-        "Authorization": f"Basic {self.client}", 
-        "Content-Type": "application/x-www-form-urlencoded"})
-    self.__set_user_and_tokens(res)
+    with self.span("token.refresh", user=self.user_id), self.__token_lock:
+      res = self.transport("POST", API.token_url,
+        params={
+          "grant_type": "refresh_token", "refresh_token": self.refresh_token},
+        headers={
+          "Authorization": f"Basic {self.client}", 
+          "Content-Type": "application/x-www-form-urlencoded"})
+      self.__set_user_and_tokens(res)
     if self.debug:
       return res
     return res.json()
+
+  def refresh_if_stale(self, access_token: str) -> str:
+    """
+    Refreshes the tokens unless another thread already replaced the given access_token, and returns
+    the current access token. Use this after a request failed with an expired token, so that many
+    threads seeing the same expired token cause a single refresh.
+
+    Parameters:
+      access_token: The access token the failed request was sent with
+    """
+    with self.__token_lock:
+      if self.access_token == access_token:
+        self.refresh()
+    return self.access_token
       
-  def __request(self, http_method, url: str, *, params: dict = {}, headers: dict = {}, data: dict = {}, is_json: bool = True) -> dict:
+  def __set_rate_limit(self, res) -> None:
+    """
+    Stores the rate limit headers of a response in self.rate_limit as a dict with the hourly limit, the
+    remaining requests and the time.time() at which the budget resets
+    """
+    if "Fitbit-Rate-Limit-Remaining" not in res.headers:
+      return
+    self.rate_limit = {
+      "limit": int(res.headers.get("Fitbit-Rate-Limit-Limit", 150)),
+      "remaining": int(res.headers["Fitbit-Rate-Limit-Remaining"]),
+      "reset": time.time() + int(res.headers.get("Fitbit-Rate-Limit-Reset", 0))}
+
+  def __request(self, http_method: str, url: str, *, params: dict = {}, headers: dict = {}, data: dict = {}, is_json: bool = True) -> dict:
     """
     Sends a request to the API base url using the specified method
 
     Parameters:
-      http_method: requests.get, requests.post, requests.delete
+      http_method: GET, POST or DELETE
       url: The location of the API endpoint
       params: (optional) A dictionary of query parameters
       headers: (optional) A dictionary of header parameters
@@ -87,12 +267,29 @@ class API:
       is_json: (optional) Whether the response is json data or not
     """
     headers = { "Authorization": f"Bearer {self.access_token}" }
-    res = http_method(f"{API.base_url}{url}",headers=headers,params=params,data=data)
-    if self.debug: 
-      return res
-    if is_json:
-      return res.json()
-    return res.text
+    stream = self in _streaming.get()
+    options = {"stream": True} if stream else {}
+    if self.tracer is None:
+      res = self.transport(http_method, f"{API.base_url}{url}", headers=headers, params=params, data=data, **options)
+      self.__set_rate_limit(res)
+      if self.debug or stream:
+        return res
+      if is_json:
+        return res.json()
+      return res.text
+    with self.tracer.request_span(http_method, url, self.user_id) as span:
+      res = self.transport(http_method, f"{API.base_url}{url}", headers=headers, params=params, data=data, **options)
+      self.__set_rate_limit(res)
+      span.set("status", res.status_code)
+      if self.rate_limit is not None:
+        span.set("rate_limit_remaining", self.rate_limit["remaining"])
+      if stream:
+        return res
+      span.set("bytes", len(res.content))
+      if self.debug:
+        return res
+      with self.tracer.span("decode", bytes=len(res.content)):
+        return res.json() if is_json else res.text
   
   def __get(self, url: str, *, params: dict = {}, headers: dict = {}, data: dict = {}, is_json: bool = True) -> dict:
     """
@@ -105,7 +302,7 @@ class API:
       data: (optional) A dictionary of form data (payload) parameters
       is_json: (optional) Whether the response is json data or not
     """
-    return self.__request(requests.get, url, params=params, headers=headers, data=data, is_json=is_json)
+    return self.__request("GET", url, params=params, headers=headers, data=data, is_json=is_json)
   
   def __post(self, url: str, *, params: dict = {}, headers: dict = {}, data: dict = {}, is_json: bool = True) -> dict:
     """
@@ -118,7 +315,7 @@ class API:
       data: (optional) A dictionary of form data (payload) parameters
       is_json: (optional) Whether the response is json data or not
     """
-    return self.__request(requests.post, url, params=params, headers=headers, data=data, is_json=is_json)
+    return self.__request("POST", url, params=params, headers=headers, data=data, is_json=is_json)
   
   def __delete(self, url: str, *, params: dict = {}, headers: dict = {}, data: dict = {}, is_json: bool = True) -> dict:
     """
@@ -131,7 +328,7 @@ class API:
       data: (optional) A dictionary of form data (payload) parameters
       is_json: (optional) Whether the response is json data or not
     """
-    return self.__request(requests.delete, url, params=params, headers=headers, data=data, is_json=is_json)
+    return self.__request("DELETE", url, params=params, headers=headers, data=data, is_json=is_json)
 
   """
   Activity
@@ -279,7 +476,7 @@ class API:
 
     Parameters:
       period: daily or weekly
-      type: activeMinutes, caloriesOut, distance, floors, or steps for daily; distance, floors, or steps for weekly
+      type: activeMinutes, activeZoneMinutes, caloriesOut, distance, floors, or steps for daily; distance, floors, or steps for weekly
       value: goal value
     """
     return self.__post(f"/1/user/{self.user_id}/activities/goals/{period}.json",
@@ -299,7 +496,7 @@ class API:
       resource_path: calories, steps, distance, floors, or elevation
       base_date: The range start date in the format yyyy-MM-dd or today.
       end_or_1d: Either an end date in the format yyyy-MM-dd or the string "1d" for a single day of data
-      detail_level: Number of data points to include. Either 1min or 15min
+      detail_level: Number of data points to include. Either 1min, 5min or 15min
       start_time: (optional) The start of the period in the format HH:mm.
       end_time: (optional) The end of the period in the format HH:mm
     """
@@ -327,7 +524,7 @@ class API:
       use_tracker: (optional) If true, only tracker data is returned
     """
     tracker = "tracker/" if use_tracker else ""
-    return self.__get(f"/1/user/{self.user_id}/activities/{tracker}/{resource_path}/date/{base_date}/{end_or_period}.json")
+    return self.__get(f"/1/user/{self.user_id}/activities/{tracker}{resource_path}/date/{base_date}/{end_or_period}.json")
   
   """
   Auth
@@ -363,7 +560,7 @@ class API:
     Parameters:
       resource_path: weight or fat
       base_date: If an end date is provided, base_date refers to the start date. If a period is provided instead, base_date will be the last date of that period. If neither is provided, a single log for the day specified is returned. Format yyyy-MM-dd
-      end_or_period: (optional) A date in the format yyyy-MM-dd or one of the following periods: 1d, 7d, 30d, 1w, 1m, 3m, 6m, 1y, or max
+      end_or_period: (optional) A date in the format yyyy-MM-dd, at most 31 days after base_date, or one of the following periods: 1d, 7d, 1w, or 1m
     """
     if end_or_period is not None:
       end = f"/{end_or_period}"
@@ -694,7 +891,7 @@ class API:
       Returns a list of meals created by user in the user's food log in the format requested. 
       User creates and manages meals on the Food Log tab on the website.
       """
-      return self.__get(f"/1/user/{self.user}/meals.json")
+      return self.__get(f"/1/user/{self.user_id}/meals.json")
   
   def create_meal(self, name: str, description: str, food_id: str, unit_id: str, amount: str):
       """
@@ -707,7 +904,7 @@ class API:
         unit_id: ID of units used. Typically retrieved via a previous call to Get Food Logs, Search Foods, or Get Food Units.
         amount: Amount consumed; in the format X.XX, in the specified unitId.
       """
-      return self.__post(f"/1/user/{self.user}/meals.json",
+      return self.__post(f"/1/user/{self.user_id}/meals.json",
           params={"name": name, "description": description, "foodId": food_id, "unitId": unit_id, "amount": amount})
   
   def edit_meal(self, meal_id: str, name: str, description: str, food_id: str, unit_id: str, amount: str):
@@ -940,7 +1137,7 @@ class API:
       base_date: The date of records to be returned. In the format yyyy-MM-dd.
       end_date: The date of records to be returned. In the format yyyy-MM-dd.
     """
-    return self.__get(f"/1.2/user/{self.user_id}/date/{base_date}/{end_date}.json")
+    return self.__get(f"/1.2/user/{self.user_id}/sleep/date/{base_date}/{end_date}.json")
 
   def sleep_logs_list(self, date: str, date_type: str, sort: str, offset: int, limit: int):
     """
@@ -1003,7 +1200,8 @@ class API:
         on that collections' updates. Each subscriber can have only one subscription for a specific 
         user's collection.
     """
-    return self.__get(f"/1/user/{self.user_id}/{collection_path}/apiSubscriptions.json")
+    collection = f"{collection_path}/" if collection_path else ""
+    return self.__get(f"/1/user/{self.user_id}/{collection}apiSubscriptions.json")
 
   def add_subscription(self, collection_path: str, subscription_id: str):
     """
@@ -1022,10 +1220,12 @@ class API:
         The Fitbit servers will pass this ID back along with any notifications about the user 
         indicated by the user parameter in the URL path.
     """
-    return self.__post(f"/1/user/{self.user_id}/{collection_path}/apiSubscriptions/{subscription_id}.json")
+    collection = f"{collection_path}/" if collection_path else ""
+    return self.__post(f"/1/user/{self.user_id}/{collection}apiSubscriptions/{subscription_id}.json")
 
   def delete_subscription(self, collection_path: str, subscription_id: str):
-    return self.__delete(f"/1/user/{self.user_id}/{collection_path}/apiSubscriptions/{subscription_id}.json")
+    collection = f"{collection_path}/" if collection_path else ""
+    return self.__delete(f"/1/user/{self.user_id}/{collection}apiSubscriptions/{subscription_id}.json")
 
   """
   User
@@ -1057,3 +1257,73 @@ class API:
     """
     return self.__post(f"/1/user/{self.user_id}/profile.json",
       params=params)
+
+  """
+  Composite
+  """
+  def day_snapshot(self, date: str, max_workers: int = 6) -> DaySnapshot:
+    """
+    Retrieves the activity summary, heart rate, sleep, food, water and weight data of a single day
+    with concurrent requests, so the call takes about as long as the slowest endpoint. A failing
+    endpoint does not fail the snapshot; its exception is stored in the snapshot's errors instead.
+
+    Parameters:
+      date: The date in the format yyyy-MM-dd
+      max_workers: (optional) The maximum number of requests in flight at once
+    """
+    calls = {
+      "activity": lambda: self.activity_summary(date),
+      "heart_rate": lambda: self.heart_rate_time_series(date, "1d"),
+      "sleep": lambda: self.sleep_log(date),
+      "food": lambda: self.food_logs(date),
+      "water": lambda: self.water_logs(date),
+      "weight": lambda: self.body_logs("weight", date),
+    }
+    snapshot = DaySnapshot(date)
+    with self.span("day_snapshot", date=date, user=self.user_id):
+      with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {part: pool.submit(self.__traced(f"day_snapshot.{part}", call)) for part, call in calls.items()}
+      for part, future in futures.items():
+        try:
+          result = future.result()
+          API.raise_for_errors(result)
+          setattr(snapshot, part, result)
+        except Exception as error:
+          snapshot.errors[part] = error
+    return snapshot
+
+  @staticmethod
+  def raise_for_errors(result) -> None:
+    """
+    Raises a requests.HTTPError if the return value of an endpoint method is a failure: a response
+    with a 4xx or 5xx status in debug mode, or a parsed body with errors otherwise
+
+    Parameters:
+      result: The return value of an endpoint method
+    """
+    if isinstance(result, requests.Response):
+      result.raise_for_status()
+    elif isinstance(result, dict) and result.get("errors"):
+      error = result["errors"][0]
+      raise requests.HTTPError(f"{error.get('errorType')}: {error.get('message')}")
+
+  def __traced(self, name: str, call):
+    """Wraps a call submitted to a thread pool in a child span of the caller's span that records its queue wait"""
+    if self.tracer is None:
+      return call
+    submitted = time.time()
+    def run():
+      with self.tracer.span(name) as span:
+        span.set("queue_wait", span.start - submitted)
+        return call()
+    return self.tracer.propagate(run)
+
+endpoints.install(API)
+
+if __name__ == "__main__":
+  # python -m fitbit <command>; the commands import this module again as fitbit
+  import sys, export
+  commands = {"export": export.main}
+  if len(sys.argv) < 2 or sys.argv[1] not in commands:
+    sys.exit(f"usage: python -m fitbit {{{','.join(commands)}}} ...")
+  commands[sys.argv[1]](sys.argv[2:])
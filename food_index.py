@@ -0,0 +1,227 @@
+"""
+Local food search index
+
+Collects the foods returned by search_foods, food, recent_foods, frequent_foods and favorite_foods
+into a token/prefix index that answers searches locally, persists to a JSON file and can refresh
+itself from the API in a background thread. Only searches that miss the index go to the API.
+"""
+import os, re, json, bisect, threading
+from typing import Union
+
+_TOKEN = re.compile(r"[0-9a-z]+")
+
+def tokenize(text: str) -> list:
+  """Returns the lower-cased alphanumeric tokens of a food name or query"""
+  return _TOKEN.findall(text.lower()) if text else []
+
+class FoodIndex:
+
+  def __init__(self, path: str = None):
+    """
+    Parameters:
+      path: (optional) A JSON file the index is loaded from and saved to
+    """
+    self.path = path
+    self.foods = {}
+    self.popularity = {}
+    self.queries = {}
+    self.error = None
+    self.__postings = {}
+    self.__tokens = []
+    self.__names = {}
+    self.__food_tokens = {}
+    self.__lock = threading.RLock()
+    self.__refresher = None
+    self.__stop = threading.Event()
+    if path is not None and os.path.exists(path):
+      self.load()
+
+  def __index(self, food: dict) -> None:
+    food_id = food["foodId"]
+    self.foods[food_id] = food
+    # The normalized name is the ranking key of exact matches, so it is computed once and not per query
+    self.__names[food_id] = " ".join(tokenize(food.get("name")))
+    tokens = set(tokenize(food.get("name")) + tokenize(food.get("brand")))
+    # A food added again after its name or brand changed is no longer found by the old tokens
+    for token in self.__food_tokens.get(food_id, set()) - tokens:
+      postings = self.__postings[token]
+      postings.discard(food_id)
+      if not postings:
+        del self.__postings[token]
+        del self.__tokens[bisect.bisect_left(self.__tokens, token)]
+    self.__food_tokens[food_id] = tokens
+    for token in tokens:
+      postings = self.__postings.get(token)
+      if postings is None:
+        postings = self.__postings[token] = set()
+        bisect.insort(self.__tokens, token)
+      postings.add(food_id)
+
+  def add(self, foods: list, weight: int = 0) -> None:
+    """
+    Adds or replaces foods in the index
+
+    Parameters:
+      foods: Food dicts with at least foodId and name
+      weight: (optional) Popularity added to each food, e.g. for foods the user logs frequently
+    """
+    with self.__lock:
+      for food in foods:
+        if "foodId" not in food:
+          continue
+        self.__index(food)
+        self.popularity[food["foodId"]] = self.popularity.get(food["foodId"], 0) + weight
+
+  def add_response(self, res: Union[dict, list], weight: int = 0) -> list:
+    """
+    Adds the foods of a search_foods, food, recent_foods, frequent_foods or favorite_foods response
+    and returns them
+
+    Parameters:
+      res: The parsed response
+      weight: (optional) Popularity added to each food
+    """
+    if isinstance(res, dict):
+      foods = res["foods"] if "foods" in res else [res["food"]] if "food" in res else []
+    else:
+      foods = res
+    self.add(foods, weight)
+    return foods
+
+  def __candidates(self, token: str, prefix: bool) -> set:
+    if not prefix:
+      return self.__postings.get(token, set())
+    matches = set()
+    tokens = self.__tokens
+    # Walks the sorted tokens from the first one not below the prefix, without copying the list
+    index = bisect.bisect_left(tokens, token)
+    while index < len(tokens) and tokens[index].startswith(token):
+      matches |= self.__postings[tokens[index]]
+      index += 1
+    return matches
+
+  def lookup(self, query: str, limit: int = 20) -> list:
+    """
+    Returns the indexed foods matching every token of the query, treating the last token as a prefix.
+    Results are ranked by exact name match, popularity and name length.
+
+    Parameters:
+      query: The search query
+      limit: (optional) The maximum number of foods returned
+    """
+    tokens = tokenize(query)
+    if not tokens:
+      return []
+    with self.__lock:
+      matches = None
+      for position, token in enumerate(tokens):
+        candidates = self.__candidates(token, position == len(tokens) - 1)
+        matches = candidates if matches is None else matches & candidates
+        if not matches:
+          return []
+      name = " ".join(tokens)
+      ranked = sorted(matches, key=lambda food_id: (
+        self.__names[food_id] != name,
+        -self.popularity.get(food_id, 0),
+        len(self.foods[food_id].get("name", ""))))
+      return [self.foods[food_id] for food_id in ranked[:limit]]
+
+  def search(self, query: str, api=None, limit: int = 20) -> list:
+    """
+    Answers a search from the index and falls back to api.search_foods when the query misses it
+
+    Parameters:
+      query: The search query
+      api: (optional) A fitbit.API instance used for queries that miss the index
+      limit: (optional) The maximum number of foods returned
+    """
+    key = " ".join(tokenize(query))
+    results = self.lookup(query, limit)
+    if results or api is None or key in self.queries:
+      with self.__lock:
+        if key in self.queries:
+          self.queries[key] += 1
+      return results
+    res = api.search_foods(query)
+    self.add_response(res.json() if api.debug else res)
+    with self.__lock:
+      self.queries[key] = self.queries.get(key, 0) + 1
+    return self.lookup(query, limit)
+
+  def refresh(self, api, top_queries: int = 50) -> None:
+    """
+    Refreshes the index from the user's recent, frequent and favorite foods and re-runs the most used searches
+
+    Parameters:
+      api: A fitbit.API instance
+      top_queries: (optional) The number of most used searches to re-run
+    """
+    unwrap = (lambda res: res.json()) if api.debug else (lambda res: res)
+    self.add_response(unwrap(api.recent_foods()), weight=1)
+    self.add_response(unwrap(api.frequent_foods()), weight=2)
+    self.add_response(unwrap(api.favorite_foods()), weight=3)
+    with self.__lock:
+      queries = sorted(self.queries, key=self.queries.get, reverse=True)[:top_queries]
+    for query in queries:
+      self.add_response(unwrap(api.search_foods(query)))
+    if self.path is not None:
+      self.save()
+
+  def start_refresh(self, api, interval: float = 3600.0, top_queries: int = 50) -> None:
+    """
+    Starts a daemon thread that calls refresh every interval seconds until stop_refresh is called. The
+    exception of a failed refresh is kept in error until a refresh succeeds.
+
+    Parameters:
+      api: A fitbit.API instance
+      interval: (optional) Seconds between refreshes
+      top_queries: (optional) The number of most used searches to re-run
+    """
+    if self.__refresher is not None and self.__refresher.is_alive():
+      return
+    self.__stop.clear()
+    def run():
+      while not self.__stop.is_set():
+        try:
+          self.refresh(api, top_queries)
+          self.error = None
+        except Exception as error:
+          self.error = error
+        self.__stop.wait(interval)
+    self.__refresher = threading.Thread(target=run, name="food-index-refresh", daemon=True)
+    self.__refresher.start()
+
+  def stop_refresh(self) -> None:
+    """Stops the background refresh thread"""
+    self.__stop.set()
+    if self.__refresher is not None:
+      self.__refresher.join()
+      self.__refresher = None
+
+  def save(self, path: str = None) -> None:
+    """
+    Writes the index to a JSON file, replacing it atomically
+
+    Parameters:
+      path: (optional) The file to write, defaults to the path the index was created with
+    """
+    path = path or self.path
+    with self.__lock:
+      state = {"foods": list(self.foods.values()), "popularity": list(self.popularity.items()), "queries": self.queries}
+      with open(f"{path}.tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(f"{path}.tmp", path)
+
+  def load(self, path: str = None) -> None:
+    """
+    Loads foods, popularity and known queries from a JSON file written by save
+
+    Parameters:
+      path: (optional) The file to read, defaults to the path the index was created with
+    """
+    with open(path or self.path) as file:
+      state = json.load(file)
+    with self.__lock:
+      self.add(state["foods"])
+      self.popularity.update(state["popularity"])
+      self.queries.update(state["queries"])
@@ -0,0 +1,206 @@
+"""
+Vectorized heart rate analytics
+
+Computes custom heart rate zones, time in zone, training load (Banister and Edwards TRIMP) and heart
+rate recovery from columnar intraday heart rate: an array of sample times and an array of beats per
+minute, e.g. from heart_rate_intraday responses or an IntradayCache. Every metric is computed with
+numpy over the whole range at once, so a year of 1sec data takes well under a second.
+"""
+import datetime
+import numpy as np
+from intraday_cache import seconds_of_day
+
+ZONE_NAMES = ("Below zones", "Very light", "Light", "Moderate", "Hard", "Maximum")
+ZONE_FRACTIONS = (0.5, 0.6, 0.7, 0.8, 0.9)
+
+def max_heart_rate(age: float, formula: str = "tanaka") -> float:
+  """
+  Estimates the maximum heart rate from age
+
+  Parameters:
+    age: The age in years, e.g. the age of a profile response
+    formula: (optional) tanaka (208 - 0.7 * age) or fox (220 - age)
+  """
+  return 220.0 - age if formula == "fox" else 208.0 - 0.7 * age
+
+def zones(max_hr: float, resting_hr: float = None, fractions: tuple = ZONE_FRACTIONS) -> np.ndarray:
+  """
+  Returns the lower bounds in bpm of the zones above "Below zones", as fractions of the maximum heart
+  rate, or of the heart rate reserve (Karvonen) when a resting heart rate is given
+
+  Parameters:
+    max_hr: The measured or estimated maximum heart rate
+    resting_hr: (optional) The resting heart rate
+    fractions: (optional) The increasing fractions that start each zone
+  """
+  fractions = np.asarray(fractions, np.float64)
+  if resting_hr is None:
+    return fractions * max_hr
+  return resting_hr + fractions * (max_hr - resting_hr)
+
+def zones_from_profile(res: dict, resting_hr: float = None) -> np.ndarray:
+  """
+  Returns zone bounds for the age of a profile response
+
+  Parameters:
+    res: The parsed profile response
+    resting_hr: (optional) The resting heart rate, e.g. restingHeartRate of heart_rate_time_series
+  """
+  return zones(max_heart_rate(res["user"]["age"]), resting_hr)
+
+def from_intraday(res: dict, date: str = None) -> tuple:
+  """
+  Returns (times, bpm) arrays of a single day heart_rate_intraday response, times in seconds since the epoch
+
+  Parameters:
+    res: The parsed response
+    date: (optional) The day of the response, by default the dateTime of its summary
+  """
+  if date is None:
+    date = res["activities-heart"][0]["dateTime"]
+  dataset = res["activities-heart-intraday"]["dataset"]
+  midnight = int(datetime.datetime.fromisoformat(date).replace(tzinfo=datetime.timezone.utc).timestamp())
+  times = midnight + seconds_of_day([point["time"] for point in dataset]).astype(np.int64)
+  return times, np.fromiter((point["value"] for point in dataset), np.float32, len(dataset))
+
+def from_cache(values: np.ndarray, present: np.ndarray, start: str) -> tuple:
+  """
+  Returns (times, bpm) arrays from the (days, slots) values and presence of IntradayCache
+
+  Parameters:
+    values: The values view returned by IntradayCache.values
+    present: The presence array returned by IntradayCache.present
+    start: The first day of the views in the format yyyy-MM-dd
+  """
+  step = 86400 // values.shape[1]
+  midnight = int(datetime.datetime.fromisoformat(start).replace(tzinfo=datetime.timezone.utc).timestamp())
+  index = np.flatnonzero(present.reshape(-1))
+  return midnight + index.astype(np.int64) * step, values.reshape(-1)[index]
+
+def _seconds(times) -> np.ndarray:
+  times = np.asarray(times)
+  if np.issubdtype(times.dtype, np.datetime64):
+    return times.astype("datetime64[s]").astype(np.int64)
+  return times.astype(np.int64, copy=False)
+
+def _window(times: np.ndarray, bpm: np.ndarray, start: int = None, end: int = None) -> tuple:
+  first = 0 if start is None else np.searchsorted(times, start, "left")
+  last = len(times) if end is None else np.searchsorted(times, end, "right")
+  return times[first:last], bpm[first:last]
+
+def sample_durations(times: np.ndarray, max_gap: int = 60) -> np.ndarray:
+  """
+  Returns the seconds each sample stands for: the time to the next sample, capped at max_gap so that
+  periods without data (device off, not worn) are not counted
+
+  Parameters:
+    times: Sample times in seconds, ascending
+    max_gap: (optional) The longest time in seconds a single sample may stand for
+  """
+  durations = np.empty(len(times), np.float64)
+  if len(times):
+    np.subtract(times[1:], times[:-1], out=durations[:-1])
+    durations[-1] = 1
+    np.minimum(durations, max_gap, out=durations)
+  return durations
+
+def time_in_zones(times, bpm: np.ndarray, bounds: np.ndarray, start: int = None, end: int = None, max_gap: int = 60) -> np.ndarray:
+  """
+  Returns the seconds spent in each zone, "Below zones" first, between start and end
+
+  Parameters:
+    times: Sample times in seconds since the epoch or as datetime64
+    bpm: Heart rate of every sample
+    bounds: The zone lower bounds returned by zones()
+    start: (optional) The first second of the range
+    end: (optional) The last second of the range
+    max_gap: (optional) The longest time in seconds a single sample may stand for
+  """
+  times, bpm = _window(_seconds(times), bpm, start, end)
+  index = np.searchsorted(np.asarray(bounds, bpm.dtype), bpm, "right")
+  return np.bincount(index, weights=sample_durations(times, max_gap), minlength=len(bounds) + 1)
+
+def daily_time_in_zones(times, bpm: np.ndarray, bounds: np.ndarray, utc_offset: int = 0, max_gap: int = 60) -> tuple:
+  """
+  Returns the days (datetime64[D]) and a (days, zones) array of the seconds spent in each zone per day
+
+  Parameters:
+    times: Sample times in seconds since the epoch or as datetime64
+    bpm: Heart rate of every sample
+    bounds: The zone lower bounds returned by zones()
+    utc_offset: (optional) Seconds added to the times to get the user's local day
+    max_gap: (optional) The longest time in seconds a single sample may stand for
+  """
+  times = _seconds(times)
+  if not len(times):
+    return np.empty(0, "datetime64[D]"), np.zeros((0, len(bounds) + 1))
+  days = (times + utc_offset) // 86400
+  first = days[0]
+  index = (days - first) * (len(bounds) + 1) + np.searchsorted(np.asarray(bounds, bpm.dtype), bpm, "right")
+  count = int(days[-1] - first + 1)
+  totals = np.bincount(index, weights=sample_durations(times, max_gap), minlength=count * (len(bounds) + 1))
+  return np.arange(first, first + count).astype("datetime64[D]"), totals.reshape(count, len(bounds) + 1)
+
+def banister_trimp(times, bpm: np.ndarray, max_hr: float, resting_hr: float, sex: str = "male",
+    start: int = None, end: int = None, max_gap: int = 60) -> float:
+  """
+  Returns Banister's training impulse: the sum over samples of minutes * HRr * a * exp(b * HRr), where
+  HRr is the fraction of the heart rate reserve
+
+  Parameters:
+    times: Sample times in seconds since the epoch or as datetime64
+    bpm: Heart rate of every sample
+    max_hr: The maximum heart rate
+    resting_hr: The resting heart rate
+    sex: (optional) male (a=0.64, b=1.92) or female (a=0.86, b=1.67)
+    start: (optional) The first second of the range
+    end: (optional) The last second of the range
+    max_gap: (optional) The longest time in seconds a single sample may stand for
+  """
+  a, b = (0.86, 1.67) if sex == "female" else (0.64, 1.92)
+  times, bpm = _window(_seconds(times), bpm, start, end)
+  reserve = np.clip((bpm - np.float32(resting_hr)) / np.float32(max_hr - resting_hr), 0, 1)
+  return float(np.dot(sample_durations(times, max_gap) / 60, reserve * a * np.exp(b * reserve)))
+
+def edwards_trimp(times, bpm: np.ndarray, bounds: np.ndarray, start: int = None, end: int = None, max_gap: int = 60) -> float:
+  """
+  Returns Edwards' training impulse: the minutes in each zone weighted by the zone number (1 to 5)
+
+  Parameters:
+    times: Sample times in seconds since the epoch or as datetime64
+    bpm: Heart rate of every sample
+    bounds: The five zone lower bounds returned by zones()
+    start: (optional) The first second of the range
+    end: (optional) The last second of the range
+    max_gap: (optional) The longest time in seconds a single sample may stand for
+  """
+  seconds = time_in_zones(times, bpm, bounds, start, end, max_gap)
+  return float(np.dot(seconds / 60, np.arange(len(seconds))))
+
+def recovery(times, bpm: np.ndarray, start: int = None, end: int = None, after: tuple = (60, 120)) -> dict:
+  """
+  Returns the peak heart rate between start and end and the drop in heart rate the given numbers of
+  seconds after the peak, e.g. {"peak": 172.0, "peak_time": ..., 60: 28.0, 120: 45.0}. A drop is None
+  if there is no sample at that time.
+
+  Parameters:
+    times: Sample times in seconds since the epoch or as datetime64
+    bpm: Heart rate of every sample
+    start: (optional) The first second of the exercise
+    end: (optional) The last second of the exercise
+    after: (optional) The delays in seconds after the peak to measure the drop at
+  """
+  times = _seconds(times)
+  window_times, window_bpm = _window(times, bpm, start, end)
+  if not len(window_bpm):
+    return {"peak": None, "peak_time": None, **{delay: None for delay in after}}
+  # The last sample at the peak, so that a plateau at the end of an exercise counts from its end
+  peak = len(window_bpm) - 1 - int(np.argmax(window_bpm[::-1]))
+  peak_time = int(window_times[peak])
+  targets = peak_time + np.asarray(after, np.int64)
+  index = np.searchsorted(times, targets, "left")
+  result = {"peak": float(window_bpm[peak]), "peak_time": peak_time}
+  for delay, target, position in zip(after, targets, index):
+    found = position < len(times) and times[position] - target <= 5
+    result[delay] = float(window_bpm[peak] - bpm[position]) if found else None
+  return result
@@ -0,0 +1,317 @@
+"""
+Compressed, deduplicated store of fetched responses
+
+Keeps years of synced responses (intraday days, sleep logs, TCX files) in one SQLite file at a
+fraction of their size as raw JSON. Every payload is stored as a content-addressed block, keyed by
+the hash of its canonical bytes, so a payload fetched again or shared by several dates is stored
+once. Intraday datasets are delta encoded: the times become seconds of the day and integer values
+differences to the previous point, while float values are XORed with the bits of the previous
+point, which is lossless and leaves mostly zero bytes for slowly changing values. Both are
+byte-shuffled so that the slowly changing bytes of every number end up next to each other. Blocks
+are compressed with zlib using a dictionary trained per resource from its first blocks, which
+matters most for the many small, similar payloads such as sleep logs. Entries are indexed by user,
+resource and date for random access, and dataset() decodes an intraday day straight into numpy
+arrays without building JSON.
+"""
+import json, time, zlib, struct, sqlite3, hashlib, threading
+import numpy as np
+from intraday_cache import seconds_of_day
+
+JSON, SERIES, TEXT, BYTES = range(4)
+
+_SERIES_HEADER = struct.Struct("<BII")
+_INTEGER, _FLOAT = 0, 1
+
+def _canonical(data) -> bytes:
+  return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def _shuffle(array: np.ndarray) -> bytes:
+  """Stores the first byte of every number, then every second byte, and so on"""
+  return np.ascontiguousarray(array.view(np.uint8).reshape(-1, array.itemsize).T).tobytes()
+
+def _unshuffle(data: bytes, dtype, count: int) -> np.ndarray:
+  dtype = np.dtype(dtype)
+  return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(dtype.itemsize, count).T).view(dtype).reshape(count)
+
+def _times(seconds: np.ndarray) -> list:
+  """Formats seconds of the day as HH:mm:ss strings, the inverse of seconds_of_day"""
+  seconds = seconds.astype(np.int32)
+  fields = np.stack([seconds // 3600, seconds // 60 % 60, seconds % 60], axis=1)
+  text = np.full((len(seconds), 8), ord(":"), np.uint8)
+  text[:, 0::3] = fields // 10 + ord("0")
+  text[:, 1::3] = fields % 10 + ord("0")
+  return text.view("S8").ravel().astype(str).tolist()
+
+def _intraday_key(data) -> str:
+  """Returns the key of a delta-encodable intraday dataset in a response, or None"""
+  if not isinstance(data, dict):
+    return None
+  for key, value in data.items():
+    if key.endswith("-intraday") and isinstance(value, dict) and isinstance(value.get("dataset"), list) and value["dataset"]:
+      points = value["dataset"]
+      if all(type(point) is dict and len(point) == 2 and isinstance(point.get("time"), str) and len(point["time"]) == 8 for point in points):
+        kinds = {type(point.get("value")) for point in points}
+        if kinds == {int} or kinds == {float}:
+          return key
+  return None
+
+def _encode_series(data: dict, key: str) -> bytes:
+  points = data[key]["dataset"]
+  skeleton = dict(data)
+  skeleton[key] = dict(data[key], dataset=None)
+  skeleton = _canonical(skeleton)
+  seconds = seconds_of_day([point["time"] for point in points])
+  kind = _INTEGER if type(points[0]["value"]) is int else _FLOAT
+  if kind == _INTEGER:
+    values = np.diff(np.fromiter((point["value"] for point in points), np.int64, len(points)), prepend=0)
+  else:
+    bits = np.fromiter((point["value"] for point in points), np.float64, len(points)).view(np.uint64)
+    values = np.bitwise_xor(bits, np.concatenate([np.zeros(1, np.uint64), bits[:-1]]))
+  return b"".join([_SERIES_HEADER.pack(kind, len(skeleton), len(points)), skeleton,
+    _shuffle(np.diff(seconds, prepend=0).astype(np.int32)), _shuffle(values)])
+
+def _decode_series(payload: bytes) -> tuple:
+  """Returns the skeleton, the seconds of day and the values of a delta-encoded block"""
+  kind, length, count = _SERIES_HEADER.unpack_from(payload)
+  offset = _SERIES_HEADER.size
+  skeleton = json.loads(payload[offset:offset + length])
+  offset += length
+  seconds = np.cumsum(_unshuffle(payload[offset:offset + 4 * count], np.int32, count), dtype=np.int32)
+  offset += 4 * count
+  values = _unshuffle(payload[offset:offset + 8 * count], np.int64 if kind == _INTEGER else np.uint64, count)
+  if kind == _INTEGER:
+    values = np.cumsum(values)
+  else:
+    values = np.bitwise_xor.accumulate(values).view(np.float64)
+  return skeleton, seconds, values
+
+class HistoryStore:
+
+  def __init__(self, path: str, *, level: int = 9, train_after: int = 8, dictionary_size: int = 32768):
+    """
+    Parameters:
+      path: The SQLite database file
+      level: (optional) The zlib compression level
+      train_after: (optional) Blocks of a resource stored before its dictionary is trained from them
+      dictionary_size: (optional) The most bytes of a dictionary
+    """
+    self.level = level
+    self.train_after = train_after
+    self.dictionary_size = dictionary_size
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, resource TEXT NOT NULL, data BLOB NOT NULL);
+      CREATE TABLE IF NOT EXISTS blocks (hash BLOB PRIMARY KEY, resource TEXT NOT NULL, codec INTEGER NOT NULL,
+        dictionary INTEGER, size INTEGER NOT NULL, data BLOB NOT NULL);
+      CREATE TABLE IF NOT EXISTS entries (user_id TEXT NOT NULL, resource TEXT NOT NULL, date TEXT NOT NULL, hash BLOB NOT NULL,
+        stored REAL NOT NULL, PRIMARY KEY (user_id, resource, date)) WITHOUT ROWID;
+      CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+    """)
+    self.__dictionaries = {}
+    # The blocks of every resource without a dictionary, counted once, so that a put does not query them
+    self.__untrained = {}
+    self.__lock = threading.RLock()
+
+  def __dictionary(self, resource: str = None, id: int = None) -> tuple:
+    """Returns the (id, data) of the latest dictionary of a resource or of the one with an ID, or (None, None)"""
+    key = id if id is not None else resource
+    if key not in self.__dictionaries:
+      column = "id" if id is not None else "resource"
+      row = self.db.execute(f"SELECT id, data FROM dictionaries WHERE {column} = ? ORDER BY id DESC LIMIT 1", (key,)).fetchone()
+      if row is None:
+        if id is not None:
+          return None, None
+        # Resources without a dictionary are remembered too, until train() adds one
+        self.__dictionaries[key] = (None, None)
+      else:
+        self.__dictionaries[key] = (row[0], bytes(row[1]))
+    return self.__dictionaries[key]
+
+  def train(self, resource: str, samples: list) -> int:
+    """
+    Trains a new dictionary of a resource from sample payloads and returns its ID. Blocks compressed
+    with an earlier dictionary keep using it. zlib finds matches nearest the end of a dictionary at
+    the lowest cost, so the most recent samples go last.
+
+    Parameters:
+      resource: The resource, e.g. heart_rate_intraday or sleep_log
+      samples: Encoded payloads of the resource
+    """
+    data = b"".join(samples)[-self.dictionary_size:]
+    with self.__lock:
+      id = self.db.execute("INSERT INTO dictionaries (resource, data) VALUES (?, ?)", (resource, data)).lastrowid
+      self.__dictionaries[resource] = self.__dictionaries[id] = (id, data)
+      return id
+
+  def __compress(self, resource: str, payload: bytes) -> tuple:
+    id, dictionary = self.__dictionary(resource)
+    if dictionary is None:
+      untrained = self.__untrained.get(resource)
+      if untrained is None:
+        untrained = self.db.execute("SELECT COUNT(*) FROM blocks WHERE resource = ? AND dictionary IS NULL", (resource,)).fetchone()[0]
+      if untrained >= self.train_after:
+        rows = self.db.execute("SELECT data FROM blocks WHERE resource = ? AND dictionary IS NULL LIMIT ?",
+          (resource, self.train_after)).fetchall()
+        id = self.train(resource, [self.__decompress(None, data) for data, in rows])
+        dictionary = self.__dictionary(id=id)[1]
+        self.__untrained.pop(resource, None)
+      else:
+        # Counts the block about to be inserted
+        self.__untrained[resource] = untrained + 1
+    compressor = zlib.compressobj(self.level, zdict=dictionary) if dictionary else zlib.compressobj(self.level)
+    return id, compressor.compress(payload) + compressor.flush()
+
+  def __decompress(self, id: int, data: bytes) -> bytes:
+    if id is None:
+      return zlib.decompress(data)
+    decompressor = zlib.decompressobj(zdict=self.__dictionary(id=id)[1])
+    return decompressor.decompress(data) + decompressor.flush()
+
+  def __transaction(self, function, *args):
+    """Runs function in one transaction, forgetting the cached dictionaries and counts if it fails"""
+    self.db.execute("BEGIN IMMEDIATE")
+    try:
+      result = function(*args)
+    except BaseException:
+      self.db.execute("ROLLBACK")
+      self.__dictionaries.clear()
+      self.__untrained.clear()
+      raise
+    self.db.execute("COMMIT")
+    return result
+
+  def put(self, user_id: str, resource: str, date: str, data) -> bool:
+    """
+    Stores a payload and returns whether it needed a new block, i.e. was not already stored. The
+    stored time of an entry whose payload did not change is kept, so entries(since) only returns changes.
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The resource, e.g. the name of the endpoint method, which selects the dictionary
+      date: The date in the format yyyy-MM-dd, or another key such as the log ID of a TCX file
+      data: The parsed response, or the text or bytes of a non-JSON response such as TCX
+    """
+    if isinstance(data, bytes):
+      codec, payload = BYTES, data
+    elif isinstance(data, str):
+      codec, payload = TEXT, data.encode("utf-8")
+    else:
+      key = _intraday_key(data)
+      codec, payload = (SERIES, _encode_series(data, key)) if key else (JSON, _canonical(data))
+    digest = hashlib.blake2b(bytes([codec]) + payload, digest_size=20).digest()
+    with self.__lock:
+      return self.__transaction(self.__put, user_id, resource, date, codec, payload, digest)
+
+  def __put(self, user_id: str, resource: str, date: str, codec: int, payload: bytes, digest: bytes) -> bool:
+    new = self.db.execute("SELECT 1 FROM blocks WHERE hash = ?", (digest,)).fetchone() is None
+    if new:
+      id, compressed = self.__compress(resource, payload)
+      self.db.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)", (digest, resource, codec, id, len(payload), compressed))
+    previous = self.db.execute("SELECT hash FROM entries WHERE user_id = ? AND resource = ? AND date = ?", (user_id, resource, date)).fetchone()
+    if previous is not None and previous[0] == digest:
+      return new
+    self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (user_id, resource, date, digest, time.time()))
+    if previous is not None:
+      self.__collect(previous[0])
+    return new
+
+  def __block(self, user_id: str, resource: str, date: str) -> tuple:
+    row = self.db.execute("""SELECT codec, dictionary, data FROM blocks JOIN entries ON entries.hash = blocks.hash
+      WHERE user_id = ? AND entries.resource = ? AND date = ?""", (user_id, resource, date)).fetchone()
+    if row is None:
+      return None, None
+    return row[0], self.__decompress(row[1], row[2])
+
+  def get(self, user_id: str, resource: str, date: str, default=None):
+    """
+    Returns a stored payload as it was put, or default
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The resource
+      date: The date or other key
+      default: (optional) Returned if nothing is stored
+    """
+    with self.__lock:
+      codec, payload = self.__block(user_id, resource, date)
+    if codec is None:
+      return default
+    if codec == BYTES:
+      return payload
+    if codec == TEXT:
+      return payload.decode("utf-8")
+    if codec == JSON:
+      return json.loads(payload)
+    skeleton, seconds, values = _decode_series(payload)
+    key = next(key for key, value in skeleton.items() if key.endswith("-intraday") and isinstance(value, dict) and value.get("dataset", 0) is None)
+    skeleton[key]["dataset"] = [{"time": time, "value": value} for time, value in zip(_times(seconds), values.tolist())]
+    return skeleton
+
+  def dataset(self, user_id: str, resource: str, date: str) -> tuple:
+    """
+    Returns the (seconds of day, values) numpy arrays of a stored intraday day without building its
+    JSON, or None if nothing is stored
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The resource
+      date: The date in the format yyyy-MM-dd
+    """
+    with self.__lock:
+      codec, payload = self.__block(user_id, resource, date)
+    if codec is None:
+      return None
+    if codec != SERIES:
+      raise ValueError(f"{resource} of {date} is not a delta-encoded intraday dataset")
+    _, seconds, values = _decode_series(payload)
+    return seconds, values
+
+  def dates(self, user_id: str, resource: str, start: str = None, end: str = None) -> list:
+    """Returns the dates or keys stored for a user's resource, optionally from start to end inclusive, in order"""
+    query, arguments = "SELECT date FROM entries WHERE user_id = ? AND resource = ?", [user_id, resource]
+    if start is not None:
+      query, arguments = f"{query} AND date >= ?", arguments + [start]
+    if end is not None:
+      query, arguments = f"{query} AND date <= ?", arguments + [end]
+    with self.__lock:
+      return [row[0] for row in self.db.execute(f"{query} ORDER BY date", arguments)]
+
+  def entries(self, since: float = None) -> list:
+    """
+    Returns the (user_id, resource, date, stored) of every entry, ordered by the time.time() it was stored
+
+    Parameters:
+      since: (optional) Only return entries stored after this time.time()
+    """
+    with self.__lock:
+      return self.db.execute("SELECT user_id, resource, date, stored FROM entries WHERE stored > ? ORDER BY stored",
+        (since if since is not None else float("-inf"),)).fetchall()
+
+  def __collect(self, digest: bytes) -> None:
+    if self.db.execute("SELECT 1 FROM entries WHERE hash = ? LIMIT 1", (digest,)).fetchone() is None:
+      if self.db.execute("DELETE FROM blocks WHERE hash = ?", (digest,)).rowcount:
+        # The deleted block may have been one of the counted blocks without a dictionary
+        self.__untrained.clear()
+
+  def __delete(self, user_id: str, resource: str, date: str) -> None:
+    row = self.db.execute("SELECT hash FROM entries WHERE user_id = ? AND resource = ? AND date = ?", (user_id, resource, date)).fetchone()
+    if row is not None:
+      self.db.execute("DELETE FROM entries WHERE user_id = ? AND resource = ? AND date = ?", (user_id, resource, date))
+      self.__collect(row[0])
+
+  def delete(self, user_id: str, resource: str, date: str) -> None:
+    """Deletes an entry, and its block unless other entries share it"""
+    with self.__lock:
+      self.__transaction(self.__delete, user_id, resource, date)
+
+  def stats(self) -> dict:
+    """Returns the number of entries and blocks, and the bytes of the stored payloads before and after compression"""
+    with self.__lock:
+      entries = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+      blocks, size, stored = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM blocks").fetchone()
+      dictionaries = self.db.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM dictionaries").fetchone()[0]
+    return {"entries": entries, "blocks": blocks, "payload_bytes": size, "stored_bytes": stored + dictionaries}
+
+  def close(self) -> None:
+    self.db.close()
@@ -0,0 +1,216 @@
+"""
+Memory-mapped binary cache for per-day intraday series
+
+Each (user, resource, detail level) gets one file in which every calendar day since EPOCH has a
+fixed-size record: the values of every slot of the day (1440 for 1min, 86,400 for 1sec), a bitmap
+of the slots that have a value, and a flag telling whether the day is complete. The file is
+memory-mapped, so reading a date range returns an array view over the file without parsing or
+copying, and the completeness flags tell a backfill exactly which days still need fetching.
+Days that were never written are holes in a sparse file and take no disk space.
+"""
+import os, struct, datetime, threading
+import numpy as np
+
+EPOCH = datetime.date(2009, 1, 1)
+
+SLOTS = {"1sec": 86400, "1min": 1440, "5min": 288, "15min": 96}
+
+MAGIC = b"FBIC0001"
+HEADER = 64
+
+def _record(slots: int) -> np.dtype:
+  """The on-disk layout of one day, padded to a multiple of 8 bytes"""
+  used = 4 * slots + slots // 8 + 1
+  return np.dtype([("values", "<f4", (slots,)), ("present", "u1", (slots // 8,)), ("complete", "u1"),
+    ("padding", "u1", (-used % 8,))])
+
+def _day(date) -> int:
+  if isinstance(date, str):
+    date = datetime.date.fromisoformat(date)
+  return (date - EPOCH).days
+
+def _date(day: int) -> str:
+  return (EPOCH + datetime.timedelta(days=int(day))).isoformat()
+
+def seconds_of_day(times: list) -> np.ndarray:
+  """
+  Converts the HH:mm:ss time strings of an intraday dataset to seconds since midnight
+
+  Parameters:
+    times: A list of time strings
+  """
+  raw = np.frombuffer("".join(times).encode("ascii"), np.uint8).reshape(len(times), 8).astype(np.int32) - ord("0")
+  return (raw[:, 0] * 10 + raw[:, 1]) * 3600 + (raw[:, 3] * 10 + raw[:, 4]) * 60 + raw[:, 6] * 10 + raw[:, 7]
+
+def intraday_dataset(res: dict) -> list:
+  """
+  Returns the dataset list of an activity_intraday or heart_rate_intraday response
+
+  Parameters:
+    res: The parsed response of a single day
+  """
+  for key, value in res.items():
+    if key.endswith("-intraday"):
+      return value["dataset"]
+  raise KeyError("The response does not contain an intraday dataset")
+
+def last_sync(devices: list) -> str:
+  """
+  Returns the latest lastSyncTime of a user's trackers, or None if none has synced
+
+  Parameters:
+    devices: The parsed response of API.devices
+  """
+  times = [device["lastSyncTime"] for device in devices if device.get("lastSyncTime")]
+  return max(times) if times else None
+
+class IntradayCache:
+
+  def __init__(self, root: str):
+    """
+    Parameters:
+      root: The directory holding one sub-directory of cache files per user
+    """
+    self.root = root
+    self.__maps = {}
+    self.__lock = threading.Lock()
+
+  def path(self, user_id: str, resource: str, detail_level: str) -> str:
+    """Returns the cache file of a user's resource at a detail level"""
+    return os.path.join(self.root, user_id, f"{resource}-{detail_level}.bin")
+
+  def __open(self, user_id: str, resource: str, detail_level: str, days: int = 0) -> np.memmap:
+    """Returns the memory map of a cache file with room for at least days records, or None if it doesn't exist"""
+    key = (user_id, resource, detail_level)
+    with self.__lock:
+      records = self.__maps.get(key)
+      if records is not None and len(records) >= days:
+        return records
+      path = self.path(user_id, resource, detail_level)
+      record = _record(SLOTS[detail_level])
+      if not os.path.exists(path):
+        if days == 0:
+          return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+          file.write(MAGIC + struct.pack("<II", SLOTS[detail_level], record.itemsize).ljust(HEADER - len(MAGIC), b"\0"))
+      with open(path, "rb+") as file:
+        header = file.read(HEADER)
+        if header[:len(MAGIC)] != MAGIC or struct.unpack_from("<II", header, len(MAGIC)) != (SLOTS[detail_level], record.itemsize):
+          raise ValueError(f"{path} is not an intraday cache file for {detail_level} data")
+        stored = (os.path.getsize(path) - HEADER) // record.itemsize
+        if stored < days:
+          # Grow in whole months so that a backfill doesn't remap the file for every day
+          stored = days + 31
+          file.truncate(HEADER + stored * record.itemsize)
+      if stored == 0:
+        return None
+      records = np.memmap(path, dtype=record, mode="r+", offset=HEADER, shape=(stored,))
+      self.__maps[key] = records
+      return records
+
+  def put(self, user_id: str, resource: str, detail_level: str, date: str, seconds: np.ndarray, values: np.ndarray, complete: bool) -> None:
+    """
+    Writes the values of one day
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The intraday resource, e.g. steps, calories or heart
+      detail_level: 1sec, 1min, 5min or 15min
+      date: The day in the format yyyy-MM-dd
+      seconds: The second of the day of every value
+      values: The values
+      complete: Whether the day is over and fully synced, so that it never needs fetching again
+    """
+    slots = SLOTS[detail_level]
+    day = _day(date)
+    records = self.__open(user_id, resource, detail_level, day + 1)
+    present = np.zeros(slots, bool)
+    slot = np.asarray(seconds) // (86400 // slots)
+    present[slot] = True
+    record = records[day]
+    record["values"][:] = 0
+    record["values"][slot] = values
+    record["present"][:] = np.packbits(present)
+    record["complete"] = complete
+    records.flush()
+
+  def store(self, user_id: str, resource: str, detail_level: str, date: str, res: dict, complete: bool = None,
+      synced: str = None) -> None:
+    """
+    Writes a single day response of activity_intraday or heart_rate_intraday
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The intraday resource, e.g. steps, calories or heart
+      detail_level: The detail level the response was requested with
+      date: The day of the response in the format yyyy-MM-dd
+      res: The parsed response
+      complete: (optional) Whether the day is fully synced. By default a day is complete if the user's
+        trackers synced on a later day, so that a day fetched before its last sync is fetched again.
+        Fitbit leaves out the minutes without a reading, so the data itself cannot tell.
+      synced: (optional) The time the user's trackers last synced in the format yyyy-MM-ddTHH:mm:ss,
+        e.g. last_sync(api.devices()). Without it a day is only complete if complete is given.
+    """
+    dataset = intraday_dataset(res)
+    seconds = seconds_of_day([point["time"] for point in dataset])
+    values = np.fromiter((point["value"] for point in dataset), np.float32, len(dataset))
+    if complete is None:
+      complete = synced is not None and date < synced[:10]
+    self.put(user_id, resource, detail_level, date, seconds, values, complete)
+
+  def __range(self, user_id: str, resource: str, detail_level: str, start: str, end: str):
+    records = self.__open(user_id, resource, detail_level)
+    first, last = _day(start), _day(end) + 1
+    if records is None or last > len(records):
+      records = self.__open(user_id, resource, detail_level, last)
+    return records[first:last]
+
+  def values(self, user_id: str, resource: str, detail_level: str, start: str, end: str) -> np.ndarray:
+    """
+    Returns a (days, slots) view of the values from start to end inclusive, backed directly by the
+    cache file. Slots without data hold 0; see present().
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The intraday resource
+      detail_level: 1sec, 1min, 5min or 15min
+      start: The first day in the format yyyy-MM-dd
+      end: The last day in the format yyyy-MM-dd
+    """
+    return self.__range(user_id, resource, detail_level, start, end)["values"]
+
+  def present(self, user_id: str, resource: str, detail_level: str, start: str, end: str) -> np.ndarray:
+    """Returns a (days, slots) boolean array of the slots that hold a value from start to end inclusive"""
+    return np.unpackbits(self.__range(user_id, resource, detail_level, start, end)["present"], axis=1).astype(bool)
+
+  def complete(self, user_id: str, resource: str, detail_level: str, start: str, end: str) -> np.ndarray:
+    """Returns a boolean array telling which days from start to end inclusive are complete"""
+    first, last = _day(start), _day(end) + 1
+    complete = np.zeros(last - first, bool)
+    records = self.__open(user_id, resource, detail_level)
+    if records is not None and first < len(records):
+      stored = records[first:last]["complete"]
+      complete[:len(stored)] = stored
+    return complete
+
+  def missing_days(self, user_id: str, resource: str, detail_level: str, start: str, end: str) -> list:
+    """
+    Returns the days from start to end inclusive that are not complete and still need fetching
+
+    Parameters:
+      user_id: The encoded ID of the user
+      resource: The intraday resource
+      detail_level: 1sec, 1min, 5min or 15min
+      start: The first day in the format yyyy-MM-dd
+      end: The last day in the format yyyy-MM-dd
+    """
+    first = _day(start)
+    return [_date(first + day) for day in np.flatnonzero(~self.complete(user_id, resource, detail_level, start, end))]
+
+  def close(self) -> None:
+    """Flushes and releases every memory map"""
+    with self.__lock:
+      for records in self.__maps.values():
+        records.flush()
+      self.__maps.clear()
@@ -0,0 +1,179 @@
+"""
+Multi-user load test against the local stub server
+
+Simulates virtual users, each with its own tokens and hourly rate-limit budget on a StubServer
+running in a separate process, so that the CPU and memory reported are those of the client only.
+Every virtual user runs on its own thread with its own fitbit.API instance and repeatedly runs one
+of the scenarios below, chosen at random by weight, for one day further back each time. A user whose
+budget is used up waits for the rate limit window to reset, as a client of Fitbit has to, and then
+retries. For every number of users the test reports throughput, latency percentiles, rate-limited
+requests, CPU and memory, and the user-days a client can sync per hour: the measured rate, but at
+most what the hourly budgets of all users allow.
+
+  python load_test.py --users 10,50,100 --duration 20 --latency 0.05
+"""
+import sys, time, random, argparse, resource, threading, multiprocessing, datetime
+import numpy as np
+import fitbit, stub_server
+
+SCENARIOS = {
+  "backfill": [
+    ("heart_rate_intraday", lambda date: (date, "1d", "1min")),
+    ("activity_intraday", lambda date: ("steps", date, "1d", "1min")),
+  ],
+  "summary": [
+    ("activity_summary", lambda date: (date,)),
+    ("sleep_log", lambda date: (date,)),
+    ("food_logs", lambda date: (date,)),
+    ("water_logs", lambda date: (date,)),
+  ],
+  "write": [
+    ("log_water", lambda date: (date, 8)),
+    ("log_body", lambda date: ("weight", 70.5, date, "08:00")),
+  ],
+}
+
+WEIGHTS = {"backfill": 1, "summary": 3, "write": 1}
+
+# The requests of syncing one user-day: one run of every scenario
+REQUESTS_PER_DAY = sum(len(calls) for calls in SCENARIOS.values())
+
+def _serve(connection, latency: float, rate_limit: int) -> None:
+  with stub_server.StubServer(latency=latency, rate_limit=rate_limit) as stub:
+    connection.send(stub.url)
+    while True:
+      count = connection.recv()
+      if count is None:
+        return
+      connection.send([tuple(stub.issue()) for _ in range(count)])
+
+class _Recorder:
+  """A transport that records the latency and status of every request a virtual user sends"""
+
+  def __init__(self, transport):
+    self.transport = transport
+    self.latencies = []
+    self.statuses = []
+
+  def __call__(self, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    res = self.transport(method, url, **kwargs)
+    self.latencies.append(time.perf_counter() - started)
+    self.statuses.append(res.status_code)
+    return res
+
+def _virtual_user(api: fitbit.API, recorder: _Recorder, deadline: float, seed: int, counts: dict) -> None:
+  rng = random.Random(seed)
+  date = datetime.date(2021, 9, 8)
+  names, weights = list(WEIGHTS), list(WEIGHTS.values())
+  backoff = 1.0
+  while time.time() < deadline:
+    scenario = rng.choices(names, weights)[0]
+    for method, arguments in SCENARIOS[scenario]:
+      while True:
+        getattr(api, method)(*arguments(date.isoformat()))
+        if recorder.statuses[-1] != 429:
+          backoff = 1.0
+          break
+        # The user's budget for this hour is used up: wait for its reset, or back off exponentially
+        # without a Fitbit-Rate-Limit-Reset header, and retry the same request
+        now = time.time()
+        resume = api.rate_limit["reset"] if api.rate_limit is not None else now + backoff
+        backoff = min(backoff * 2, 60.0)
+        if resume >= deadline:
+          time.sleep(max(0.0, deadline - now))
+          return
+        time.sleep(max(0.0, resume - now))
+    counts[scenario] = counts.get(scenario, 0) + 1
+    date -= datetime.timedelta(days=1)
+
+def _rss() -> int:
+  try:
+    with open("/proc/self/statm") as file:
+      return int(file.read().split()[1]) * resource.getpagesize()
+  except OSError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run(users: int, duration: float, tokens: list, url: str, seed: int = 0, rate_limit: int = 150) -> dict:
+  """
+  Runs one step of the load test and returns its metrics
+
+  Parameters:
+    users: The number of virtual users
+    duration: Seconds the virtual users keep sending requests
+    tokens: A Tokens tuple per virtual user, issued by the stub server
+    url: The url of the stub server
+    seed: (optional) Seeds the scenario choices of the virtual users
+    rate_limit: (optional) Requests per user and hour the stub server allows, which caps the user-days per hour
+  """
+  recorders, counts, threads = [], [], []
+  deadline = time.time() + duration
+  for index, user_tokens in enumerate(tokens[:users]):
+    recorder = _Recorder(stub_server.redirect(url, pool_size=1))
+    api = fitbit.API(transport=recorder, user_id=user_tokens[0], access_token=user_tokens[1], refresh_token=user_tokens[2])
+    recorders.append(recorder)
+    counts.append({})
+    threads.append(threading.Thread(target=_virtual_user, args=(api, recorder, deadline, seed + index, counts[-1]), daemon=True))
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - started
+  after = resource.getrusage(resource.RUSAGE_SELF)
+  latencies = np.concatenate([np.asarray(recorder.latencies) for recorder in recorders]) if recorders else np.empty(0)
+  statuses = np.concatenate([np.asarray(recorder.statuses, np.int32) for recorder in recorders]) if recorders else np.empty(0, np.int32)
+  ok = int(np.count_nonzero(statuses < 400))
+  # A burst of a few seconds extrapolates to far more than the hourly budgets of the users allow
+  user_days_per_hour = min(ok / elapsed * 3600, users * rate_limit) / REQUESTS_PER_DAY
+  percentiles = np.percentile(latencies, [50, 90, 99]) * 1000 if len(latencies) else [float("nan")] * 3
+  scenarios = {}
+  for user_counts in counts:
+    for scenario, count in user_counts.items():
+      scenarios[scenario] = scenarios.get(scenario, 0) + count
+  return {
+    "users": users, "seconds": elapsed, "requests": len(statuses), "ok": ok,
+    "rate_limited": int(np.count_nonzero(statuses == 429)), "errors": int(np.count_nonzero(statuses >= 400)) - int(np.count_nonzero(statuses == 429)),
+    "requests_per_second": ok / elapsed, "user_days_per_hour": user_days_per_hour,
+    "p50_ms": percentiles[0], "p90_ms": percentiles[1], "p99_ms": percentiles[2],
+    "max_ms": float(latencies.max()) * 1000 if len(latencies) else float("nan"),
+    "cpu_percent": 100 * (after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime) / elapsed,
+    "rss_mib": _rss() / 2**20, "scenarios": scenarios,
+  }
+
+# The key, header, width and decimals of every column of the report
+COLUMNS = [("users", "users", 6, 0), ("requests", "requests", 9, 0), ("rate_limited", "429s", 7, 0), ("errors", "errors", 6, 0),
+  ("requests_per_second", "req/s", 8, 1), ("user_days_per_hour", "user-days/h", 11, 0), ("p50_ms", "p50 ms", 8, 1),
+  ("p90_ms", "p90 ms", 8, 1), ("p99_ms", "p99 ms", 8, 1), ("max_ms", "max ms", 8, 1), ("cpu_percent", "cpu %", 6, 0),
+  ("rss_mib", "rss MiB", 8, 1)]
+
+def main(argv: list = None) -> list:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--users", default="1,10,50,100", help="comma separated numbers of virtual users, one step each")
+  parser.add_argument("--duration", type=float, default=10.0, help="seconds every step runs")
+  parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub server delays every response")
+  parser.add_argument("--rate-limit", type=int, default=150, help="requests per user and hour before 429 responses")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args(argv)
+  steps = [int(users) for users in args.users.split(",")]
+  parent, child = multiprocessing.Pipe()
+  server = multiprocessing.Process(target=_serve, args=(child, args.latency, args.rate_limit), daemon=True)
+  server.start()
+  url = parent.recv()
+  print(" ".join(f"{header:>{width}}" for _, header, width, _ in COLUMNS))
+  results = []
+  try:
+    for users in steps:
+      # Fresh users every step, so that no step starts with budgets used up by the previous one
+      parent.send(users)
+      result = run(users, args.duration, parent.recv(), url, args.seed, args.rate_limit)
+      results.append(result)
+      print(" ".join(f"{result[key]:>{width}.{decimals}f}" for key, _, width, decimals in COLUMNS), flush=True)
+  finally:
+    parent.send(None)
+    server.join()
+  return results
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,198 @@
+"""
+Budget-aware fetch planner
+
+Given the resources to sync, a date range, the detail needed and what is already cached, plan()
+picks the endpoint of every resource (a time series for daily values, an intraday call per day for
+finer detail, sleep_logs_range for sleep) and covers the missing days with the fewest calls the
+range limits of ENDPOINTS allow. Calls are ordered by value, the number of missing days they fill
+weighted by resource, most recent first, and the ones beyond the remaining rate budget are deferred
+to the next hour. A plan can be printed as a dry run, so capacity planning needs no live calls:
+
+  python planner.py --resources steps,heart,sleep,weight --start 2021-01-01 --end 2021-09-08 --detail 1min
+"""
+import sys, time, argparse, datetime
+from collections import namedtuple
+import endpoints
+from intraday_cache import SLOTS
+
+Call = namedtuple("Call", ["method", "args", "resource", "dates", "value"])
+Call.__doc__ = "A planned request: the fitbit.API method, its arguments, and the missing dates it fills"
+
+HEART, SLEEP = "heart", "sleep"
+BODY_RESOURCES = ("bmi", "fat", "weight")
+
+def _days(start: str, end: str) -> list:
+  first, last = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+  return [(first + datetime.timedelta(days=day)).isoformat() for day in range((last - first).days + 1)]
+
+def strategy(resource: str, detail: str) -> tuple:
+  """
+  Returns the endpoint name and a function building its arguments from (first date, last date)
+  that fetches a resource at a detail
+
+  Parameters:
+    resource: An activity resource, e.g. steps, or heart, sleep, bmi, fat or weight
+    detail: day for daily values, or an intraday detail level, e.g. 1min. Sleep has no detail
+      levels and body resources are fetched as individual logs for any detail finer than day.
+  """
+  if resource == SLEEP:
+    return "sleep_logs_range", lambda first, last: (first, last)
+  if resource in BODY_RESOURCES:
+    if detail == "day" or resource == "bmi":
+      return "body_time_series", lambda first, last: (resource, first, last)
+    return "body_logs", lambda first, last: (resource, first, last)
+  if resource == HEART:
+    if detail == "day":
+      return "heart_rate_time_series", lambda first, last: (first, last)
+    return "heart_rate_intraday", lambda first, last: (first, "1d", detail)
+  if resource not in endpoints.ACTIVITY_RESOURCES:
+    raise ValueError(f"Unknown resource {resource!r}")
+  if detail == "day":
+    return "activity_time_series", lambda first, last: (resource, first, last)
+  if resource not in endpoints.INTRADAY_RESOURCES:
+    raise ValueError(f"{resource} has no intraday data, only detail day")
+  return "activity_intraday", lambda first, last: (resource, first, "1d", detail)
+
+def cover(missing: list, max_days: int) -> list:
+  """
+  Returns [first, last, missing dates] windows that cover every missing date with the fewest windows
+  of at most max_days, each starting at a missing date. Cached dates inside a window are fetched
+  again at no extra request.
+
+  Parameters:
+    missing: Sorted dates in the format yyyy-MM-dd
+    max_days: The most days a window may span, None for no limit
+  """
+  windows = []
+  for date in missing:
+    if windows and (max_days is None or (datetime.date.fromisoformat(date) - datetime.date.fromisoformat(windows[-1][0])).days < max_days):
+      windows[-1][1] = date
+      windows[-1][2].append(date)
+    else:
+      windows.append([date, date, [date]])
+  return windows
+
+class Plan:
+
+  def __init__(self, calls: list, deferred: list, budget: int = None):
+    """
+    Parameters:
+      calls: The calls that fit the budget, in the order they run
+      deferred: The calls beyond the budget, in the order they would run
+      budget: (optional) The budget the plan was made for
+    """
+    self.calls = calls
+    self.deferred = deferred
+    self.budget = budget
+
+  @property
+  def requests(self) -> int:
+    """The number of requests the plan sends now"""
+    return len(self.calls)
+
+  @property
+  def total_requests(self) -> int:
+    """The number of requests needed to fetch everything, including deferred calls"""
+    return len(self.calls) + len(self.deferred)
+
+  def hours(self, limit: int = 150) -> int:
+    """Returns the hours of a user's rate limit needed to run every call"""
+    return -(-self.total_requests // limit)
+
+  def __str__(self) -> str:
+    lines = []
+    for label, calls in (("run", self.calls), ("deferred", self.deferred)):
+      for call in calls:
+        arguments = ", ".join(repr(argument) for argument in call.args)
+        lines.append(f"{label:<9}{call.method}({arguments})  {len(call.dates)} missing days, value {call.value:g}")
+    budget = "" if self.budget is None else f" of a budget of {self.budget}"
+    lines.append(f"{self.requests} requests{budget}, {len(self.deferred)} deferred, {self.hours()} hours at 150 requests per hour")
+    return "\n".join(lines)
+
+def plan(resources: list, start: str, end: str, detail="day", cached=None, budget: int = None, weights: dict = None) -> Plan:
+  """
+  Plans the fewest calls that fetch every missing day of the resources and orders them by value
+
+  Parameters:
+    resources: The resources to sync, see strategy()
+    start: The first date in the format yyyy-MM-dd
+    end: The last date in the format yyyy-MM-dd
+    detail: (optional) day or an intraday detail level, or a dict of them by resource
+    cached: (optional) A function (resource, detail, date) returning whether a date is already cached,
+      see intraday_cached(). By default nothing is cached.
+    budget: (optional) The requests that may be sent now, e.g. remaining_budget(api). Calls beyond it
+      are deferred. By default every call runs.
+    weights: (optional) The value of a missing day of each resource, 1 by default
+  """
+  weights = weights or {}
+  dates = _days(start, end)
+  calls = []
+  for resource in resources:
+    level = detail.get(resource, "day") if isinstance(detail, dict) else detail
+    method, arguments = strategy(resource, level)
+    missing = [date for date in dates if not (cached and cached(resource, level, date))]
+    for first, last, filled in cover(missing, endpoints.ENDPOINTS[method].max_days):
+      calls.append(Call(method, arguments(first, last), resource, tuple(filled), len(filled) * weights.get(resource, 1)))
+  # Most value first, and the most recent days first among calls of equal value
+  calls.sort(key=lambda call: call.dates[-1], reverse=True)
+  calls.sort(key=lambda call: call.value, reverse=True)
+  if budget is None:
+    return Plan(calls, [])
+  budget = max(0, budget)
+  return Plan(calls[:budget], calls[budget:], budget)
+
+def intraday_cached(cache, user_id: str):
+  """
+  Returns a cached function for plan() backed by the complete days of an IntradayCache. Daily
+  values are not stored in it and always count as missing.
+
+  Parameters:
+    cache: An intraday_cache.IntradayCache
+    user_id: The encoded ID of the user
+  """
+  def cached(resource: str, detail: str, date: str) -> bool:
+    if detail not in SLOTS:
+      return False
+    return bool(cache.complete(user_id, resource, detail, date, date)[0])
+  return cached
+
+def remaining_budget(api) -> int:
+  """Returns the requests the rate limit of an API instance still allows this hour, or None if unknown"""
+  if api.rate_limit is None:
+    return None
+  if time.time() >= api.rate_limit["reset"]:
+    return api.rate_limit["limit"]
+  return api.rate_limit["remaining"]
+
+def execute(api, plan: Plan, on_result=None) -> list:
+  """
+  Runs the calls of a plan in order and returns (call, result) pairs
+
+  Parameters:
+    api: The fitbit.API instance of the user
+    plan: The plan to run; its deferred calls are not sent
+    on_result: (optional) Called with every call and its result as it arrives, e.g. to store it in a cache
+  """
+  results = []
+  for call in plan.calls:
+    res = getattr(api, call.method)(*call.args)
+    res = res.json() if api.debug else res
+    if on_result is not None:
+      on_result(call, res)
+    results.append((call, res))
+  return results
+
+def main(argv: list = None) -> Plan:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--resources", default="steps,heart,sleep,weight", help="comma separated resources")
+  parser.add_argument("--start", required=True, help="the first date in the format yyyy-MM-dd")
+  parser.add_argument("--end", default=datetime.date.today().isoformat(), help="the last date in the format yyyy-MM-dd")
+  parser.add_argument("--detail", default="day", help="day or an intraday detail level, e.g. 1min")
+  parser.add_argument("--budget", type=int, help="requests that may be sent now")
+  args = parser.parse_args(argv)
+  result = plan(args.resources.split(","), args.start, args.end, args.detail, budget=args.budget)
+  print(result)
+  return result
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""
+Priority classes sharing one rate-limit budget
+
+BudgetGate is a transport for fitbit.API that makes every request wait for a slot according to its
+priority class. Interactive requests may use the whole hourly budget of the user; normal and
+background requests leave a reserved fraction of it untouched, so that a running backfill can never
+use up the budget of the requests a user is waiting for. Waiting requests are started highest
+priority first, so background work queued behind the concurrency limit is preempted by interactive
+calls, and background requests that find the budget down to the reserve are deferred until the
+budget resets. The budget is taken from the Fitbit-Rate-Limit-* headers of the responses.
+
+  gate = BudgetGate()
+  api = fitbit.API(transport=gate, ...)
+  with priority.background():
+    api.activity_intraday("steps", "2021-09-08", "1d", "1min")
+  api.activity_summary("today")  # interactive by default, served first
+"""
+import time, heapq, itertools, threading, contextvars
+from contextlib import contextmanager
+import requests
+
+INTERACTIVE, NORMAL, BACKGROUND = 0, 1, 2
+NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+
+# The fraction of the hourly limit each class leaves for the classes above it
+RESERVES = {INTERACTIVE: 0.0, NORMAL: 0.1, BACKGROUND: 0.2}
+
+_priority = contextvars.ContextVar("fitbit_priority", default=INTERACTIVE)
+
+class Deferred(Exception):
+  """Raised when a request could not get a slot of the budget within its max_wait"""
+
+@contextmanager
+def priority(level: int):
+  """
+  Sends the requests made in the block, on this thread or context, with the given priority class
+
+  Parameters:
+    level: INTERACTIVE, NORMAL or BACKGROUND
+  """
+  token = _priority.set(level)
+  try:
+    yield
+  finally:
+    _priority.reset(token)
+
+def interactive():
+  """Same as priority(INTERACTIVE)"""
+  return priority(INTERACTIVE)
+
+def background():
+  """Same as priority(BACKGROUND)"""
+  return priority(BACKGROUND)
+
+class BudgetGate:
+
+  def __init__(self, transport=None, *, limit: int = 150, reserves: dict = None, max_concurrency: int = 4,
+      max_wait: dict = None):
+    """
+    Parameters:
+      transport: (optional) The transport requests are sent with, requests.request by default
+      limit: (optional) The hourly limit assumed until a response reports it
+      reserves: (optional) The fraction of the limit each class leaves unused, RESERVES by default
+      max_concurrency: (optional) Requests in flight at once; waiting requests are started by priority
+      max_wait: (optional) Seconds each class waits for a slot before Deferred is raised, by default
+        forever for every class
+    """
+    self.transport = transport or requests.request
+    self.limit = limit
+    self.reserves = dict(RESERVES, **(reserves or {}))
+    self.max_concurrency = max_concurrency
+    self.max_wait = max_wait or {}
+    self.remaining = limit
+    self.reset = None
+    self.in_flight = 0
+    self.sent = {level: 0 for level in NAMES}
+    self.deferred = {level: 0 for level in NAMES}
+    self.__waiting = []
+    self.__order = itertools.count()
+    self.__condition = threading.Condition()
+
+  def __refill(self, now: float) -> None:
+    if self.reset is not None and now >= self.reset:
+      self.remaining = self.limit
+      self.reset = None
+
+  def __allowed(self, level: int) -> bool:
+    """Whether a request of the class may start now, given the budget and the requests in flight"""
+    if self.in_flight >= self.max_concurrency:
+      return False
+    return self.remaining - self.in_flight > self.reserves.get(level, 0.0) * self.limit
+
+  def __wait_time(self, now: float) -> float:
+    # Without a reported reset, budget only returns when a request in flight reports it
+    return None if self.reset is None else max(0.0, self.reset - now)
+
+  def acquire(self, level: int = None) -> None:
+    """
+    Waits until a request of a class may be sent and counts it as in flight
+
+    Parameters:
+      level: (optional) The priority class, by default the one of the current context
+    """
+    level = _priority.get() if level is None else level
+    max_wait = self.max_wait.get(level)
+    deadline = None if max_wait is None else time.time() + max_wait
+    with self.__condition:
+      entry = (level, next(self.__order))
+      heapq.heappush(self.__waiting, entry)
+      try:
+        while True:
+          now = time.time()
+          self.__refill(now)
+          if self.__waiting[0] == entry and self.__allowed(level):
+            break
+          if deadline is not None and now >= deadline:
+            self.deferred[level] += 1
+            raise Deferred(f"No {NAMES.get(level, level)} budget within {max_wait}s, {self.remaining} of {self.limit} requests left")
+          timeouts = [timeout for timeout in (self.__wait_time(now), None if deadline is None else deadline - now) if timeout is not None]
+          self.__condition.wait(min(timeouts) if timeouts else None)
+      finally:
+        self.__waiting.remove(entry)
+        heapq.heapify(self.__waiting)
+        # The next waiter may be of a class that can start although this one could not
+        self.__condition.notify_all()
+      self.in_flight += 1
+      self.sent[level] += 1
+
+  def release(self, res: requests.Response = None) -> None:
+    """Counts a request as finished and updates the budget from its response headers"""
+    with self.__condition:
+      self.in_flight -= 1
+      if res is not None and "Fitbit-Rate-Limit-Remaining" in res.headers:
+        self.limit = int(res.headers.get("Fitbit-Rate-Limit-Limit", self.limit))
+        self.remaining = int(res.headers["Fitbit-Rate-Limit-Remaining"])
+        self.reset = time.time() + int(res.headers.get("Fitbit-Rate-Limit-Reset", 0))
+      elif res is not None and res.status_code == 429:
+        self.remaining = 0
+      elif res is not None:
+        self.remaining -= 1
+      self.__condition.notify_all()
+
+  def __call__(self, method: str, url: str, **kwargs) -> requests.Response:
+    # Token requests do not count against the rate limit
+    if "/oauth2/" in url:
+      return self.transport(method, url, **kwargs)
+    self.acquire()
+    res = None
+    try:
+      res = self.transport(method, url, **kwargs)
+      return res
+    finally:
+      self.release(res)
@@ -0,0 +1,265 @@
+"""
+Local query engine over synced data
+
+Answers questions such as "average steps on weekdays in Q2 for cohort X" from the data already
+synced instead of with new API calls. ingest() extracts the daily values of a response (time
+series, the daily summaries of intraday responses, sleep and body logs) into a daily table indexed
+by (user, resource, date), and index() does the same for every payload of a HistoryStore. Queries
+load the rows of a resource once into sorted numpy columns, then filter by users, dates and
+weekdays with boolean masks and aggregate per group with bincount and ufunc.at, so a cohort query
+over years of days takes milliseconds:
+
+  engine.query("steps", "2021-04-01", "2021-06-30", cohort="X", weekdays=range(5), aggregate="mean")
+  engine.query("minutesAsleep", "2021-01-01", "2021-12-31", by=("user", "month"))
+"""
+import sqlite3, threading
+from collections import namedtuple
+import numpy as np
+
+AGGREGATES = ("mean", "sum", "min", "max", "count", "median")
+GROUPS = ("user", "date", "weekday", "month", "quarter", "year")
+
+# The prefixes of time series keys in responses, e.g. activities-steps or activities-tracker-steps
+SERIES_PREFIXES = ("activities-tracker-", "activities-", "body-", "foods-log-")
+
+# The fields of sleep logs indexed per dateOfSleep, summed over the logs of a night unless main sleep only
+SLEEP_FIELDS = {"minutesAsleep": False, "minutesAwake": False, "timeInBed": False, "efficiency": True}
+
+Columns = namedtuple("Columns", ["users", "user", "day", "value"])
+Columns.__doc__ = "The rows of one resource: user IDs, and user index, days since 1970-01-01 and value per row"
+
+def _number(value) -> float:
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+def daily_values(res: dict) -> list:
+  """
+  Returns the (resource, date, value) daily values in a parsed response
+
+  Parameters:
+    res: A response of a time series, intraday, sleep or body log endpoint
+  """
+  values = []
+  for key, entries in res.items():
+    if key == "sleep" and isinstance(entries, list):
+      nights = {}
+      for log in entries:
+        night = nights.setdefault(log["dateOfSleep"], {})
+        for field, main_only in SLEEP_FIELDS.items():
+          if field in log and (not main_only or log.get("isMainSleep", True)):
+            night[field] = night.get(field, 0) + log[field] if not main_only else log[field]
+      values.extend((field, date, value) for date, night in nights.items() for field, value in night.items())
+    elif key in ("weight", "fat") and isinstance(entries, list):
+      for log in entries:
+        values.extend((field, log["date"], log[field]) for field in ("weight", "bmi", "fat") if field in log)
+    elif isinstance(entries, list) and not key.endswith("-intraday"):
+      resource = next((key[len(prefix):] for prefix in SERIES_PREFIXES if key.startswith(prefix)), None)
+      for entry in entries:
+        if resource is None or not isinstance(entry, dict) or "dateTime" not in entry:
+          break
+        if resource == "heart":
+          if isinstance(entry.get("value"), dict) and "restingHeartRate" in entry["value"]:
+            values.append(("restingHeartRate", entry["dateTime"], entry["value"]["restingHeartRate"]))
+        else:
+          values.append((resource, entry["dateTime"], entry["value"]))
+  return [(resource, date, number) for resource, date, value in values for number in [_number(value)] if number is not None]
+
+class QueryEngine:
+
+  def __init__(self, path: str):
+    """
+    Parameters:
+      path: The SQLite database file, which may be the file of a HistoryStore
+    """
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS daily (user_id TEXT NOT NULL, resource TEXT NOT NULL, date TEXT NOT NULL, value REAL NOT NULL,
+        PRIMARY KEY (user_id, resource, date)) WITHOUT ROWID;
+      CREATE INDEX IF NOT EXISTS daily_resource ON daily (resource, user_id, date);
+      CREATE TABLE IF NOT EXISTS cohorts (cohort TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (cohort, user_id)) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS indexed (source TEXT PRIMARY KEY, stored REAL NOT NULL);
+      CREATE TABLE IF NOT EXISTS versions (resource TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID;
+    """)
+    # Every write to a resource's rows, by any connection, bumps its version, which tells columns()
+    # whether the columns it loaded are still current. The INSERT OR REPLACE of ingest() would override
+    # an OR IGNORE here, so a missing version is inserted with a WHERE NOT EXISTS instead.
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+      self.db.execute(f"""CREATE TRIGGER IF NOT EXISTS daily_{event.lower()} AFTER {event} ON daily BEGIN
+        INSERT INTO versions SELECT {row}.resource, 0 WHERE NOT EXISTS (SELECT 1 FROM versions WHERE resource = {row}.resource);
+        UPDATE versions SET version = version + 1 WHERE resource = {row}.resource;
+      END""")
+    self.__columns = {}
+    self.__lock = threading.RLock()
+
+  def ingest(self, user_id: str, res: dict) -> int:
+    """
+    Stores the daily values of a response, replacing earlier values of the same days, and returns how many
+
+    Parameters:
+      user_id: The encoded ID of the user
+      res: A parsed response, see daily_values()
+    """
+    rows = [(user_id, resource, date, value) for resource, date, value in daily_values(res)]
+    with self.__lock:
+      self.db.execute("BEGIN")
+      self.db.executemany("INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?)", rows)
+      self.db.execute("COMMIT")
+    return len(rows)
+
+  def index(self, store) -> int:
+    """
+    Ingests the JSON payloads a HistoryStore received since the last call and returns the daily values stored
+
+    Parameters:
+      store: A history_store.HistoryStore
+    """
+    with self.__lock:
+      row = self.db.execute("SELECT stored FROM indexed WHERE source = 'history'").fetchone()
+      count, last = 0, row[0] if row else None
+      for user_id, resource, date, stored in store.entries(last):
+        data = store.get(user_id, resource, date)
+        if isinstance(data, dict):
+          count += self.ingest(user_id, data)
+        last = stored
+      if last is not None:
+        self.db.execute("INSERT OR REPLACE INTO indexed VALUES ('history', ?)", (last,))
+    return count
+
+  def add_cohort(self, cohort: str, users: list) -> None:
+    """Adds users to a named cohort"""
+    with self.__lock:
+      self.db.executemany("INSERT OR IGNORE INTO cohorts VALUES (?, ?)", [(cohort, user_id) for user_id in users])
+
+  def cohort(self, cohort: str) -> list:
+    """Returns the users of a cohort"""
+    with self.__lock:
+      return [row[0] for row in self.db.execute("SELECT user_id FROM cohorts WHERE cohort = ? ORDER BY user_id", (cohort,))]
+
+  def resources(self) -> list:
+    """Returns the resources that have daily values"""
+    with self.__lock:
+      return [row[0] for row in self.db.execute("SELECT DISTINCT resource FROM daily ORDER BY resource")]
+
+  def columns(self, resource: str) -> Columns:
+    """
+    Returns the rows of a resource as numpy columns sorted by user and date, loaded once until the
+    resource changes, also through another connection
+    """
+    with self.__lock:
+      self.db.execute("BEGIN")
+      try:
+        # The version and the rows are read in one transaction, so the columns never pair new rows with an old version
+        version = self.db.execute("SELECT version FROM versions WHERE resource = ?", (resource,)).fetchone()
+        version = version[0] if version else 0
+        cached = self.__columns.get(resource)
+        if cached is not None and cached[0] == version:
+          return cached[1]
+        rows = self.db.execute("SELECT user_id, date, value FROM daily WHERE resource = ? ORDER BY user_id, date", (resource,)).fetchall()
+      finally:
+        self.db.execute("COMMIT")
+      users, user = np.unique(np.array([row[0] for row in rows], dtype=object).astype(str), return_inverse=True) if rows else (np.empty(0, str), np.empty(0, np.int64))
+      day = np.array([row[1] for row in rows], dtype="datetime64[D]").astype(np.int32)
+      value = np.fromiter((row[2] for row in rows), np.float64, len(rows))
+      columns = Columns(users.tolist(), user.astype(np.int32), day, value)
+      self.__columns[resource] = (version, columns)
+      return columns
+
+  def query(self, resource: str, start: str = None, end: str = None, *, users: list = None, cohort: str = None, weekdays=None,
+      by=None, aggregate: str = "mean"):
+    """
+    Aggregates the daily values of a resource. Returns one number without by, else a dict with a key
+    per group: a user ID, a date, a weekday (0 is Monday), a month (yyyy-MM), a quarter (yyyy-Qn) or a
+    year, or a tuple of them when by is a tuple.
+
+    Parameters:
+      resource: The resource, e.g. steps, restingHeartRate, minutesAsleep or weight
+      start: (optional) The first date in the format yyyy-MM-dd
+      end: (optional) The last date in the format yyyy-MM-dd
+      users: (optional) The users to include, by default all
+      cohort: (optional) The cohort whose users to include; with users, only the users in both are included
+      weekdays: (optional) The weekdays to include, 0 is Monday
+      by: (optional) One of GROUPS or a tuple of them
+      aggregate: (optional) One of AGGREGATES
+    """
+    if aggregate not in AGGREGATES:
+      raise ValueError(f"aggregate must be one of {', '.join(AGGREGATES)}, not {aggregate!r}")
+    groups = (by,) if isinstance(by, str) else tuple(by or ())
+    for group in groups:
+      if group not in GROUPS:
+        raise ValueError(f"by must be one of {', '.join(GROUPS)} or a tuple of them, not {group!r}")
+    columns = self.columns(resource)
+    mask = np.ones(len(columns.value), bool)
+    if start is not None:
+      mask &= columns.day >= np.datetime64(start, "D").astype(np.int32)
+    if end is not None:
+      mask &= columns.day <= np.datetime64(end, "D").astype(np.int32)
+    if users is not None or cohort is not None:
+      selected = set(users) if users is not None else None
+      if cohort is not None:
+        selected = set(self.cohort(cohort)) if selected is None else selected & set(self.cohort(cohort))
+      mask &= np.isin(columns.user, [code for code, user_id in enumerate(columns.users) if user_id in selected])
+    # 1970-01-01 was a Thursday
+    weekday = (columns.day + 3) % 7
+    if weekdays is not None:
+      mask &= np.isin(weekday, list(weekdays))
+    values = columns.value[mask]
+    if not groups:
+      return self.__aggregate(values, np.zeros(len(values), np.int64), 1, aggregate)[0] if len(values) else None
+    day = columns.day[mask]
+    keys = [self.__group(group, columns.user[mask], day, weekday[mask]) for group in groups]
+    # One integer per combination of group codes, labelled only once per group in the result
+    codes = [np.unique(key, return_inverse=True) for key, _ in keys]
+    combined = np.zeros(len(values), np.int64)
+    for uniques, inverse in codes:
+      combined = combined * len(uniques) + inverse
+    present, inverse = np.unique(combined, return_inverse=True)
+    results = self.__aggregate(values, inverse, len(present), aggregate)
+    labels = [[label(code, columns) for code in uniques.tolist()] for (uniques, _), (_, label) in zip(codes, keys)]
+    output = {}
+    for index, code in enumerate(present.tolist()):
+      parts = []
+      for part_labels in reversed(labels):
+        code, part = divmod(code, len(part_labels))
+        parts.append(part_labels[part])
+      key = tuple(reversed(parts))
+      output[key if len(key) > 1 else key[0]] = results[index]
+    return output
+
+  @staticmethod
+  def __group(group: str, user: np.ndarray, day: np.ndarray, weekday: np.ndarray) -> tuple:
+    """Returns the integer code of every row in a group and a function labelling a code"""
+    if group == "user":
+      return user, lambda code, columns: columns.users[code]
+    if group == "date":
+      return day, lambda code, columns: str(np.datetime64(code, "D"))
+    if group == "weekday":
+      return weekday, lambda code, columns: code
+    months = day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    if group == "month":
+      return months, lambda code, columns: str(np.datetime64(code, "M"))
+    if group == "year":
+      return months // 12 + 1970, lambda code, columns: code
+    return months // 3, lambda code, columns: f"{code // 4 + 1970}-Q{code % 4 + 1}"
+
+  @staticmethod
+  def __aggregate(values: np.ndarray, groups: np.ndarray, count: int, aggregate: str) -> list:
+    if aggregate == "count":
+      return np.bincount(groups, minlength=count).tolist()
+    if aggregate in ("sum", "mean"):
+      sums = np.bincount(groups, values, minlength=count)
+      return (sums if aggregate == "sum" else sums / np.bincount(groups, minlength=count)).tolist()
+    if aggregate in ("min", "max"):
+      result = np.full(count, np.inf if aggregate == "min" else -np.inf)
+      (np.minimum if aggregate == "min" else np.maximum).at(result, groups, values)
+      return result.tolist()
+    # Sorted by group and value, the median of a group is the middle one or two of its values
+    order = np.lexsort((values, groups))
+    values, first = values[order], np.searchsorted(groups[order], np.arange(count))
+    sizes = np.bincount(groups, minlength=count)
+    return ((values[first + (sizes - 1) // 2] + values[first + sizes // 2]) / 2).tolist()
+
+  def close(self) -> None:
+    self.db.close()
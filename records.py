@@ -0,0 +1,252 @@
+"""
+Typed records for log entries
+
+The log endpoints of fitbit.API return plain dicts. The classes in this module are an opt-in
+alternative for holding many log entries in memory: each record uses __slots__, is built
+directly from the parsed JSON of a response, and interns repeated short strings (sleep levels,
+log sources, units) so that a large history costs a fraction of the equivalent dicts.
+"""
+import sys
+from typing import Union
+
+def _intern(value: Union[str, None]) -> Union[str, None]:
+  return sys.intern(value) if value is not None else None
+
+class ActivityLog:
+  """An activity log entry from activity_log_list or activity_summary"""
+
+  __slots__ = ("log_id", "activity_id", "name", "start_time", "duration", "calories",
+    "steps", "distance", "average_heart_rate", "log_type")
+
+  def __init__(self, log_id: int, activity_id: int, name: str, start_time: str, duration: int,
+      calories: int, steps: int, distance: float, average_heart_rate: int, log_type: str):
+    self.log_id = log_id
+    self.activity_id = activity_id
+    self.name = name
+    self.start_time = start_time
+    self.duration = duration
+    self.calories = calories
+    self.steps = steps
+    self.distance = distance
+    self.average_heart_rate = average_heart_rate
+    self.log_type = log_type
+
+  @classmethod
+  def from_json(cls, data: dict) -> "ActivityLog":
+    """
+    Builds a record from one entry of the activities list of a response
+
+    Parameters:
+      data: An activity log entry; both the activity_log_list and the activity_summary shapes are accepted
+    """
+    get = data.get
+    return cls(get("logId"), get("activityTypeId", get("activityId")), _intern(get("activityName", get("name"))),
+      get("startTime"), get("duration"), get("calories"), get("steps"), get("distance"),
+      get("averageHeartRate"), _intern(get("logType")))
+
+  def __repr__(self) -> str:
+    return f"ActivityLog(log_id={self.log_id}, name={self.name!r}, start_time={self.start_time!r})"
+
+class SleepStage:
+  """One interval of a sleep log's levels.data or levels.shortData"""
+
+  __slots__ = ("start_time", "level", "seconds")
+
+  def __init__(self, start_time: str, level: str, seconds: int):
+    self.start_time = start_time
+    self.level = level
+    self.seconds = seconds
+
+  @classmethod
+  def from_json(cls, data: dict) -> "SleepStage":
+    return cls(data["dateTime"], sys.intern(data["level"]), data["seconds"])
+
+  def __repr__(self) -> str:
+    return f"SleepStage({self.start_time!r}, {self.level!r}, {self.seconds})"
+
+class SleepLog:
+  """A sleep log entry from sleep_log, sleep_logs_range or sleep_logs_list"""
+
+  __slots__ = ("log_id", "date_of_sleep", "start_time", "end_time", "duration", "efficiency",
+    "is_main_sleep", "minutes_asleep", "minutes_awake", "time_in_bed", "type", "stages", "short_stages")
+
+  def __init__(self, log_id: int, date_of_sleep: str, start_time: str, end_time: str, duration: int,
+      efficiency: int, is_main_sleep: bool, minutes_asleep: int, minutes_awake: int, time_in_bed: int,
+      type: str, stages: tuple, short_stages: tuple):
+    self.log_id = log_id
+    self.date_of_sleep = date_of_sleep
+    self.start_time = start_time
+    self.end_time = end_time
+    self.duration = duration
+    self.efficiency = efficiency
+    self.is_main_sleep = is_main_sleep
+    self.minutes_asleep = minutes_asleep
+    self.minutes_awake = minutes_awake
+    self.time_in_bed = time_in_bed
+    self.type = type
+    self.stages = stages
+    self.short_stages = short_stages
+
+  @classmethod
+  def from_json(cls, data: dict) -> "SleepLog":
+    """
+    Builds a record, including its stage intervals, from one entry of the sleep list of a response
+
+    Parameters:
+      data: A sleep log entry from the 1.2 sleep endpoints
+    """
+    get = data.get
+    levels = get("levels") or {}
+    stages = tuple(SleepStage.from_json(stage) for stage in levels.get("data", ()))
+    short_stages = tuple(SleepStage.from_json(stage) for stage in levels.get("shortData", ()))
+    return cls(get("logId"), get("dateOfSleep"), get("startTime"), get("endTime"), get("duration"),
+      get("efficiency"), get("isMainSleep"), get("minutesAsleep"), get("minutesAwake"), get("timeInBed"),
+      _intern(get("type")), stages, short_stages)
+
+  def __repr__(self) -> str:
+    return f"SleepLog(log_id={self.log_id}, date_of_sleep={self.date_of_sleep!r}, stages={len(self.stages)})"
+
+class FoodLog:
+  """A food log entry from food_logs"""
+
+  __slots__ = ("log_id", "log_date", "food_id", "name", "brand", "meal_type_id", "amount", "unit_id",
+    "calories", "carbs", "fat", "fiber", "protein", "sodium", "is_favorite")
+
+  def __init__(self, log_id: int, log_date: str, food_id: int, name: str, brand: str, meal_type_id: int,
+      amount: float, unit_id: int, calories: float, carbs: float, fat: float, fiber: float, protein: float,
+      sodium: float, is_favorite: bool):
+    self.log_id = log_id
+    self.log_date = log_date
+    self.food_id = food_id
+    self.name = name
+    self.brand = brand
+    self.meal_type_id = meal_type_id
+    self.amount = amount
+    self.unit_id = unit_id
+    self.calories = calories
+    self.carbs = carbs
+    self.fat = fat
+    self.fiber = fiber
+    self.protein = protein
+    self.sodium = sodium
+    self.is_favorite = is_favorite
+
+  @classmethod
+  def from_json(cls, data: dict) -> "FoodLog":
+    """
+    Builds a record from one entry of the foods list of a food_logs response
+
+    Parameters:
+      data: A food log entry
+    """
+    food = data.get("loggedFood") or {}
+    nutrition = data.get("nutritionalValues") or {}
+    unit = food.get("unit") or {}
+    return cls(data.get("logId"), data.get("logDate"), food.get("foodId"), _intern(food.get("name")),
+      _intern(food.get("brand")), food.get("mealTypeId"), food.get("amount"), unit.get("id"),
+      nutrition.get("calories", food.get("calories")), nutrition.get("carbs"), nutrition.get("fat"),
+      nutrition.get("fiber"), nutrition.get("protein"), nutrition.get("sodium"), data.get("isFavorite"))
+
+  def __repr__(self) -> str:
+    return f"FoodLog(log_id={self.log_id}, log_date={self.log_date!r}, name={self.name!r})"
+
+class WaterLog:
+  """A water log entry from water_logs"""
+
+  __slots__ = ("log_id", "date", "amount")
+
+  def __init__(self, log_id: int, date: str, amount: float):
+    self.log_id = log_id
+    self.date = date
+    self.amount = amount
+
+  @classmethod
+  def from_json(cls, data: dict, date: str = None) -> "WaterLog":
+    """
+    Builds a record from one entry of the water list of a water_logs response
+
+    Parameters:
+      data: A water log entry
+      date: (optional) The date the logs were requested for, as the entries do not include it
+    """
+    return cls(data.get("logId"), date, data.get("amount"))
+
+  def __repr__(self) -> str:
+    return f"WaterLog(log_id={self.log_id}, date={self.date!r}, amount={self.amount})"
+
+class BodyLog:
+  """A weight or body fat log entry from body_logs"""
+
+  __slots__ = ("log_id", "date", "time", "weight", "bmi", "fat", "source")
+
+  def __init__(self, log_id: int, date: str, time: str, weight: float, bmi: float, fat: float, source: str):
+    self.log_id = log_id
+    self.date = date
+    self.time = time
+    self.weight = weight
+    self.bmi = bmi
+    self.fat = fat
+    self.source = source
+
+  @classmethod
+  def from_json(cls, data: dict) -> "BodyLog":
+    """
+    Builds a record from one entry of the weight or fat list of a body_logs response
+
+    Parameters:
+      data: A weight or body fat log entry
+    """
+    get = data.get
+    return cls(get("logId"), get("date"), get("time"), get("weight"), get("bmi"), get("fat"), _intern(get("source")))
+
+  def __repr__(self) -> str:
+    return f"BodyLog(log_id={self.log_id}, date={self.date!r}, time={self.time!r})"
+
+def activity_logs(res: dict) -> list:
+  """
+  Returns the activity log entries of an activity_log_list or activity_summary response as ActivityLog records
+
+  Parameters:
+    res: The parsed response
+  """
+  return [ActivityLog.from_json(entry) for entry in res.get("activities", ())]
+
+def sleep_logs(res: dict) -> list:
+  """
+  Returns the sleep log entries of a sleep_log, sleep_logs_range or sleep_logs_list response as SleepLog records
+
+  Parameters:
+    res: The parsed response
+  """
+  return [SleepLog.from_json(entry) for entry in res.get("sleep", ())]
+
+def food_logs(res: dict) -> list:
+  """
+  Returns the food log entries of a food_logs response as FoodLog records
+
+  Parameters:
+    res: The parsed response
+  """
+  return [FoodLog.from_json(entry) for entry in res.get("foods", ())]
+
+def water_logs(res: dict, date: str = None) -> list:
+  """
+  Returns the water log entries of a water_logs response as WaterLog records
+
+  Parameters:
+    res: The parsed response
+    date: (optional) The date the logs were requested for
+  """
+  return [WaterLog.from_json(entry, date) for entry in res.get("water", ())]
+
+def body_logs(res: dict) -> list:
+  """
+  Returns the entries of a weight or body fat body_logs response as BodyLog records
+
+  Parameters:
+    res: The parsed response
+  """
+  entries = res.get("weight")
+  if entries is None:
+    entries = res.get("fat", ())
+  return [BodyLog.from_json(entry) for entry in entries]
@@ -0,0 +1,150 @@
+"""
+Local resampling of cached intraday data
+
+Serves coarser detail levels and start_time/end_time windows of activity_intraday and
+heart_rate_intraday from the finest data already in an IntradayCache, bucketing the slots with
+numpy and aggregating them per resource (sums for activity counts, means for heart rate). Only
+days that are not cached at the requested or a finer detail level are fetched from the API.
+"""
+import time
+import numpy as np
+from intraday_cache import IntradayCache, SLOTS, intraday_dataset, last_sync, seconds_of_day
+
+LEVEL_SECONDS = {"1sec": 1, "1min": 60, "5min": 300, "15min": 900}
+
+AGGREGATIONS = {"steps": "sum", "calories": "sum", "distance": "sum", "floors": "sum", "elevation": "sum", "heart": "mean"}
+
+INTEGER_RESOURCES = {"steps", "floors", "heart"}
+
+def resample(values: np.ndarray, present: np.ndarray, source_level: str, target_level: str, how: str) -> tuple:
+  """
+  Buckets (..., slots) arrays of one detail level into a coarser one and returns the new values and presence
+
+  Parameters:
+    values: The values with the slots on the last axis
+    present: A boolean array of the same shape telling which slots hold a value
+    source_level: The detail level of values
+    target_level: A detail level at least as coarse as source_level
+    how: sum or mean; a mean only counts the slots that hold a value
+  """
+  factor = LEVEL_SECONDS[target_level] // LEVEL_SECONDS[source_level]
+  if factor < 1 or LEVEL_SECONDS[target_level] % LEVEL_SECONDS[source_level]:
+    raise ValueError(f"Cannot resample {source_level} data to {target_level}")
+  shape = values.shape[:-1] + (values.shape[-1] // factor, factor)
+  present = present.reshape(shape)
+  sums = np.where(present, values.reshape(shape), 0).sum(axis=-1, dtype=np.float64)
+  counts = present.sum(axis=-1)
+  if how == "mean":
+    sums = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+  return sums, counts > 0
+
+def _seconds(time: str) -> int:
+  hours, minutes = time.split(":")[:2]
+  return int(hours) * 3600 + int(minutes) * 60
+
+class CachedIntraday:
+
+  def __init__(self, api, cache: IntradayCache, sync_ttl: float = 900.0):
+    """
+    Parameters:
+      api: The fitbit.API instance used for days that are not cached
+      cache: The IntradayCache the days are read from and stored in
+      sync_ttl: (optional) Seconds the last sync time of the user's trackers, which tells whether a
+        fetched day is complete, is reused before the devices are requested again
+    """
+    self.api = api
+    self.cache = cache
+    self.sync_ttl = sync_ttl
+    self.__synced = (None, float("-inf"))
+
+  def __last_sync(self) -> str:
+    synced, checked = self.__synced
+    if time.time() - checked >= self.sync_ttl:
+      res = self.api.devices()
+      synced = last_sync(res.json() if self.api.debug else res)
+      self.__synced = (synced, time.time())
+    return synced
+
+  def __finest(self, resource: str, date: str, detail_level: str) -> str:
+    """Returns the finest cached detail level of a complete day that can serve detail_level, or None"""
+    for level in sorted(LEVEL_SECONDS, key=LEVEL_SECONDS.get):
+      if LEVEL_SECONDS[level] > LEVEL_SECONDS[detail_level]:
+        break
+      if self.cache.complete(self.api.user_id, resource, level, date, date)[0]:
+        return level
+    return None
+
+  def day(self, resource: str, date: str, detail_level: str, start_time: str = None, end_time: str = None) -> tuple:
+    """
+    Returns the seconds of day and values of the buckets of one day that hold a value, fetching and
+    caching the whole day only if no complete day at detail_level or finer is cached
+
+    Parameters:
+      resource: calories, steps, distance, floors, elevation or heart
+      date: The date in the format yyyy-MM-dd
+      detail_level: 1sec, 1min, 5min or 15min
+      start_time: (optional) The start of the window in the format HH:mm
+      end_time: (optional) The end of the window in the format HH:mm, inclusive
+    """
+    source = self.__finest(resource, date, detail_level)
+    if source is None:
+      if resource == "heart":
+        res = self.api.heart_rate_intraday(date, "1d", detail_level)
+      else:
+        res = self.api.activity_intraday(resource, date, "1d", detail_level)
+      self.cache.store(self.api.user_id, resource, detail_level, date, res.json() if self.api.debug else res,
+        synced=self.__last_sync())
+      source = detail_level
+    values = self.cache.values(self.api.user_id, resource, source, date, date)[0]
+    present = self.cache.present(self.api.user_id, resource, source, date, date)[0]
+    values, present = resample(values, present, source, detail_level, AGGREGATIONS[resource])
+    seconds = np.arange(SLOTS[detail_level]) * LEVEL_SECONDS[detail_level]
+    if start_time is not None and end_time is not None:
+      present &= (seconds >= _seconds(start_time)) & (seconds <= _seconds(end_time))
+    if resource in INTEGER_RESOURCES:
+      values = np.rint(values)
+    return seconds[present], values[present]
+
+  def __dataset(self, resource: str, date: str, detail_level: str, start_time: str, end_time: str) -> dict:
+    seconds, values = self.day(resource, date, detail_level, start_time, end_time)
+    cast = int if resource in INTEGER_RESOURCES else float
+    dataset = [{"time": f"{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}", "value": cast(value)}
+      for second, value in zip(seconds.tolist(), values.tolist())]
+    minutes = LEVEL_SECONDS[detail_level] // 60
+    return {"dataset": dataset, "datasetInterval": minutes or 1, "datasetType": "minute" if minutes else "second"}
+
+  def activity_intraday(self, resource_path: str, base_date: str, end_or_1d: str, detail_level: str, start_time: str = None, end_time: str = None) -> dict:
+    """
+    Same as fitbit.API.activity_intraday for a single day, served from the cache when possible. The
+    summary only holds the day's total of the returned window.
+
+    Parameters:
+      resource_path: calories, steps, distance, floors, or elevation
+      base_date: The date in the format yyyy-MM-dd
+      end_or_1d: The string "1d" or the same date as base_date; other ranges go to the API
+      detail_level: 1min, 5min or 15min
+      start_time: (optional) The start of the period in the format HH:mm.
+      end_time: (optional) The end of the period in the format HH:mm
+    """
+    if end_or_1d not in ("1d", base_date):
+      return self.api.activity_intraday(resource_path, base_date, end_or_1d, detail_level, start_time, end_time)
+    intraday = self.__dataset(resource_path, base_date, detail_level, start_time, end_time)
+    total = sum(point["value"] for point in intraday["dataset"])
+    return {f"activities-{resource_path}": [{"dateTime": base_date, "value": str(total)}],
+      f"activities-{resource_path}-intraday": intraday}
+
+  def heart_rate_intraday(self, base_date: str, end_or_1d: str, detail_level: str, start_time: str = None, end_time: str = None) -> dict:
+    """
+    Same as fitbit.API.heart_rate_intraday for a single day, served from the cache when possible. Only
+    the intraday part of the response is returned.
+
+    Parameters:
+      base_date: The date in the format of yyyy-MM-dd
+      end_or_1d: The string "1d" or the same date as base_date; other ranges go to the API
+      detail_level: Either 1sec or 1min
+      start_time: (optional) The start of the period in the format of HH:mm.
+      end_time: (optional) The end time of the period in the format of HH:mm.
+    """
+    if end_or_1d not in ("1d", base_date):
+      return self.api.heart_rate_intraday(base_date, end_or_1d, detail_level, start_time, end_time)
+    return {"activities-heart-intraday": self.__dataset("heart", base_date, detail_level, start_time, end_time)}
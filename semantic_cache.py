@@ -0,0 +1,271 @@
+"""
+Cross-endpoint cache
+
+Many endpoints return overlapping data: an activity_time_series range holds every day's total that a
+narrower range or activity_value() would fetch again, activity_summary holds the totals of every
+activity resource for its day, and a sleep_logs_range response holds every sleep_log(date) in it.
+SemanticCache keeps the data of such responses per day and answers any request it fully covers
+without a network call. Writes made through it and webhook notifications passed to notify()
+invalidate the affected days of the affected collection.
+
+Responses are always returned parsed, even if the API instance is in debug mode. Failed responses,
+e.g. a 429 or an expired token, are returned without being cached.
+"""
+import datetime, inspect, threading, time
+
+PERIOD_DAYS = {"1d": 1, "7d": 7, "30d": 30, "1w": 7}
+PERIOD_MONTHS = {"1m": 1, "3m": 3, "6m": 6, "1y": 12}
+
+# The activity_summary fields holding the day's value of each activity_time_series resource
+SUMMARY_FIELDS = {
+  "steps": "steps", "calories": "caloriesOut", "caloriesBMR": "caloriesBMR", "floors": "floors",
+  "elevation": "elevation", "activityCalories": "activityCalories", "minutesSedentary": "sedentaryMinutes",
+  "minutesLightlyActive": "lightlyActiveMinutes", "minutesFairlyActive": "fairlyActiveMinutes",
+  "minutesVeryActive": "veryActiveMinutes",
+}
+
+# The collection every mutation changes, as named by the Subscriptions API
+MUTATION_COLLECTIONS = {
+  "log_activity": "activities", "delete_activity_log": "activities",
+  "log_body": "body", "delete_body_log": "body",
+  "log_food": "foods", "edit_food_log": "foods", "delete_food_log": "foods",
+  "log_water": "foods", "update_water_log": "foods", "delete_water_log": "foods",
+  "log_sleep": "sleep", "delete_sleep_log": "sleep",
+}
+
+def _date(value: str) -> datetime.date:
+  return datetime.date.today() if value == "today" else datetime.date.fromisoformat(value)
+
+def _minus_months(date: datetime.date, months: int) -> datetime.date:
+  month = date.month - months - 1
+  year, month = date.year + month // 12, month % 12 + 1
+  return date.replace(year=year, month=month, day=min(date.day, [31, 29 if year % 4 == 0 and (year % 100 or year % 400 == 0) else 28,
+    31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month - 1]))
+
+def date_range(base_date: str, end_or_period: str) -> tuple:
+  """
+  Returns the first and last date of a time series request, or None for the max period
+
+  Parameters:
+    base_date: The base_date of the request
+    end_or_period: An end date or one of the periods 1d, 7d, 30d, 1w, 1m, 3m, 6m, 1y, or max
+  """
+  base = _date(base_date)
+  if end_or_period in PERIOD_DAYS:
+    return base - datetime.timedelta(days=PERIOD_DAYS[end_or_period] - 1), base
+  if end_or_period in PERIOD_MONTHS:
+    return _minus_months(base, PERIOD_MONTHS[end_or_period]) + datetime.timedelta(days=1), base
+  if end_or_period == "max":
+    return None
+  return base, _date(end_or_period)
+
+def _days(start: datetime.date, end: datetime.date) -> list:
+  return [start + datetime.timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+class SemanticCache:
+
+  def __init__(self, api, live_ttl: float = 300.0):
+    """
+    Parameters:
+      api: The fitbit.API instance requests that are not covered are sent with
+      live_ttl: (optional) Seconds the data of today, which is still changing, is served from the cache
+    """
+    self.api = api
+    self.live_ttl = live_ttl
+    self.__values = {}
+    self.__covered = {}
+    self.__summaries = {}
+    self.__sleep = {}
+    self.__lock = threading.RLock()
+
+  def __fetch(self, method: str, *args) -> tuple:
+    """Returns the parsed response of an API call and whether it succeeded and can be cached"""
+    res = getattr(self.api, method)(*args)
+    if self.api.debug:
+      body = res.json()
+      return body, res.status_code < 400 and not (isinstance(body, dict) and body.get("errors"))
+    return res, not (isinstance(res, dict) and res.get("errors"))
+
+  def __fresh(self, family: tuple, day: datetime.date) -> bool:
+    fetched = self.__covered.get(family, {}).get(day)
+    if fetched is None:
+      return False
+    return day < datetime.date.today() or time.time() - fetched < self.live_ttl
+
+  def __cover(self, family: tuple, days: list, values: dict) -> None:
+    now = time.time()
+    covered = self.__covered.setdefault(family, {})
+    stored = self.__values.setdefault(family, {})
+    for day in days:
+      covered[day] = now
+    stored.update(values)
+
+  def __series(self, family: tuple, key: str, fetch, base_date: str, end_or_period: str) -> dict:
+    span = date_range(base_date, end_or_period)
+    with self.__lock:
+      if span is not None and all(self.__fresh(family, day) for day in _days(*span)):
+        stored = self.__values[family]
+        return {key: [{"dateTime": day.isoformat(), "value": stored[day]} for day in _days(*span) if day in stored]}
+    res, ok = fetch()
+    if not ok:
+      return res
+    entries = res.get(key, [])
+    values = {datetime.date.fromisoformat(entry["dateTime"]): entry["value"] for entry in entries}
+    if span is None and values:
+      span = (min(values), max(values))
+    with self.__lock:
+      if span is not None:
+        self.__cover(family, _days(*span), values)
+    return res
+
+  """
+  Endpoints served from the cache
+  """
+  def activity_time_series(self, resource_path: str, base_date: str, end_or_period: str, use_tracker: bool = False) -> dict:
+    """Same as fitbit.API.activity_time_series"""
+    tracker = "tracker-" if use_tracker else ""
+    return self.__series(("activities", tracker + resource_path), f"activities-{tracker}{resource_path}",
+      lambda: self.__fetch("activity_time_series", resource_path, base_date, end_or_period, use_tracker), base_date, end_or_period)
+
+  def body_time_series(self, resource_path: str, base_date: str, end_or_period: str) -> dict:
+    """Same as fitbit.API.body_time_series"""
+    return self.__series(("body", resource_path), f"body-{resource_path}",
+      lambda: self.__fetch("body_time_series", resource_path, base_date, end_or_period), base_date, end_or_period)
+
+  def heart_rate_time_series(self, base_date: str, end_or_period: str) -> dict:
+    """Same as fitbit.API.heart_rate_time_series"""
+    return self.__series(("activities", "heart"), "activities-heart",
+      lambda: self.__fetch("heart_rate_time_series", base_date, end_or_period), base_date, end_or_period)
+
+  def food_or_water_time_series(self, base_date: str, end_or_period: str, resource_path: str = "caloriesIn") -> dict:
+    """Same as fitbit.API.food_or_water_time_series"""
+    return self.__series(("foods", resource_path), f"foods-log-{resource_path}",
+      lambda: self.__fetch("food_or_water_time_series", base_date, end_or_period, resource_path), base_date, end_or_period)
+
+  def activity_summary(self, date: str) -> dict:
+    """
+    Same as fitbit.API.activity_summary. A fetched summary also covers the day in the time series of
+    every resource in SUMMARY_FIELDS.
+    """
+    day = _date(date)
+    with self.__lock:
+      if self.__fresh(("activities", "summary"), day):
+        return self.__summaries[day]
+    res, ok = self.__fetch("activity_summary", date)
+    if not ok:
+      return res
+    summary = res.get("summary", {})
+    with self.__lock:
+      self.__summaries[day] = res
+      self.__cover(("activities", "summary"), [day], {})
+      for resource, field in SUMMARY_FIELDS.items():
+        if field in summary:
+          self.__cover(("activities", resource), [day], {day: str(summary[field])})
+      distance = next((entry["distance"] for entry in summary.get("distances", []) if entry.get("activity") == "total"), None)
+      if distance is not None:
+        self.__cover(("activities", "distance"), [day], {day: str(distance)})
+    return res
+
+  def activity_value(self, resource_path: str, date: str) -> str:
+    """
+    Returns one day's value of an activity time series resource, from any cached time series or
+    activity summary covering the day, and otherwise from a single activity_summary request
+
+    Parameters:
+      resource_path: A resource of SUMMARY_FIELDS or distance
+      date: The date in the format yyyy-MM-dd
+    """
+    day = _date(date)
+    family = ("activities", resource_path)
+    with self.__lock:
+      if self.__fresh(family, day):
+        return self.__values[family].get(day)
+    self.activity_summary(date)
+    with self.__lock:
+      return self.__values.get(family, {}).get(day)
+
+  def __store_sleep(self, days: list, logs: list) -> None:
+    by_day = {day: [] for day in days}
+    for log in logs:
+      by_day.setdefault(datetime.date.fromisoformat(log["dateOfSleep"]), []).append(log)
+    self.__sleep.update(by_day)
+    self.__cover(("sleep", ""), list(by_day), {})
+
+  def sleep_logs_range(self, base_date: str, end_date: str) -> dict:
+    """Same as fitbit.API.sleep_logs_range"""
+    days = _days(_date(base_date), _date(end_date))
+    with self.__lock:
+      if all(self.__fresh(("sleep", ""), day) for day in days):
+        return {"sleep": [log for day in reversed(days) for log in self.__sleep[day]]}
+    res, ok = self.__fetch("sleep_logs_range", base_date, end_date)
+    if not ok:
+      return res
+    with self.__lock:
+      self.__store_sleep(days, res.get("sleep", []))
+    return res
+
+  def sleep_log(self, date: str) -> dict:
+    """Same as fitbit.API.sleep_log; a summary is computed from the logs when served from the cache"""
+    day = _date(date)
+    with self.__lock:
+      if self.__fresh(("sleep", ""), day):
+        logs = self.__sleep[day]
+        stages = {}
+        for log in logs:
+          if log.get("isMainSleep"):
+            for stage, summary in (log.get("levels") or {}).get("summary", {}).items():
+              stages[stage] = stages.get(stage, 0) + summary.get("minutes", 0)
+        return {"sleep": logs, "summary": {"stages": stages, "totalMinutesAsleep": sum(log.get("minutesAsleep", 0) for log in logs),
+          "totalSleepRecords": len(logs), "totalTimeInBed": sum(log.get("timeInBed", 0) for log in logs)}}
+    res, ok = self.__fetch("sleep_log", date)
+    if not ok:
+      return res
+    with self.__lock:
+      self.__store_sleep([day], res.get("sleep", []))
+    return res
+
+  """
+  Invalidation
+  """
+  def invalidate(self, collection: str = None, date: str = None) -> None:
+    """
+    Forgets cached data so that the next request for it goes to the API
+
+    Parameters:
+      collection: (optional) activities, body, foods or sleep; all collections by default
+      date: (optional) The changed day in the format yyyy-MM-dd; all days by default
+    """
+    day = _date(date) if date is not None else None
+    with self.__lock:
+      for family, covered in self.__covered.items():
+        if collection is not None and family[0] != collection:
+          continue
+        if day is None:
+          covered.clear()
+        else:
+          covered.pop(day, None)
+
+  def notify(self, notifications) -> None:
+    """
+    Invalidates the days named by Subscriptions API notifications
+
+    Parameters:
+      notifications: A notification dict or the list posted to the subscriber endpoint
+    """
+    for notification in notifications if isinstance(notifications, list) else [notifications]:
+      if notification.get("ownerId") in (None, self.api.user_id):
+        self.invalidate(notification.get("collectionType"), notification.get("date"))
+
+  def __getattr__(self, name: str):
+    attribute = getattr(self.api, name)
+    if name not in MUTATION_COLLECTIONS:
+      return attribute
+    def mutate(*args, **kwargs):
+      res = attribute(*args, **kwargs)
+      date = inspect.signature(attribute).bind(*args, **kwargs).arguments.get("date")
+      self.invalidate(MUTATION_COLLECTIONS[name], date)
+      if name == "log_sleep" and date is not None:
+        # A sleep that starts on date and ends after midnight belongs to the next day's dateOfSleep
+        self.invalidate("sleep", (_date(date) + datetime.timedelta(days=1)).isoformat())
+      return res
+    return mutate
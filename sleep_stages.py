@@ -0,0 +1,120 @@
+"""
+Sleep stage timeline decoding
+
+Turns the levels.data and levels.shortData lists of a sleep log into compact numpy arrays of
+start offsets (seconds from the start of the log), durations (seconds) and stage codes, with
+the short wake periods merged into the main timeline, and computes per-stage totals for a
+single night or a whole cohort without Python loops over the intervals.
+"""
+import numpy as np
+
+STAGES = ("wake", "light", "deep", "rem", "asleep", "restless", "awake")
+STAGE_CODES = {stage: code for code, stage in enumerate(STAGES)}
+
+class SleepTimeline:
+  """The decoded stage intervals of one sleep log"""
+
+  __slots__ = ("log_id", "date_of_sleep", "start", "offsets", "durations", "stages")
+
+  def __init__(self, log_id: int, date_of_sleep: str, start: np.datetime64, offsets: np.ndarray, durations: np.ndarray, stages: np.ndarray):
+    self.log_id = log_id
+    self.date_of_sleep = date_of_sleep
+    self.start = start
+    self.offsets = offsets
+    self.durations = durations
+    self.stages = stages
+
+  def totals(self) -> np.ndarray:
+    """Returns the number of seconds spent in each stage, indexed by stage code"""
+    return np.bincount(self.stages, weights=self.durations, minlength=len(STAGES)).astype(np.int64)
+
+  def totals_by_name(self) -> dict:
+    """Returns the number of seconds spent in each stage that occurs in the timeline, keyed by stage name"""
+    return {STAGES[code]: int(seconds) for code, seconds in enumerate(self.totals()) if seconds}
+
+  def __len__(self) -> int:
+    return len(self.stages)
+
+  def __repr__(self) -> str:
+    return f"SleepTimeline(log_id={self.log_id}, date_of_sleep={self.date_of_sleep!r}, intervals={len(self)})"
+
+def _intervals(entries: list) -> tuple:
+  """Returns the start times (datetime64[s]), durations and stage codes of a levels list"""
+  if not entries:
+    return np.empty(0, "datetime64[s]"), np.empty(0, np.int32), np.empty(0, np.uint8)
+  starts = np.array([entry["dateTime"] for entry in entries], dtype="datetime64[ms]").astype("datetime64[s]")
+  durations = np.fromiter((entry["seconds"] for entry in entries), np.int32, len(entries))
+  stages = np.fromiter((STAGE_CODES[entry["level"]] for entry in entries), np.uint8, len(entries))
+  return starts, durations, stages
+
+def _merge(starts: np.ndarray, ends: np.ndarray, stages: np.ndarray, short_starts: np.ndarray, short_ends: np.ndarray, short_stages: np.ndarray) -> tuple:
+  """Overlays the short intervals on the main ones and returns the merged starts, ends and stages"""
+  bounds = np.unique(np.concatenate((starts, ends, short_starts, short_ends)))
+  seg_starts, seg_ends = bounds[:-1], bounds[1:]
+  main = np.searchsorted(starts, seg_starts, side="right") - 1
+  covered = (main >= 0) & (seg_starts < ends[np.maximum(main, 0)])
+  short = np.searchsorted(short_starts, seg_starts, side="right") - 1
+  in_short = (short >= 0) & (seg_starts < short_ends[np.maximum(short, 0)])
+  merged = np.where(in_short, short_stages[np.maximum(short, 0)], stages[np.maximum(main, 0)])
+  keep = covered | in_short
+  seg_starts, seg_ends, merged = seg_starts[keep], seg_ends[keep], merged[keep]
+  # Collapse neighbouring segments that ended up in the same stage
+  if len(merged) > 1:
+    first = np.ones(len(merged), bool)
+    first[1:] = (merged[1:] != merged[:-1]) | (seg_starts[1:] != seg_ends[:-1])
+    last = np.ones(len(merged), bool)
+    last[:-1] = first[1:]
+    seg_starts, seg_ends, merged = seg_starts[first], seg_ends[last], merged[first]
+  return seg_starts, seg_ends, merged
+
+def decode(log: dict, merge_short: bool = True) -> SleepTimeline:
+  """
+  Decodes one sleep log into a SleepTimeline
+
+  Parameters:
+    log: A sleep log entry from sleep_log, sleep_logs_range or sleep_logs_list
+    merge_short: (optional) Whether to merge the short wake periods of levels.shortData into the timeline
+  """
+  levels = log.get("levels") or {}
+  starts, durations, stages = _intervals(levels.get("data"))
+  if merge_short and levels.get("shortData"):
+    short_starts, short_durations, short_stages = _intervals(levels["shortData"])
+    order = np.argsort(short_starts, kind="stable")
+    short_starts, short_durations, short_stages = short_starts[order], short_durations[order], short_stages[order]
+    starts, ends, stages = _merge(starts, starts + durations, stages, short_starts, short_starts + short_durations, short_stages)
+    durations = (ends - starts).astype(np.int32)
+  if log.get("startTime"):
+    start = np.datetime64(log["startTime"], "s")
+  elif len(starts):
+    start = starts[0]
+  else:
+    start = np.datetime64("NaT", "s")
+  offsets = (starts - start).astype(np.int32)
+  return SleepTimeline(log.get("logId"), log.get("dateOfSleep"), start, offsets, durations.astype(np.int32), stages.astype(np.uint8))
+
+def decode_all(res: dict, merge_short: bool = True) -> list:
+  """
+  Decodes every sleep log of a sleep_log, sleep_logs_range or sleep_logs_list response
+
+  Parameters:
+    res: The parsed response
+    merge_short: (optional) Whether to merge the short wake periods into the timelines
+  """
+  return [decode(log, merge_short) for log in res.get("sleep", ())]
+
+def cohort_totals(timelines: list) -> np.ndarray:
+  """
+  Returns an array of shape (len(timelines), len(STAGES)) with the seconds spent in each stage per timeline,
+  computed with a single bincount over all of the intervals
+
+  Parameters:
+    timelines: A list of SleepTimeline instances, e.g. one per user-night
+  """
+  if not timelines:
+    return np.zeros((0, len(STAGES)), np.int64)
+  lengths = np.fromiter((len(timeline) for timeline in timelines), np.int64, len(timelines))
+  owners = np.repeat(np.arange(len(timelines)), lengths)
+  stages = np.concatenate([timeline.stages for timeline in timelines]).astype(np.int64)
+  durations = np.concatenate([timeline.durations for timeline in timelines])
+  totals = np.bincount(owners * len(STAGES) + stages, weights=durations, minlength=len(timelines) * len(STAGES))
+  return totals.astype(np.int64).reshape(len(timelines), len(STAGES))
@@ -0,0 +1,161 @@
+"""
+A local stand-in for the Fitbit Web API
+
+Serves the token endpoint with rotating, single-use refresh tokens and answers every other request
+with a small JSON body and Fitbit-Rate-Limit-* headers, after an optional delay. It is meant for
+stress tests, load tests and profiling without a Fitbit account or network:
+
+  with StubServer() as stub:
+    tokens = stub.issue("ABC123")
+    api = fitbit.API(transport=stub.transport(), user_id=tokens.user_id,
+      access_token=tokens.access_token, refresh_token=tokens.refresh_token)
+"""
+import json, time, uuid, threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from requests.adapters import HTTPAdapter
+from fitbit import API, Tokens
+
+def redirect(url: str, session: requests.Session = None, pool_size: int = 32):
+  """
+  Returns a transport for fitbit.API that sends requests for the Fitbit API to a stub server instead,
+  e.g. one running in another process
+
+  Parameters:
+    url: The url of the stub server
+    session: (optional) The session the requests are sent with, a new one by default
+    pool_size: (optional) The number of connections kept open by a new session
+  """
+  if session is None:
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+  def send(method: str, address: str, **kwargs) -> requests.Response:
+    return session.request(method, address.replace(API.base_url, url, 1), **kwargs)
+  return send
+
+class StubServer:
+
+  def __init__(self, *, latency: float = 0.0, rate_limit: int = 150, host: str = "127.0.0.1", port: int = 0):
+    """
+    Parameters:
+      latency: (optional) Seconds every response is delayed by
+      rate_limit: (optional) Requests each user may make per hour before getting 429 responses
+      host: (optional) The interface to listen on
+      port: (optional) The port to listen on, by default any free port
+    """
+    self.latency = latency
+    self.rate_limit = rate_limit
+    self.lock = threading.Lock()
+    self.refresh_tokens = {}
+    self.access_tokens = {}
+    self.requests = {}
+    self.window = time.time()
+    stub = self
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      disable_nagle_algorithm = True
+      def log_message(self, *args):
+        pass
+      def do_GET(self):
+        stub._handle(self)
+      do_POST = do_DELETE = do_GET
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.server.daemon_threads = True
+    self.url = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+    self.__thread = None
+
+  def issue(self, user_id: str = None) -> Tokens:
+    """
+    Creates a token pair for a user, as an authorization would, and returns it
+
+    Parameters:
+      user_id: (optional) The encoded ID of the user, a random one by default
+    """
+    user_id = user_id or uuid.uuid4().hex[:6].upper()
+    tokens = Tokens(user_id, f"access-{uuid.uuid4().hex}", f"refresh-{uuid.uuid4().hex}")
+    with self.lock:
+      self.refresh_tokens[user_id] = tokens.refresh_token
+      self.access_tokens[tokens.access_token] = user_id
+    return tokens
+
+  def _handle(self, request: BaseHTTPRequestHandler) -> None:
+    if self.latency:
+      time.sleep(self.latency)
+    url = urlsplit(request.path)
+    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+    length = int(request.headers.get("Content-Length") or 0)
+    if length:
+      request.rfile.read(length)
+    if url.path == "/oauth2/token":
+      status, body, headers = self._token(query)
+    else:
+      status, body, headers = self._resource(request.command, url.path, query, request.headers.get("Authorization", ""))
+    payload = json.dumps(body).encode("utf-8")
+    request.send_response(status)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(payload)))
+    for key, value in headers.items():
+      request.send_header(key, value)
+    request.end_headers()
+    request.wfile.write(payload)
+
+  def _token(self, query: dict) -> tuple:
+    with self.lock:
+      if query.get("grant_type") == "refresh_token":
+        user_id = next((user for user, token in self.refresh_tokens.items() if token == query.get("refresh_token")), None)
+        if user_id is None:
+          return 400, {"errors": [{"errorType": "invalid_grant", "message": "Refresh token invalid"}], "success": False}, {}
+      else:
+        user_id = query.get("code") or uuid.uuid4().hex[:6].upper()
+      tokens = Tokens(user_id, f"access-{uuid.uuid4().hex}", f"refresh-{uuid.uuid4().hex}")
+      self.refresh_tokens[user_id] = tokens.refresh_token
+      self.access_tokens[tokens.access_token] = user_id
+    return 200, {"user_id": tokens.user_id, "access_token": tokens.access_token, "refresh_token": tokens.refresh_token,
+      "expires_in": 28800, "token_type": "Bearer", "scope": " "}, {}
+
+  def _resource(self, method: str, path: str, query: dict, authorization: str) -> tuple:
+    with self.lock:
+      user_id = self.access_tokens.get(authorization[len("Bearer "):])
+      if user_id is None:
+        return 401, {"errors": [{"errorType": "invalid_token", "message": "Access token invalid"}], "success": False}, {}
+      now = time.time()
+      if now - self.window >= 3600:
+        self.window = now
+        self.requests.clear()
+      used = self.requests[user_id] = self.requests.get(user_id, 0) + 1
+    remaining = max(0, self.rate_limit - used)
+    headers = {"Fitbit-Rate-Limit-Limit": str(self.rate_limit), "Fitbit-Rate-Limit-Remaining": str(remaining),
+      "Fitbit-Rate-Limit-Reset": str(int(3600 - (now - self.window)))}
+    if used > self.rate_limit:
+      return 429, {"errors": [{"errorType": "system", "message": "Too Many Requests"}], "success": False}, headers
+    return 200, {"method": method, "path": path, "query": query, "user_id": user_id}, headers
+
+  def transport(self, session: requests.Session = None, pool_size: int = 32):
+    """
+    Returns a transport for fitbit.API that sends requests for the Fitbit API to this server instead
+
+    Parameters:
+      session: (optional) The session the requests are sent with, a new one by default
+      pool_size: (optional) The number of connections kept open by a new session
+    """
+    return redirect(self.url, session, pool_size)
+
+  def start(self) -> "StubServer":
+    """Starts serving in a daemon thread"""
+    self.__thread = threading.Thread(target=self.server.serve_forever, name="stub-server", daemon=True)
+    self.__thread.start()
+    return self
+
+  def stop(self) -> None:
+    """Stops serving and closes the socket"""
+    self.server.shutdown()
+    self.server.server_close()
+    if self.__thread is not None:
+      self.__thread.join()
+
+  def __enter__(self) -> "StubServer":
+    return self.start()
+
+  def __exit__(self, *exc_info) -> None:
+    self.stop()
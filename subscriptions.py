@@ -0,0 +1,261 @@
+"""
+Fleet-wide subscription reconciliation
+
+The Subscriptions API works one user and collection at a time and keeps no record on our side.
+Reconciler keeps the desired subscriptions of every user in a SQLite database, together with what
+Fitbit last reported, and reconciles users concurrently: one subscriptions call per user lists what
+exists, and only the difference is deleted and added. Users whose rate-limit budget is down to the
+reserve are left for the next round, and so are users a sync worker holds the lease on, since
+their tokens may be refreshed by it meanwhile. Users whose refresh token was revoked are marked in
+the token store and kept apart from the users that failed for a transient reason. run() repeats
+this on an interval to heal drift, checking the users checked longest ago first, and onboarding a
+batch of users is one call to desire():
+
+  reconciler = Reconciler("subscriptions.db", Coordinator("sync.db"))
+  reconciler.desire(new_user_ids, ["activities", "sleep"])
+  reconciler.reconcile()
+
+A collection of "" is a subscription to all collections, which Fitbit reports as collectionType user.
+"""
+import time, uuid, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
+import fitbit, planner
+
+# The statuses that leave a subscription deleted or added
+SUCCESS = {"delete_subscription": (204, 404), "add_subscription": (200, 201)}
+
+def subscription_id(user_id: str, collection: str) -> str:
+  """Returns the subscription ID used for a user's collection, unique across users and collections"""
+  return f"{user_id}-{collection or 'all'}"
+
+class Reconciler:
+
+  def __init__(self, path: str, store, *, workers: int = 8, reserve: int = 10, lease: float = 300.0, worker_id: str = None,
+      api_options: dict = None):
+    """
+    Parameters:
+      path: The SQLite database holding the desired and reported subscriptions
+      store: The token store, a sync_workers.Coordinator; refreshed tokens are saved back to it
+      workers: (optional) Users reconciled at once
+      reserve: (optional) Requests of a user's hourly budget left for other callers
+      lease: (optional) Seconds of the lease taken on a user in the token store while it is reconciled
+      worker_id: (optional) The ID the leases are taken under, by default a random one
+      api_options: (optional) Keyword arguments for every fitbit.API, e.g. a transport
+    """
+    self.store = store
+    self.workers = workers
+    self.reserve = reserve
+    self.lease = lease
+    self.worker_id = worker_id or f"subscriptions-{uuid.uuid4().hex[:12]}"
+    self.api_options = api_options or {}
+    self.errors = {}
+    self.revoked = {}
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS desired (user_id TEXT NOT NULL, collection TEXT NOT NULL, subscription_id TEXT NOT NULL,
+        PRIMARY KEY (user_id, collection)) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS reported (user_id TEXT NOT NULL, collection TEXT NOT NULL, subscription_id TEXT NOT NULL,
+        PRIMARY KEY (user_id, collection, subscription_id)) WITHOUT ROWID;
+      CREATE TABLE IF NOT EXISTS checked (user_id TEXT PRIMARY KEY, checked REAL NOT NULL, in_sync INTEGER NOT NULL);
+    """)
+    self.__lock = threading.RLock()
+    self.__store_lock = threading.Lock()
+
+  def desire(self, users: list, collections: list = ("",)) -> None:
+    """
+    Sets the subscriptions a batch of users should have, replacing their earlier desired state, in one transaction
+
+    Parameters:
+      users: The encoded IDs of the users
+      collections: (optional) The collections, e.g. activities, body, foods or sleep, or "" for all
+    """
+    with self.__lock:
+      self.db.execute("BEGIN")
+      self.db.executemany("DELETE FROM desired WHERE user_id = ?", [(user_id,) for user_id in users])
+      self.db.executemany("INSERT INTO desired VALUES (?, ?, ?)",
+        [(user_id, collection, subscription_id(user_id, collection)) for user_id in users for collection in collections])
+      self.db.executemany("UPDATE checked SET in_sync = 0 WHERE user_id = ?", [(user_id,) for user_id in users])
+      self.db.execute("COMMIT")
+
+  def forget(self, users: list) -> None:
+    """Desires no subscriptions for users, so that the next reconciliation deletes theirs"""
+    self.desire(users, ())
+
+  def desired(self, user_id: str) -> set:
+    """Returns the (collection, subscription ID) pairs a user should have"""
+    with self.__lock:
+      return set(self.db.execute("SELECT collection, subscription_id FROM desired WHERE user_id = ?", (user_id,)).fetchall())
+
+  def reported(self, user_id: str) -> set:
+    """Returns the (collection, subscription ID) pairs Fitbit reported for a user when last checked"""
+    with self.__lock:
+      return set(self.db.execute("SELECT collection, subscription_id FROM reported WHERE user_id = ?", (user_id,)).fetchall())
+
+  def users(self) -> list:
+    """Returns the users with desired or reported subscriptions, the ones checked longest ago or never first"""
+    with self.__lock:
+      return [row[0] for row in self.db.execute("""SELECT user_id FROM (SELECT user_id FROM desired UNION SELECT user_id FROM reported)
+        LEFT JOIN checked USING (user_id) ORDER BY COALESCE(checked, 0), user_id""")]
+
+  def out_of_sync(self) -> list:
+    """Returns the users whose desired subscriptions differ from the ones last reported, or that were never checked"""
+    return [user_id for user_id in self.users() if self.desired(user_id) != self.reported(user_id)]
+
+  @staticmethod
+  def diff(desired: set, reported: set) -> tuple:
+    """Returns the (collection, subscription ID) pairs to delete and to add to turn reported into desired"""
+    return sorted(reported - desired), sorted(desired - reported)
+
+  def __call(self, api: fitbit.API, method: str, *args):
+    # The token the request is sent with, so that a refresh made meanwhile is not repeated
+    access_token = api.access_token
+    res = getattr(api, method)(*args)
+    if res.status_code == 401:
+      api.refresh_if_stale(access_token)
+      res = getattr(api, method)(*args)
+    return res
+
+  def __record(self, user_id: str, reported: set, in_sync: bool) -> None:
+    with self.__lock:
+      self.db.execute("BEGIN")
+      self.db.execute("DELETE FROM reported WHERE user_id = ?", (user_id,))
+      self.db.executemany("INSERT INTO reported VALUES (?, ?, ?)", [(user_id, collection, id) for collection, id in reported])
+      self.db.execute("INSERT OR REPLACE INTO checked VALUES (?, ?, ?)", (user_id, time.time(), int(in_sync)))
+      self.db.execute("COMMIT")
+
+  def reconcile_user(self, user_id: str) -> dict:
+    """
+    Lists a user's subscriptions, deletes the ones not desired and adds the missing ones, and returns
+    the counts of the subscriptions deleted and added, whether the user is now in sync and whether
+    it was skipped because another worker holds the lease on the user. A TokenError of a revoked
+    refresh token marks the user revoked in the token store before it is raised.
+    """
+    counts = {"deleted": 0, "added": 0, "in_sync": False, "skipped": False}
+    with self.__store_lock:
+      # A sync worker holding the lease may refresh the user's single-use refresh token at any moment
+      if not self.store.acquire(user_id, self.worker_id, self.lease):
+        counts["skipped"] = True
+        return counts
+      try:
+        tokens, expires_at = self.store.tokens(user_id)
+      except BaseException:
+        self.store.release(user_id, self.worker_id)
+        raise
+    try:
+      self.__reconcile_user(user_id, tokens, expires_at, counts)
+    finally:
+      with self.__store_lock:
+        self.store.release(user_id, self.worker_id)
+    return counts
+
+  def __reconcile_user(self, user_id: str, tokens: fitbit.Tokens, expires_at: float, counts: dict) -> None:
+    api = fitbit.API(user_id=tokens.user_id, access_token=tokens.access_token, refresh_token=tokens.refresh_token,
+      expires_at=expires_at, **dict(self.api_options, debug=True))
+    try:
+      res = self.__call(api, "subscriptions", "")
+      res.raise_for_status()
+      reported = {("" if entry["collectionType"] == "user" else entry["collectionType"], entry["subscriptionId"])
+        for entry in res.json().get("apiSubscriptions", [])}
+      to_delete, to_add = self.diff(self.desired(user_id), reported)
+      # Deletes first: Fitbit allows one subscription per collection, so a subscription under another ID blocks the add
+      for method, changes, key in [("delete_subscription", to_delete, "deleted"), ("add_subscription", to_add, "added")]:
+        for collection, id in changes:
+          budget = planner.remaining_budget(api)
+          if budget is not None and budget <= self.reserve:
+            break
+          res = self.__call(api, method, collection, id)
+          # A 404 on delete or a 200 on add means the change was already made since the list
+          if res.status_code not in SUCCESS[method]:
+            res.raise_for_status()
+            raise ValueError(f"{method} of {collection or 'all collections'} returned {res.status_code}")
+          (reported.discard if method == "delete_subscription" else reported.add)((collection, id))
+          counts[key] += 1
+      counts["in_sync"] = reported == self.desired(user_id)
+      self.__record(user_id, reported, counts["in_sync"])
+    except fitbit.TokenError as error:
+      if error.revoked:
+        with self.__store_lock:
+          self.store.revoke(user_id)
+      raise
+    finally:
+      # Refresh tokens are single use, so a refresh must be stored even if the reconciliation failed afterwards
+      if api.tokens != tokens:
+        with self.__store_lock:
+          self.store.save_tokens(*api.credentials)
+
+  def reconcile(self, users: list = None, max_age: float = None) -> dict:
+    """
+    Reconciles users concurrently and returns the total counts of subscriptions deleted and added, and
+    of the users checked, in sync, skipped because a sync worker holds their lease, revoked and
+    failed. Users whose refresh token is revoked, or who are not in the token store, are kept in
+    revoked and not tried again until they are authorized again; other failures are kept in errors.
+    Both are by user.
+
+    Parameters:
+      users: (optional) The users to reconcile, by default every user with desired or reported subscriptions
+      max_age: (optional) Only reconcile users that are out of sync or were checked longer ago than this many seconds
+    """
+    users = self.users() if users is None else list(users)
+    if max_age is not None:
+      with self.__lock:
+        fresh = {row[0] for row in self.db.execute("SELECT user_id FROM checked WHERE in_sync = 1 AND checked > ?", (time.time() - max_age,))}
+      users = [user_id for user_id in users if user_id not in fresh]
+    totals = {"checked": 0, "deleted": 0, "added": 0, "in_sync": 0, "skipped": 0, "revoked": 0, "failed": 0}
+    with self.__store_lock:
+      authorized = set(self.store.users())
+    for user_id in users:
+      if user_id not in authorized:
+        self.revoked.setdefault(user_id, None)
+        self.errors.pop(user_id, None)
+        totals["revoked"] += 1
+      else:
+        self.revoked.pop(user_id, None)
+    users = [user_id for user_id in users if user_id in authorized]
+    def run(user_id: str):
+      try:
+        counts = self.reconcile_user(user_id)
+      except Exception as error:
+        return user_id, error
+      return user_id, counts
+    with ThreadPoolExecutor(self.workers, thread_name_prefix="subscriptions") as executor:
+      for user_id, result in executor.map(run, users):
+        if isinstance(result, fitbit.TokenError) and result.revoked:
+          self.revoked[user_id] = result
+          self.errors.pop(user_id, None)
+          totals["revoked"] += 1
+          continue
+        if isinstance(result, Exception):
+          self.errors[user_id] = result
+          totals["failed"] += 1
+          continue
+        self.errors.pop(user_id, None)
+        if result["skipped"]:
+          totals["skipped"] += 1
+          continue
+        totals["checked"] += 1
+        totals["deleted"] += result["deleted"]
+        totals["added"] += result["added"]
+        totals["in_sync"] += result["in_sync"]
+    return totals
+
+  def run(self, interval: float = 3600.0, max_age: float = 86400.0, rounds: int = None) -> None:
+    """
+    Heals drift until interrupted or the given number of rounds is done: every round reconciles the
+    users that are out of sync or were checked longer than max_age ago
+
+    Parameters:
+      interval: (optional) Seconds between the starts of two rounds
+      max_age: (optional) Seconds after which a user in sync is checked again
+      rounds: (optional) The number of rounds, by default unlimited
+    """
+    round = 0
+    while rounds is None or round < rounds:
+      started = time.time()
+      self.reconcile(max_age=max_age)
+      round += 1
+      if rounds is None or round < rounds:
+        time.sleep(max(0.0, interval - (time.time() - started)))
+
+  def close(self) -> None:
+    self.db.close()
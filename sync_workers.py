@@ -0,0 +1,308 @@
+"""
+Sharded sync workers
+
+Spreads the syncing of many users over worker processes, on one host or on several hosts sharing
+the coordination database. Workers register and heartbeat in a SQLite database that also holds
+every user's tokens and per-user checkpoints. Each worker builds a consistent hash ring of the live
+workers and syncs the users the ring assigns to it, so that a worker joining or leaving only moves
+the users of its share of the ring. Before syncing a user a worker takes a lease on the user in
+the database and releases it once the sync is done, so even while workers disagree about the ring
+during a rebalance a user is synced by exactly one worker at a time, and other users of the tokens,
+such as subscriptions.Reconciler and export, can take the lease between syncs.
+
+  python sync_workers.py --db sync.db --processes 4 --sync mymodule:sync_user
+
+where sync_user(api, checkpoint) syncs one user with a fitbit.API and records its progress with
+checkpoint.set(task, cursor).
+"""
+import sys, json, time, uuid, bisect, hashlib, sqlite3, argparse, importlib, threading, multiprocessing
+import fitbit
+
+def _hash(key: str) -> int:
+  return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+class HashRing:
+
+  def __init__(self, workers: list, replicas: int = 64):
+    """
+    Parameters:
+      workers: The IDs of the live workers
+      replicas: (optional) Points per worker on the ring; more points spread users more evenly
+    """
+    points = sorted((_hash(f"{worker}#{replica}"), worker) for worker in workers for replica in range(replicas))
+    self.hashes = [point for point, _ in points]
+    self.workers = [worker for _, worker in points]
+
+  def owner(self, user_id: str) -> str:
+    """Returns the worker a user is assigned to, or None if there are no workers"""
+    if not self.hashes:
+      return None
+    index = bisect.bisect(self.hashes, _hash(user_id)) % len(self.hashes)
+    return self.workers[index]
+
+class Coordinator:
+
+  def __init__(self, path: str, timeout: float = 30.0):
+    """
+    Parameters:
+      path: The SQLite database shared by all workers
+      timeout: (optional) Seconds a worker may miss heartbeats before it is considered gone
+    """
+    self.path = path
+    self.timeout = timeout
+    self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+      CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, access_token TEXT NOT NULL, refresh_token TEXT NOT NULL,
+        expires_at REAL, revoked INTEGER NOT NULL DEFAULT 0);
+      CREATE TABLE IF NOT EXISTS leases (user_id TEXT PRIMARY KEY, worker_id TEXT NOT NULL, expires REAL NOT NULL);
+      CREATE TABLE IF NOT EXISTS checkpoints (user_id TEXT NOT NULL, task TEXT NOT NULL, cursor TEXT NOT NULL,
+        updated REAL NOT NULL, PRIMARY KEY (user_id, task));""")
+
+  def heartbeat(self, worker_id: str) -> None:
+    """Registers a worker or renews its registration"""
+    self.db.execute("INSERT INTO workers VALUES (?, ?) ON CONFLICT (worker_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+      (worker_id, time.time()))
+
+  def leave(self, worker_id: str) -> None:
+    """Removes a worker and releases its leases, so that its users move to the other workers at once"""
+    self.db.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+    self.db.execute("DELETE FROM leases WHERE worker_id = ?", (worker_id,))
+
+  def workers(self) -> list:
+    """Returns the IDs of the workers that sent a heartbeat within the timeout"""
+    return [row[0] for row in self.db.execute("SELECT worker_id FROM workers WHERE heartbeat >= ? ORDER BY worker_id",
+      (time.time() - self.timeout,))]
+
+  def add_user(self, tokens: fitbit.Tokens, expires_at: float = None) -> None:
+    """Stores or replaces a user's tokens"""
+    self.db.execute("""INSERT INTO users (user_id, access_token, refresh_token, expires_at) VALUES (?, ?, ?, ?)
+      ON CONFLICT (user_id) DO UPDATE SET access_token = excluded.access_token, refresh_token = excluded.refresh_token,
+      expires_at = excluded.expires_at, revoked = 0""", (tokens.user_id, tokens.access_token, tokens.refresh_token, expires_at))
+
+  def remove_user(self, user_id: str) -> None:
+    """Deletes a user with their lease and checkpoints"""
+    for table in ("users", "leases", "checkpoints"):
+      self.db.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+
+  def users(self) -> list:
+    """Returns the IDs of the users that are not revoked"""
+    return [row[0] for row in self.db.execute("SELECT user_id FROM users WHERE revoked = 0 ORDER BY user_id")]
+
+  def tokens(self, user_id: str) -> tuple:
+    """Returns the Tokens and expires_at of a user"""
+    row = self.db.execute("SELECT user_id, access_token, refresh_token, expires_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return fitbit.Tokens(*row[:3]), row[3]
+
+  def save_tokens(self, tokens: fitbit.Tokens, expires_at: float = None) -> None:
+    """Stores the tokens of a user after a refresh"""
+    self.db.execute("UPDATE users SET access_token = ?, refresh_token = ?, expires_at = ? WHERE user_id = ?",
+      (tokens.access_token, tokens.refresh_token, expires_at, tokens.user_id))
+
+  def revoke(self, user_id: str) -> None:
+    """Marks a user whose refresh token was revoked, so that no worker syncs them until add_user is called again"""
+    self.db.execute("UPDATE users SET revoked = 1 WHERE user_id = ?", (user_id,))
+
+  def acquire(self, user_id: str, worker_id: str, ttl: float) -> bool:
+    """
+    Takes or renews the lease on a user for a worker and returns whether it holds the lease. The
+    lease is only taken over if it is held by nobody, by this worker, or has expired.
+    """
+    now = time.time()
+    cursor = self.db.execute("""INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (user_id) DO UPDATE
+      SET worker_id = excluded.worker_id, expires = excluded.expires WHERE leases.worker_id = excluded.worker_id OR leases.expires < ?""",
+      (user_id, worker_id, now + ttl, now))
+    return cursor.rowcount == 1
+
+  def release(self, user_id: str, worker_id: str) -> None:
+    """Gives up a worker's lease on a user"""
+    self.db.execute("DELETE FROM leases WHERE user_id = ? AND worker_id = ?", (user_id, worker_id))
+
+  def leases(self, worker_id: str) -> list:
+    """Returns the users a worker holds leases on"""
+    return [row[0] for row in self.db.execute("SELECT user_id FROM leases WHERE worker_id = ?", (worker_id,))]
+
+  def checkpoint(self, user_id: str) -> "Checkpoint":
+    """Returns the checkpoints of a user"""
+    return Checkpoint(self, user_id)
+
+  def close(self) -> None:
+    self.db.close()
+
+class Checkpoint:
+  """The progress of one user's sync tasks, e.g. the last day backfilled, stored as JSON"""
+
+  def __init__(self, coordinator: Coordinator, user_id: str):
+    self.coordinator = coordinator
+    self.user_id = user_id
+
+  def get(self, task: str, default=None):
+    """Returns the cursor of a task, or default"""
+    row = self.coordinator.db.execute("SELECT cursor FROM checkpoints WHERE user_id = ? AND task = ?", (self.user_id, task)).fetchone()
+    return json.loads(row[0]) if row else default
+
+  def set(self, task: str, cursor) -> None:
+    """Records the cursor of a task"""
+    self.coordinator.db.execute("""INSERT INTO checkpoints VALUES (?, ?, ?, ?)
+      ON CONFLICT (user_id, task) DO UPDATE SET cursor = excluded.cursor, updated = excluded.updated""",
+      (self.user_id, task, json.dumps(cursor), time.time()))
+
+class Worker:
+
+  def __init__(self, path: str, sync, *, worker_id: str = None, lease: float = 300.0, timeout: float = 30.0,
+      heartbeat: float = None, api_options: dict = None):
+    """
+    Parameters:
+      path: The coordination database
+      sync: A callable sync(api, checkpoint) that syncs one user
+      worker_id: (optional) A unique ID of the worker, by default a random one
+      lease: (optional) Seconds a lease lasts; it is renewed with every heartbeat while its user syncs
+      timeout: (optional) Seconds without heartbeat after which a worker is considered gone
+      heartbeat: (optional) Seconds between the heartbeats of the background thread, by default a
+        third of the timeout; it must be shorter than the timeout and the lease
+      api_options: (optional) Keyword arguments for every fitbit.API, e.g. a transport
+    """
+    heartbeat = timeout / 3 if heartbeat is None else heartbeat
+    if not 0 < heartbeat < min(timeout, lease):
+      raise ValueError(f"heartbeat must be shorter than the timeout and the lease, got {heartbeat}")
+    self.sync = sync
+    self.path = path
+    self.worker_id = worker_id or uuid.uuid4().hex[:12]
+    self.lease = lease
+    self.heartbeat = heartbeat
+    self.api_options = api_options or {}
+    self.coordinator = Coordinator(path, timeout)
+    self.errors = {}
+    self.syncing = None
+    # Keeps the heartbeat from renewing a lease that run_once has just released
+    self.__syncing_lock = threading.Lock()
+    self.coordinator.heartbeat(self.worker_id)
+    # Heartbeats are sent from a thread of their own, so that a sync longer than the timeout does not
+    # drop the worker from the ring and move its users while it still syncs them
+    self.__stop = threading.Event()
+    self.__beater = threading.Thread(target=self.__beat, name=f"heartbeat-{self.worker_id}", daemon=True)
+    self.__beater.start()
+
+  def __beat(self) -> None:
+    coordinator = Coordinator(self.path, self.coordinator.timeout)
+    try:
+      while not self.__stop.wait(self.heartbeat):
+        try:
+          coordinator.heartbeat(self.worker_id)
+          with self.__syncing_lock:
+            if self.syncing is not None:
+              coordinator.acquire(self.syncing, self.worker_id, self.lease)
+        except sqlite3.Error:
+          # A busy database only delays this heartbeat; the next one is due well within the timeout
+          pass
+    finally:
+      coordinator.close()
+
+  def assigned(self) -> list:
+    """Returns the users the hash ring of the live workers assigns to this worker"""
+    ring = HashRing(self.coordinator.workers())
+    return [user_id for user_id in self.coordinator.users() if ring.owner(user_id) == self.worker_id]
+
+  def sync_user(self, user_id: str) -> None:
+    """Syncs one user, storing the tokens if the sync refreshed them"""
+    tokens, expires_at = self.coordinator.tokens(user_id)
+    api = fitbit.API(user_id=tokens.user_id, access_token=tokens.access_token, refresh_token=tokens.refresh_token,
+      expires_at=expires_at, **self.api_options)
+    try:
+      self.sync(api, self.coordinator.checkpoint(user_id))
+    except fitbit.TokenError as error:
+      if error.revoked:
+        self.coordinator.revoke(user_id)
+      raise
+    finally:
+      # Refresh tokens are single use, so a refresh must be stored even if the sync failed afterwards
+      if api.tokens != tokens:
+        self.coordinator.save_tokens(*api.credentials)
+
+  def run_once(self) -> list:
+    """
+    Heartbeats and syncs every assigned user this worker can lease, holding each lease only while
+    its user syncs. Returns the users synced.
+    """
+    self.coordinator.heartbeat(self.worker_id)
+    synced = []
+    for user_id in self.assigned():
+      if not self.coordinator.acquire(user_id, self.worker_id, self.lease):
+        # Still syncing on the previous owner, or leased by another user of the tokens
+        continue
+      self.syncing = user_id
+      try:
+        self.sync_user(user_id)
+        self.errors.pop(user_id, None)
+        synced.append(user_id)
+      except Exception as error:
+        self.errors[user_id] = error
+      finally:
+        with self.__syncing_lock:
+          self.syncing = None
+          self.coordinator.release(user_id, self.worker_id)
+    return synced
+
+  def run(self, interval: float = 60.0, rounds: int = None) -> None:
+    """
+    Runs rounds until interrupted or the given number of rounds is done, then leaves
+
+    Parameters:
+      interval: (optional) Seconds between the starts of two rounds
+      rounds: (optional) The number of rounds, by default unlimited
+    """
+    try:
+      round = 0
+      while rounds is None or round < rounds:
+        started = time.time()
+        self.run_once()
+        round += 1
+        if rounds is None or round < rounds:
+          time.sleep(max(0.0, interval - (time.time() - started)))
+    finally:
+      self.leave()
+
+  def leave(self) -> None:
+    """Stops the heartbeats, deregisters the worker and releases its leases"""
+    self.__stop.set()
+    self.__beater.join()
+    self.coordinator.leave(self.worker_id)
+    self.coordinator.close()
+
+def _load(spec: str):
+  module, _, name = spec.partition(":")
+  return getattr(importlib.import_module(module), name)
+
+def _process(path: str, spec: str, worker_id: str, interval: float, rounds: int) -> None:
+  Worker(path, _load(spec), worker_id=worker_id).run(interval, rounds)
+
+def main(argv: list = None) -> None:
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--db", required=True, help="the coordination database, shared by the workers of all hosts")
+  parser.add_argument("--sync", required=True, help="module:function called with (api, checkpoint) for every user")
+  parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="worker processes on this host")
+  parser.add_argument("--interval", type=float, default=60.0, help="seconds between sync rounds")
+  parser.add_argument("--rounds", type=int, default=None, help="rounds to run, by default until interrupted")
+  args = parser.parse_args(argv)
+  _load(args.sync)
+  # Registering all workers of this host before any starts keeps them from syncing each other's users in their first round
+  worker_ids = [uuid.uuid4().hex[:12] for _ in range(args.processes)]
+  coordinator = Coordinator(args.db)
+  for worker_id in worker_ids:
+    coordinator.heartbeat(worker_id)
+  coordinator.close()
+  processes = [multiprocessing.Process(target=_process, args=(args.db, args.sync, worker_id, args.interval, args.rounds),
+    name=f"sync-worker-{worker_id}") for worker_id in worker_ids]
+  for process in processes:
+    process.start()
+  try:
+    for process in processes:
+      process.join()
+  except KeyboardInterrupt:
+    # The workers got the interrupt too and leave, releasing their leases
+    for process in processes:
+      process.join()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
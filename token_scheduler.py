@@ -0,0 +1,170 @@
+"""
+Proactive token refresh for many users
+
+Access tokens expire after expires_in seconds (8 hours), each on its own clock. TokenScheduler keeps
+a heap of the API instances of all users ordered by when their token should be refreshed, a margin
+before expiry minus a random jitter so that tokens issued together are not refreshed together, and
+refreshes them on a small pool of worker threads. Requests never wait for these refreshes: they
+read the current Tokens tuple without taking the token lock, and the old access token stays valid
+until the new one has replaced it. Users whose refresh token was revoked are marked and dropped
+from the schedule.
+"""
+import heapq, random, time, threading, itertools
+from concurrent.futures import ThreadPoolExecutor
+from fitbit import TokenError
+
+SCHEDULED, REFRESHING, REVOKED = "scheduled", "refreshing", "revoked"
+
+class TokenScheduler:
+
+  def __init__(self, *, margin: float = 900.0, jitter: float = 600.0, workers: int = 4, retry: float = 30.0,
+      on_refresh=None, on_revoked=None, clock=time.time):
+    """
+    Parameters:
+      margin: (optional) Seconds before expiry at which a token is refreshed at the latest
+      jitter: (optional) Up to this many seconds are randomly added to the margin of every refresh
+      workers: (optional) The number of refreshes running at once
+      retry: (optional) Seconds before a refresh that failed for another reason than revocation is retried
+      on_refresh: (optional) Called with the API instance after every refresh, e.g. to persist its tokens
+      on_revoked: (optional) Called with the API instance and the TokenError when its refresh token was revoked
+      clock: (optional) The function returning the current time.time(), e.g. a fake clock in tests
+    """
+    self.margin = margin
+    self.jitter = jitter
+    self.retry = retry
+    self.on_refresh = on_refresh
+    self.on_revoked = on_revoked
+    self.clock = clock
+    self.apis = {}
+    self.status = {}
+    self.errors = {}
+    self.__heap = []
+    self.__order = itertools.count()
+    self.__due = {}
+    self.__condition = threading.Condition()
+    self.__pool = ThreadPoolExecutor(workers, thread_name_prefix="token-refresh")
+    self.__thread = None
+    self.__stop = False
+
+  def __schedule(self, user_id: str, due: float) -> None:
+    self.__due[user_id] = due
+    heapq.heappush(self.__heap, (due, next(self.__order), user_id))
+    self.__condition.notify()
+
+  def due(self, api) -> float:
+    """
+    Returns the time.time() at which the token of an API instance should be refreshed. A token without
+    a known expiry is refreshed within the jitter, which also learns its expiry.
+    """
+    offset = random.uniform(0, self.jitter)
+    if api.expires_at is None:
+      return self.clock() + offset
+    return api.expires_at - self.margin - offset
+
+  def add(self, api) -> None:
+    """
+    Schedules the refreshes of a user's tokens
+
+    Parameters:
+      api: The fitbit.API instance of the user, shared with the code making its requests
+    """
+    with self.__condition:
+      self.apis[api.user_id] = api
+      self.status[api.user_id] = SCHEDULED
+      self.errors.pop(api.user_id, None)
+      self.__schedule(api.user_id, self.due(api))
+
+  def remove(self, user_id: str) -> None:
+    """Stops refreshing a user's tokens"""
+    with self.__condition:
+      self.apis.pop(user_id, None)
+      self.status.pop(user_id, None)
+      self.__due.pop(user_id, None)
+
+  def revoked(self) -> list:
+    """Returns the IDs of the users whose refresh token was revoked and who have to authorize again"""
+    with self.__condition:
+      return [user_id for user_id, status in self.status.items() if status == REVOKED]
+
+  def next_refresh(self, user_id: str) -> float:
+    """Returns the time.time() of the next scheduled refresh of a user, or None"""
+    with self.__condition:
+      return self.__due.get(user_id)
+
+  def __refresh(self, user_id: str) -> None:
+    api = self.apis.get(user_id)
+    if api is None:
+      return
+    try:
+      # Another thread may have refreshed after a 401 already, in which case only the schedule is updated
+      api.refresh_if_stale(api.access_token)
+    except TokenError as error:
+      with self.__condition:
+        self.errors[user_id] = error
+        if error.revoked:
+          self.status[user_id] = REVOKED
+          self.__due.pop(user_id, None)
+        elif user_id in self.apis:
+          self.status[user_id] = SCHEDULED
+          self.__schedule(user_id, self.clock() + self.retry)
+      if error.revoked and self.on_revoked is not None:
+        self.on_revoked(api, error)
+      return
+    except Exception as error:
+      with self.__condition:
+        self.errors[user_id] = error
+        if user_id in self.apis:
+          self.status[user_id] = SCHEDULED
+          self.__schedule(user_id, self.clock() + self.retry)
+      return
+    with self.__condition:
+      if user_id in self.apis:
+        self.errors.pop(user_id, None)
+        self.status[user_id] = SCHEDULED
+        self.__schedule(user_id, self.due(api))
+    if self.on_refresh is not None:
+      self.on_refresh(api)
+
+  def run_pending(self) -> int:
+    """Starts the refreshes that are due and returns how many were started"""
+    started = 0
+    with self.__condition:
+      now = self.clock()
+      while self.__heap and self.__heap[0][0] <= now:
+        due, _, user_id = heapq.heappop(self.__heap)
+        # Entries replaced by a later schedule or removal are skipped
+        if self.__due.get(user_id) != due:
+          continue
+        del self.__due[user_id]
+        self.status[user_id] = REFRESHING
+        self.__pool.submit(self.__refresh, user_id)
+        started += 1
+    return started
+
+  def start(self) -> None:
+    """Starts the scheduler thread"""
+    if self.__thread is not None and self.__thread.is_alive():
+      return
+    self.__stop = False
+    def run():
+      with self.__condition:
+        while not self.__stop:
+          self.run_pending()
+          timeout = self.__heap[0][0] - self.clock() if self.__heap else None
+          self.__condition.wait(timeout)
+    self.__thread = threading.Thread(target=run, name="token-scheduler", daemon=True)
+    self.__thread.start()
+
+  def stop(self) -> None:
+    """Stops the scheduler thread; refreshes that already started still finish"""
+    with self.__condition:
+      self.__stop = True
+      self.__condition.notify()
+    if self.__thread is not None:
+      self.__thread.join()
+      self.__thread = None
+
+  def close(self) -> None:
+    """Stops the scheduler thread and waits for running refreshes"""
+    self.stop()
+    self.__pool.shutdown(wait=True)
@@ -0,0 +1,206 @@
+"""
+Span-based tracing of API calls and composite operations
+
+A Tracer records nested spans with timings and attributes. fitbit.API creates a span for every
+request (endpoint template, user, status, bytes), for decoding the response and for token
+requests; composite operations such as day_snapshot and the write queue wrap their calls in
+parent spans and record queue waits and retry counts. Finished spans go to a pluggable exporter,
+e.g. an in-memory list or a JSON lines file, and critical_path() explains where the time of an
+operation went:
+
+  tracer = Tracer(InMemoryExporter())
+  api = fitbit.API(tracer=tracer, ...)
+  api.day_snapshot("2021-09-08")
+  print(critical_path(tracer.exporter.spans))
+"""
+import re, json, time, uuid, threading, contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("fitbit_span", default=None)
+
+_VERSION = re.compile(r"/\d+(\.\d+)?")
+_DATE = re.compile(r"/\d{4}-\d{2}-\d{2}(?=[/.])")
+_ID = re.compile(r"/\d+(?=[/.])")
+_TIME = re.compile(r"/time/\d{2}:\d{2}/\d{2}:\d{2}")
+
+def endpoint_template(path: str, user_id: str = None) -> str:
+  """
+  Returns the template of a request path with the user ID, dates, times and numeric IDs replaced by
+  placeholders, e.g. /1/user/{user_id}/activities/date/{date}.json
+
+  Parameters:
+    path: The path of the request
+    user_id: (optional) The user ID to replace
+  """
+  version = _VERSION.match(path)
+  prefix, path = (version.group(0), path[version.end():]) if version else ("", path)
+  if user_id:
+    path = path.replace(f"user/{user_id}/", "user/{user_id}/")
+  path = _TIME.sub("/time/{start_time}/{end_time}", path)
+  return prefix + _ID.sub("/{id}", _DATE.sub("/{date}", path))
+
+class Span:
+
+  __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "thread")
+
+  def __init__(self, name: str, parent: "Span" = None, attributes: dict = None):
+    self.name = name
+    self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+    self.span_id = uuid.uuid4().hex[:16]
+    self.parent_id = parent.span_id if parent is not None else None
+    self.start = time.time()
+    self.end = None
+    self.attributes = dict(attributes or {})
+    self.thread = threading.current_thread().name
+
+  @property
+  def duration(self) -> float:
+    return (self.end if self.end is not None else time.time()) - self.start
+
+  def set(self, key: str, value) -> None:
+    """Sets an attribute of the span"""
+    self.attributes[key] = value
+
+  def to_dict(self) -> dict:
+    return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+      "start": self.start, "end": self.end, "duration": self.duration, "thread": self.thread, "attributes": self.attributes}
+
+  @classmethod
+  def from_dict(cls, data: dict) -> "Span":
+    span = cls.__new__(cls)
+    for key in cls.__slots__:
+      setattr(span, key, data[key])
+    return span
+
+  def __repr__(self) -> str:
+    return f"Span({self.name!r}, duration={self.duration:.6f}, attributes={self.attributes})"
+
+class InMemoryExporter:
+  """Keeps finished spans in the spans list"""
+
+  def __init__(self):
+    self.spans = []
+    self.__lock = threading.Lock()
+
+  def export(self, span: Span) -> None:
+    with self.__lock:
+      self.spans.append(span)
+
+  def clear(self) -> None:
+    with self.__lock:
+      self.spans.clear()
+
+class JSONLinesExporter:
+  """Appends finished spans to a JSON lines file"""
+
+  def __init__(self, path: str):
+    self.path = path
+    self.__lock = threading.Lock()
+    self.__file = open(path, "a", encoding="utf-8")
+
+  def export(self, span: Span) -> None:
+    line = json.dumps(span.to_dict(), default=str) + "\n"
+    with self.__lock:
+      self.__file.write(line)
+      self.__file.flush()
+
+  def close(self) -> None:
+    with self.__lock:
+      self.__file.close()
+
+def load(path: str) -> list:
+  """Returns the spans of a file written by JSONLinesExporter"""
+  with open(path, encoding="utf-8") as file:
+    return [Span.from_dict(json.loads(line)) for line in file if line.strip()]
+
+class Tracer:
+
+  def __init__(self, exporter=None):
+    """
+    Parameters:
+      exporter: (optional) An object with an export(span) method, an InMemoryExporter by default
+    """
+    self.exporter = exporter if exporter is not None else InMemoryExporter()
+
+  @contextmanager
+  def span(self, name: str, **attributes):
+    """
+    Starts a span that is a child of the current span of this thread or context, makes it the current
+    span until the block exits, and exports it when it ends
+
+    Parameters:
+      name: The name of the operation
+      attributes: Initial attributes of the span
+    """
+    span = Span(name, _current.get(), attributes)
+    token = _current.set(span)
+    try:
+      yield span
+    except BaseException as error:
+      span.set("error", repr(error))
+      raise
+    finally:
+      span.end = time.time()
+      _current.reset(token)
+      self.exporter.export(span)
+
+  def request_span(self, method: str, path: str, user_id: str = None):
+    """
+    Starts the span of one HTTP request, named after its method and endpoint template
+
+    Parameters:
+      method: The HTTP method
+      path: The path of the request
+      user_id: (optional) The user the request is made for
+    """
+    template = endpoint_template(path, user_id)
+    return self.span(f"{method} {template}", kind="http", method=method, endpoint=template, user=user_id)
+
+  @staticmethod
+  def current() -> Span:
+    """Returns the current span, or None"""
+    return _current.get()
+
+  @staticmethod
+  def propagate(function):
+    """
+    Returns a function that runs in a copy of the caller's context, so that spans it creates on
+    another thread, e.g. in a ThreadPoolExecutor, are children of the caller's current span
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def _children(spans: list) -> dict:
+  children = {}
+  for span in spans:
+    children.setdefault(span.parent_id, []).append(span)
+  return children
+
+def _walk(span: Span, children: dict, breakdown: dict, path: list) -> None:
+  path.append(span)
+  cursor = span.end
+  # Walk back from the end of the span, always following the child that finished last
+  for child in sorted(children.get(span.span_id, []), key=lambda child: child.end, reverse=True):
+    if child.end > cursor:
+      continue
+    breakdown[span.name] = breakdown.get(span.name, 0.0) + cursor - child.end
+    _walk(child, children, breakdown, path)
+    cursor = child.start
+  breakdown[span.name] = breakdown.get(span.name, 0.0) + max(0.0, cursor - span.start)
+
+def critical_path(spans: list, root: Span = None) -> dict:
+  """
+  Returns the critical path of an operation: the chain of spans that determined when it finished, and
+  the time on that chain attributed to each span name (time not covered by a child on the path)
+
+  Parameters:
+    spans: The finished spans of one or more operations
+    root: (optional) The root span of the operation, by default the longest span without a parent
+  """
+  children = _children(spans)
+  if root is None:
+    root = max(children.get(None, []), key=lambda span: span.duration)
+  breakdown, path = {}, []
+  _walk(root, children, breakdown, path)
+  return {"operation": root.name, "duration": root.duration, "path": [span.name for span in path],
+    "breakdown": dict(sorted(breakdown.items(), key=lambda item: item[1], reverse=True))}
@@ -1,9 +1,61 @@
+import os
 import json
 import fitbit
+import cassette
+import records
+import sleep_stages
+import food_index
+import write_queue
+import intraday_cache
+import resample
+import stub_server
+import tracing
+import heart_rate
+import semantic_cache
+import token_scheduler
+import load_test
+import endpoints
+import timeit
+import inspect
+import sync_workers
+import json_stream
+import priority
+import planner
+import concurrency
+import export
+import history_store
+import query_engine
+import subscriptions
+import io
+import gzip
+import csv
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+try:
+    import arrow_export
+except ImportError:
+    arrow_export = None
+import numpy as np
 import unittest
 import requests
 
-api = fitbit.API(debug=True)
+# Set fitbit_cassette to record the session to a cassette file, or to replay it offline if the file exists
+cassette_path = os.environ.get("fitbit_cassette")
+recorder = None
+if cassette_path and os.path.exists(cassette_path):
+    api = fitbit.API(debug=True, transport=cassette.Player(cassette_path, repeat=True), access_token="replay", refresh_token="replay")
+elif cassette_path:
+    recorder = cassette.Recorder(cassette_path)
+    api = fitbit.API(debug=True, transport=recorder)
+    recorder.user_ids.add(api.user_id)
+else:
+    api = fitbit.API(debug=True)
+
+def tearDownModule():
+    if recorder is not None:
+        recorder.close()
 
 def log(res):
     print(json.dumps(json.loads(res.text), indent=1))
@@ -167,6 +219,13 @@ class FitbitTestMethods(unittest.TestCase):
     def test_update_water_log(self):
         pass
 
+    def test_write_queue(self):
+        queue = write_queue.WriteQueue(api, ":memory:")
+        entry_id = queue.log_water("2021-09-08", 8)
+        queue.drain()
+        self.assertEqual(queue.status(entry_id)["status"], write_queue.DONE)
+        self.res = api.water_logs("2021-09-08")
+
     def test_favorite_foods(self):
         pass
 
@@ -279,5 +338,1029 @@ class FitbitTestMethods(unittest.TestCase):
     def test_update_profile(self):
         pass
 
+    """Composite"""
+    def test_day_snapshot(self):
+        snapshot = api.day_snapshot("2021-09-08")
+        self.assertTrue(snapshot.complete)
+        self.res = snapshot.activity
+
+class CassetteTestMethods(unittest.TestCase):
+
+    def test_record_crash_and_replay(self):
+        path = os.path.join(tempfile.mkdtemp(), "session.jsonl.gz")
+        with stub_server.StubServer(latency=0.05) as stub:
+            tokens = stub.issue("ABC123")
+            # A pre-authorized API: the user ID only appears in request paths and response bodies
+            recorder = cassette.Recorder(path, stub.transport())
+            recorded = fitbit.API(transport=recorder, user_id=tokens.user_id, access_token=tokens.access_token, refresh_token=tokens.refresh_token)
+            recorded.profile()
+            time.sleep(0.2)
+            recorded.badges()
+        # The process dies while writing an entry, without closing the recorder
+        with open(path, "ab") as file:
+            file.write(gzip.compress(b'{"key": "GET /1/user/-/devices.json?"}\n')[:20])
+        entries = cassette.load(path)
+        self.assertEqual(len(entries), 2)
+        self.assertNotIn("ABC123", json.dumps(entries))
+        player = cassette.Player(path, realtime=True)
+        replayed = fitbit.API(transport=player, user_id="XYZ789", access_token="replay")
+        started = time.perf_counter()
+        self.assertEqual(replayed.profile()["user_id"], "-")
+        replayed.badges()
+        # The pause between the recorded requests is reproduced, not only their latencies
+        self.assertGreater(time.perf_counter() - started, 0.28)
+        self.assertEqual(player.remaining(), 0)
+
+class RecordsTestMethods(unittest.TestCase):
+
+    def test_sleep_logs(self):
+        logs = records.sleep_logs({"sleep": [{"logId": 1, "dateOfSleep": "2021-09-08", "type": "stages",
+            "levels": {"data": [{"dateTime": "2021-09-07T23:23:30.000", "level": "wake", "seconds": 30}], "shortData": []}}]})
+        self.assertEqual(logs[0].log_id, 1)
+        self.assertEqual(logs[0].stages[0].level, "wake")
+        self.assertFalse(hasattr(logs[0], "__dict__"))
+
+    def test_body_logs(self):
+        logs = records.body_logs({"fat": [{"logId": 2, "date": "2021-09-08", "time": "12:30:01", "fat": 20.5, "source": "API"}]})
+        self.assertEqual(logs[0].fat, 20.5)
+        self.assertIsNone(logs[0].weight)
+
+class SleepStagesTestMethods(unittest.TestCase):
+
+    def test_decode_merges_short_wakes(self):
+        timeline = sleep_stages.decode({"logId": 1, "startTime": "2021-09-07T23:00:00.000", "levels": {
+            "data": [{"dateTime": "2021-09-07T23:00:00.000", "level": "light", "seconds": 600},
+                {"dateTime": "2021-09-07T23:10:00.000", "level": "deep", "seconds": 600}],
+            "shortData": [{"dateTime": "2021-09-07T23:05:00.000", "level": "wake", "seconds": 60}]}})
+        self.assertEqual(timeline.offsets.tolist(), [0, 300, 360, 600])
+        self.assertEqual(timeline.totals_by_name(), {"wake": 60, "light": 540, "deep": 600})
+        self.assertEqual(sleep_stages.cohort_totals([timeline, timeline]).sum(), 2400)
+
+class FoodIndexTestMethods(unittest.TestCase):
+
+    def test_lookup_ranks_exact_and_popular_foods_first(self):
+        index = food_index.FoodIndex()
+        index.add_response({"foods": [{"foodId": 1, "name": "Chicken Breast"}, {"foodId": 2, "name": "Chicken Soup"},
+            {"foodId": 3, "name": "Chicken"}]})
+        index.add_response([{"foodId": 2, "name": "Chicken Soup"}], weight=1)
+        self.assertEqual([food["foodId"] for food in index.lookup("chick")], [2, 3, 1])
+        self.assertEqual([food["foodId"] for food in index.lookup("chicken")], [3, 2, 1])
+        self.assertEqual(index.lookup("soup bre"), [])
+
+    def test_renamed_food_loses_old_tokens(self):
+        index = food_index.FoodIndex()
+        index.add([{"foodId": 1, "name": "Oat Milk", "brand": "Oatly"}, {"foodId": 2, "name": "Oat Bar"}])
+        index.add([{"foodId": 1, "name": "Soy Milk"}])
+        self.assertEqual([food["foodId"] for food in index.lookup("oat")], [2])
+        self.assertEqual(index.lookup("oatly"), [])
+        self.assertEqual([food["foodId"] for food in index.lookup("soy milk")], [1])
+        self.assertEqual(index._FoodIndex__tokens, ["bar", "milk", "oat", "soy"])
+
+    def test_refresh_failure_is_kept(self):
+        called = threading.Event()
+        class FailingAPI:
+            debug = False
+            def recent_foods(self):
+                called.set()
+                raise requests.ConnectionError("offline")
+        index = food_index.FoodIndex()
+        index.start_refresh(FailingAPI(), interval=60)
+        called.wait(5)
+        index.stop_refresh()
+        self.assertIsInstance(index.error, requests.ConnectionError)
+
+class WriteQueueTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = stub_server.StubServer().start()
+        self.tokens = self.stub.issue()
+        self.forward = self.stub.transport()
+        self.logs, self.failures, self.lookups = [], [], 0
+        self.api = fitbit.API(debug=True, transport=self.transport, user_id=self.tokens.user_id,
+            access_token=self.tokens.access_token, refresh_token=self.tokens.refresh_token)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    @staticmethod
+    def response(status, body):
+        response = requests.Response()
+        response.status_code, response._content = status, json.dumps(body).encode("utf-8")
+        return response
+
+    def transport(self, method, url, **kwargs):
+        # The stub authorizes the request, then water logs are kept here
+        res = self.forward(method, url, **kwargs)
+        if res.status_code != 200 or "/foods/log/water" not in url:
+            return res
+        if method == "GET":
+            self.lookups += 1
+            return self.response(200, {"water": list(self.logs)})
+        failure = self.failures.pop(0) if self.failures else None
+        if failure in (429, 500):
+            return self.response(failure, {"errors": [{"errorType": "system", "message": "failure"}], "success": False})
+        log = {"logId": len(self.logs) + 1, "amount": kwargs["params"]["amount"]}
+        self.logs.append(log)
+        if failure == "lost":
+            raise requests.ConnectionError("connection reset after the log was created")
+        return self.response(201, {"waterLog": log})
+
+    def test_order_backoff_and_refresh(self):
+        queue = write_queue.WriteQueue(self.api, ":memory:", max_backoff=0.0)
+        entries = [queue.log_water("2021-09-08", amount) for amount in (1, 2, 3)]
+        del self.stub.access_tokens[self.tokens.access_token]
+        self.failures = [429, 500]
+        queue.drain()
+        self.assertEqual([log["amount"] for log in self.logs], [1, 2, 3])
+        self.assertEqual([queue.status(entry)["status"] for entry in entries], [write_queue.DONE] * 3)
+        # 401 and refresh, 429, 500, then logged; only the 500 left the outcome unknown
+        self.assertEqual(queue.status(entries[0])["attempts"], 4)
+        self.assertEqual(self.lookups, 1)
+        self.assertNotEqual(self.api.access_token, self.tokens.access_token)
+        self.failures = [500]
+        queue = write_queue.WriteQueue(self.api, ":memory:")
+        entry = queue.log_water("2021-09-08", 4)
+        queue.drain()
+        self.assertEqual(queue.status(entry)["status"], write_queue.PENDING)
+        self.assertEqual(queue.pending(), 1)
+
+    def test_lost_response_is_not_logged_twice(self):
+        queue = write_queue.WriteQueue(self.api, ":memory:", max_backoff=0.0)
+        first = queue.log_water("2021-09-08", 8)
+        queue.drain()
+        self.failures = ["lost"]
+        second = queue.log_water("2021-09-08", 8)
+        queue.drain()
+        self.assertEqual(len(self.logs), 2)
+        self.assertEqual(self.lookups, 1)
+        self.assertEqual(queue.status(first)["result"]["waterLog"]["logId"], 1)
+        self.assertEqual(queue.status(second)["status"], write_queue.DONE)
+        self.assertEqual(queue.status(second)["result"]["logId"], 2)
+
+    def test_invalid_entries_are_rejected_on_submit(self):
+        queue = write_queue.WriteQueue(self.api, ":memory:")
+        with self.assertRaises(TypeError):
+            queue.log_water("2021-09-08")
+        with self.assertRaises(ValueError):
+            queue.log_water("2021-09-08", 8, "gallon")
+        self.assertEqual(queue.pending(), 0)
+
+class IntradayCacheTestMethods(unittest.TestCase):
+
+    def test_store_and_view_days(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = intraday_cache.IntradayCache(root)
+            cache.store("U", "steps", "1min", "2021-09-08", {"activities-steps-intraday": {"dataset": [
+                {"time": "00:00:00", "value": 3}, {"time": "00:02:00", "value": 7}]}}, complete=True)
+            values = cache.values("U", "steps", "1min", "2021-09-07", "2021-09-08")
+            self.assertEqual(values.shape, (2, 1440))
+            self.assertEqual(values[1, :3].tolist(), [3, 0, 7])
+            self.assertEqual(cache.present("U", "steps", "1min", "2021-09-08", "2021-09-08").sum(), 2)
+            self.assertEqual(cache.missing_days("U", "steps", "1min", "2021-09-07", "2021-09-09"), ["2021-09-07", "2021-09-09"])
+            cache.close()
+
+    def test_day_fetched_before_sync_is_not_complete(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = intraday_cache.IntradayCache(root)
+            dataset = {"activities-steps-intraday": {"dataset": [{"time": "00:00:00", "value": 3}, {"time": "21:30:00", "value": 1}]}}
+            synced = intraday_cache.last_sync([{"lastSyncTime": "2021-09-10T07:58:00.000"}, {"lastSyncTime": "2021-09-09T22:10:00.000"}])
+            # Fetched on the day itself, or without a known sync, a day is fetched again
+            cache.store("U", "steps", "5min", "2021-09-07", dataset)
+            cache.store("U", "steps", "5min", "2021-09-10", dataset, synced=synced)
+            # A day the trackers synced after is complete, though no reading reaches midnight
+            cache.store("U", "steps", "5min", "2021-09-09", dataset, synced=synced)
+            self.assertEqual(cache.missing_days("U", "steps", "5min", "2021-09-07", "2021-09-10"), ["2021-09-07", "2021-09-08", "2021-09-10"])
+            self.assertEqual(cache.values("U", "steps", "5min", "2021-09-09", "2021-09-09").shape, (1, 288))
+            cache.close()
+
+class ResampleTestMethods(unittest.TestCase):
+
+    def test_resample_sum_and_mean(self):
+        values = np.arange(1440, dtype="f4")
+        present = np.ones(1440, bool)
+        present[1:15] = False
+        sums, sum_present = resample.resample(values, present, "1min", "15min", "sum")
+        means, _ = resample.resample(values, present, "1min", "15min", "mean")
+        self.assertEqual(sums.shape, (96,))
+        self.assertEqual(sums[0], 0)
+        self.assertEqual(sums[1], sum(range(15, 30)))
+        self.assertEqual(means[1], 22)
+        self.assertTrue(sum_present.all())
+
+    def test_resample_rejects_finer_levels(self):
+        with self.assertRaises(ValueError):
+            resample.resample(np.zeros(96), np.ones(96, bool), "15min", "1min", "sum")
+
+@unittest.skipIf(arrow_export is None, "pyarrow is not installed")
+class ArrowExportTestMethods(unittest.TestCase):
+
+    def test_activity_time_series_table(self):
+        table = arrow_export.activity_time_series_table({"activities-steps": [
+            {"dateTime": "2021-09-01", "value": "1000"}, {"dateTime": "2021-09-02", "value": "2500"}]})
+        self.assertEqual(str(table.schema.field("date").type), "date32[day]")
+        self.assertEqual(table.column("value").to_pylist(), [1000, 2500])
+
+    def test_concat_keeps_chunks(self):
+        table = arrow_export.heart_rate_intraday_table({"activities-heart-intraday": {"dataset": [
+            {"time": "00:00:01", "value": 60}, {"time": "12:00:00", "value": 90}]}}, "2021-09-08")
+        combined = arrow_export.concat([table, table])
+        self.assertEqual(combined.num_rows, 4)
+        self.assertEqual(combined.column("time").num_chunks, 2)
+
+class ThreadSafetyTestMethods(unittest.TestCase):
+
+    def test_shared_instance_under_load(self):
+        with stub_server.StubServer(rate_limit=10**6) as stub:
+            tokens = stub.issue()
+            shared = fitbit.API(transport=stub.transport(), user_id=tokens.user_id,
+                access_token=tokens.access_token, refresh_token=tokens.refresh_token)
+
+            def worker(thread):
+                for call in range(40):
+                    if call % 10 == thread % 10:
+                        shared.refresh()
+                    body = shared.profile()
+                    self.assertEqual(body["user_id"], tokens.user_id)
+                    self.assertEqual(body["path"], f"/1/user/{tokens.user_id}/profile.json")
+
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                list(pool.map(worker, range(32)))
+            self.assertEqual(stub.refresh_tokens[tokens.user_id], shared.refresh_token)
+            self.assertEqual(stub.access_tokens[shared.access_token], tokens.user_id)
+
+    def test_credentials_swap_together(self):
+        with stub_server.StubServer() as stub:
+            tokens = stub.issue()
+            shared = fitbit.API(transport=stub.transport(), user_id=tokens.user_id,
+                access_token=tokens.access_token, refresh_token=tokens.refresh_token, expires_at=0.0)
+            self.assertEqual(shared.credentials, (tokens, 0.0))
+            shared.refresh()
+            refreshed, expires_at = shared.credentials
+            self.assertNotEqual(refreshed, tokens)
+            self.assertGreater(expires_at, time.time() + 28000)
+        # With an injected transport no session and connection pool is created
+        self.assertIsNone(shared._API__session)
+
+class DaySnapshotTestMethods(unittest.TestCase):
+
+    def test_rate_limited_part_is_a_failure(self):
+        with stub_server.StubServer() as stub:
+            tokens = stub.issue()
+            forward = stub.transport()
+            def transport(method, url, **kwargs):
+                if "/foods/log/water/" in url:
+                    response = requests.Response()
+                    response.status_code = 429
+                    response._content = b'{"errors": [{"errorType": "system", "message": "Too Many Requests"}], "success": false}'
+                    return response
+                return forward(method, url, **kwargs)
+            for debug in (False, True):
+                snapshot = fitbit.API(debug=debug, transport=transport, user_id=tokens.user_id,
+                    access_token=tokens.access_token, refresh_token=tokens.refresh_token).day_snapshot("2021-09-08")
+                self.assertFalse(snapshot.complete)
+                self.assertEqual(list(snapshot.errors), ["water"])
+                self.assertIsNone(snapshot.water)
+                self.assertIsNotNone(snapshot.activity)
+
+class TracingTestMethods(unittest.TestCase):
+
+    def test_day_snapshot_spans(self):
+        with stub_server.StubServer(latency=0.01) as stub:
+            tokens = stub.issue()
+            tracer = tracing.Tracer(tracing.InMemoryExporter())
+            traced = fitbit.API(transport=stub.transport(), user_id=tokens.user_id,
+                access_token=tokens.access_token, refresh_token=tokens.refresh_token, tracer=tracer)
+            traced.day_snapshot("2021-09-08")
+        spans = {span.span_id: span for span in tracer.exporter.spans}
+        requests_spans = [span for span in spans.values() if span.attributes.get("kind") == "http"]
+        self.assertEqual(len(requests_spans), 6)
+        for span in requests_spans:
+            self.assertEqual(spans[spans[span.parent_id].parent_id].name, "day_snapshot")
+        self.assertIn("/1.2/user/{user_id}/sleep/date/{date}.json", {span.attributes["endpoint"] for span in requests_spans})
+        path = tracing.critical_path(tracer.exporter.spans)
+        self.assertEqual(path["operation"], "day_snapshot")
+        self.assertEqual(path["path"][0], "day_snapshot")
+
+class HeartRateTestMethods(unittest.TestCase):
+
+    def test_time_in_zones_and_trimp(self):
+        times = np.arange(0, 600, 1)
+        bpm = np.concatenate([np.full(300, 80, np.float32), np.full(300, 160, np.float32)])
+        bounds = heart_rate.zones(200)
+        seconds = heart_rate.time_in_zones(times, bpm, bounds)
+        self.assertEqual(seconds.tolist(), [300, 0, 0, 0, 300, 0])
+        self.assertEqual(heart_rate.edwards_trimp(times, bpm, bounds), 20)
+        self.assertGreater(heart_rate.banister_trimp(times, bpm, 200, 60), 0)
+
+    def test_recovery(self):
+        times = np.arange(0, 300, 1)
+        bpm = np.concatenate([np.full(100, 170, np.float32), np.linspace(170, 110, 200, dtype=np.float32)])
+        result = heart_rate.recovery(times, bpm, 0, 100)
+        self.assertEqual(result["peak"], 170)
+        self.assertAlmostEqual(result[60], 60 * 60 / 199, places=3)
+
+class SemanticCacheTestMethods(unittest.TestCase):
+
+    class FakeAPI:
+        debug = False
+        user_id = "ABC123"
+
+        def __init__(self):
+            self.calls = []
+
+        def activity_time_series(self, resource_path, base_date, end_or_period, use_tracker=False):
+            self.calls.append("activity_time_series")
+            start, end = semantic_cache.date_range(base_date, end_or_period)
+            days = semantic_cache._days(start, end)
+            return {f"activities-{resource_path}": [{"dateTime": day.isoformat(), "value": str(day.day)} for day in days]}
+
+        def activity_summary(self, date):
+            self.calls.append("activity_summary")
+            return {"summary": {"steps": 1234, "distances": [{"activity": "total", "distance": 3.2}]}}
+
+        def sleep_logs_range(self, base_date, end_date):
+            self.calls.append("sleep_logs_range")
+            return {"sleep": [{"dateOfSleep": "2021-09-08", "isMainSleep": True, "minutesAsleep": 400, "timeInBed": 450}]}
+
+        def sleep_log(self, date):
+            self.calls.append("sleep_log")
+            return {"sleep": []}
+
+        def log_activity(self, activity_id, id_type, manual_calories, start_time, duration_millis, date, distance):
+            self.calls.append("log_activity")
+
+        def log_sleep(self, start_time, duration, date):
+            self.calls.append("log_sleep")
+
+    def test_derived_answers(self):
+        api = self.FakeAPI()
+        cache = semantic_cache.SemanticCache(api)
+        cache.activity_time_series("steps", "2021-09-30", "1m")
+        res = cache.activity_time_series("steps", "2021-09-10", "2021-09-12")
+        self.assertEqual([entry["value"] for entry in res["activities-steps"]], ["10", "11", "12"])
+        self.assertEqual(cache.activity_value("steps", "2021-09-05"), "5")
+        self.assertEqual(cache.activity_value("distance", "2021-09-05"), "3.2")
+        self.assertEqual(cache.activity_time_series("distance", "2021-09-05", "1d")["activities-distance"][0]["value"], "3.2")
+        cache.sleep_logs_range("2021-09-01", "2021-09-10")
+        self.assertEqual(cache.sleep_log("2021-09-08")["summary"]["totalMinutesAsleep"], 400)
+        self.assertEqual(cache.sleep_log("2021-09-07")["sleep"], [])
+        self.assertEqual(api.calls, ["activity_time_series", "activity_summary", "sleep_logs_range"])
+
+    def test_invalidation(self):
+        api = self.FakeAPI()
+        cache = semantic_cache.SemanticCache(api)
+        cache.activity_time_series("steps", "2021-09-30", "1m")
+        cache.log_activity(90013, "activityId", 100, "10:00", 600000, "2021-09-10", 1.0)
+        cache.activity_time_series("steps", "2021-09-11", "1d")
+        cache.activity_time_series("steps", "2021-09-10", "1d")
+        cache.sleep_logs_range("2021-09-01", "2021-09-10")
+        cache.notify([{"collectionType": "sleep", "date": "2021-09-08", "ownerId": "ABC123"}])
+        cache.sleep_log("2021-09-08")
+        # A sleep logged at night on 2021-09-08 ends on the 9th, the day it is filed under
+        cache.log_sleep("23:30", 28800000, "2021-09-08")
+        cache.sleep_log("2021-09-09")
+        cache.sleep_log("2021-09-10")
+        self.assertEqual(api.calls, ["activity_time_series", "log_activity", "activity_time_series", "sleep_logs_range", "sleep_log",
+            "log_sleep", "sleep_log"])
+
+    def test_errors_are_not_cached(self):
+        with stub_server.StubServer(rate_limit=0) as stub:
+            tokens = stub.issue()
+            for debug in (False, True):
+                cache = semantic_cache.SemanticCache(fitbit.API(debug=debug, transport=stub.transport(), user_id=tokens.user_id,
+                    access_token=tokens.access_token, refresh_token=tokens.refresh_token))
+                for _ in range(2):
+                    self.assertIn("errors", cache.activity_time_series("steps", "2021-09-01", "2021-09-07"))
+                    self.assertIn("errors", cache.activity_summary("2021-09-08"))
+                    self.assertIn("errors", cache.sleep_logs_range("2021-09-01", "2021-09-07"))
+                    self.assertIn("errors", cache.sleep_log("2021-09-08"))
+            # Every call reached the server: nothing was served from a cached 429
+            self.assertEqual(stub.requests[tokens.user_id], 16)
+
+class TokenSchedulerTestMethods(unittest.TestCase):
+
+    def test_refresh_before_expiry(self):
+        now = [time.time()]
+        with stub_server.StubServer() as stub:
+            apis = []
+            for _ in range(20):
+                tokens = stub.issue()
+                apis.append(fitbit.API(transport=stub.transport(), user_id=tokens.user_id, access_token=tokens.access_token,
+                    refresh_token=tokens.refresh_token, expires_at=now[0] + 1))
+            stub.refresh_tokens[apis[0].user_id] = "revoked"
+            old = [api.access_token for api in apis]
+            refreshed, revoked = [], []
+            scheduler = token_scheduler.TokenScheduler(margin=0.5, jitter=0.3, on_refresh=refreshed.append,
+                on_revoked=lambda api, error: revoked.append(api), clock=lambda: now[0])
+            for api in apis:
+                scheduler.add(api)
+            self.assertEqual(scheduler.run_pending(), 0)
+            now[0] += 0.5
+            self.assertEqual(scheduler.run_pending(), 20)
+            scheduler.close()
+        self.assertEqual(len(refreshed), 19)
+        self.assertEqual(revoked, [apis[0]])
+        self.assertEqual(scheduler.revoked(), [apis[0].user_id])
+        self.assertTrue(all(api.access_token != token for api, token in zip(apis[1:], old[1:])))
+        self.assertGreater(scheduler.next_refresh(apis[1].user_id), now[0] + 27000)
+
+    def test_failed_refresh_is_retried(self):
+        now = [time.time()]
+        with stub_server.StubServer() as stub:
+            tokens = stub.issue()
+            def transport(method, url, **kwargs):
+                # Wrong app credentials are rejected with a 401 that does not revoke the user's grant
+                res = requests.Response()
+                res.status_code = 401
+                res._content = json.dumps({"errors": [{"errorType": "invalid_client", "message": "Invalid client"}]}).encode()
+                return res
+            api = fitbit.API(transport=transport, user_id=tokens.user_id, access_token=tokens.access_token,
+                refresh_token=tokens.refresh_token, expires_at=now[0])
+            scheduler = token_scheduler.TokenScheduler(margin=0, jitter=0, retry=30, clock=lambda: now[0])
+            scheduler.add(api)
+            self.assertEqual(scheduler.run_pending(), 1)
+            scheduler.close()
+        self.assertFalse(scheduler.errors[api.user_id].revoked)
+        self.assertEqual(scheduler.status[api.user_id], token_scheduler.SCHEDULED)
+        self.assertEqual(scheduler.revoked(), [])
+        self.assertEqual(scheduler.next_refresh(api.user_id), now[0] + 30)
+
+class LoadTestTestMethods(unittest.TestCase):
+
+    def test_step_metrics(self):
+        with stub_server.StubServer(rate_limit=20) as stub:
+            tokens = [tuple(stub.issue()) for _ in range(4)]
+            started = time.time()
+            result = load_test.run(4, 1.0, tokens, stub.url, rate_limit=20)
+        self.assertEqual(result["users"], 4)
+        self.assertEqual(result["errors"], 0)
+        # Every user waits for its budget to reset after its first 429, which is past the end of the step
+        self.assertEqual(result["ok"], 80)
+        self.assertEqual(result["rate_limited"], 4)
+        self.assertGreaterEqual(time.time() - started, 1.0)
+        self.assertLessEqual(result["user_days_per_hour"], 4 * 20 / load_test.REQUESTS_PER_DAY)
+        self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+class EndpointsTestMethods(unittest.TestCase):
+
+    SAMPLES = {"date": "2021-09-08", "date_or_today": "2021-09-08", "date_time": "2021-09-08", "end_or_period": "7d",
+        "end_or_log_period": "7d", "end_or_1d": "1d", "time": "10:00", "time_seconds": "10:00:00", "limit": 10}
+
+    def setUp(self):
+        self.sent = []
+        def transport(method, url, **kwargs):
+            self.sent.append((method, url[len(fitbit.API.base_url):]))
+            response = requests.Response()
+            response.status_code, response._content = 200, b"{}"
+            return response
+        self.api = fitbit.API(transport=transport, user_id="ABC123", access_token="token")
+
+    def test_paths_match_registry(self):
+        for name, endpoint in endpoints.ENDPOINTS.items():
+            method = getattr(fitbit.API, name)
+            arguments = {}
+            for param in list(inspect.signature(method).parameters)[1:]:
+                rule = endpoint.params.get(param)
+                arguments[param] = rule[-1] if isinstance(rule, tuple) else self.SAMPLES.get(rule, "123")
+            getattr(self.api, name)(**arguments)
+            self.assertIs(endpoints.match(*self.sent[-1]), endpoint, self.sent[-1])
+        self.api.activity_time_series("steps", "2021-09-01", "2021-09-08", use_tracker=True)
+        self.api.heart_rate_intraday("2021-09-08", "1d", "1sec", "10:00", "11:00")
+        self.api.subscriptions("")
+        for (method, path), name in zip(self.sent[-3:], ["activity_time_series", "heart_rate_intraday", "subscriptions"]):
+            self.assertEqual(endpoints.match(method, path).name, name)
+        self.assertEqual(self.sent[-3][1], "/1/user/ABC123/activities/tracker/steps/date/2021-09-01/2021-09-08.json")
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            self.api.activity_intraday("steps", "2021-09-08", "1d", "1mn")
+        with self.assertRaises(ValueError):
+            self.api.activity_time_series("step", "2021-09-08", "7d")
+        with self.assertRaises(ValueError):
+            self.api.sleep_logs_range("2021-01-01", "2021-06-01")
+        with self.assertRaises(ValueError):
+            self.api.activity_log_list("2021-09-08", "before", "desc", 500)
+        with self.assertRaises(ValueError):
+            self.api.body_time_series("weight", "2021-02-30", "7d")
+        with self.assertRaises(ValueError):
+            self.api.body_logs("weight", "2021-09-08", "3m")
+        self.assertEqual(self.sent, [])
+        self.api.body_logs("weight", "2021-09-08", "1m")
+        self.api.update_activity_goals("daily", "activeZoneMinutes", "22")
+        self.api.activity_intraday("steps", "2021-09-08", "1d", "5min")
+        self.assertEqual(len(self.sent), 3)
+        endpoint = endpoints.ENDPOINTS["activity_intraday"]
+        seconds = timeit.timeit(lambda: endpoint.validate({"resource_path": "steps", "base_date": "2021-09-08", "end_or_1d": "1d", "detail_level": "1min"}), number=1000) / 1000
+        self.assertLess(seconds, 0.001)
+
+    def test_split_range(self):
+        chunks = endpoints.split_range("sleep_logs_range", "2021-01-01", "2021-12-31")
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(chunks[0], ("2021-01-01", "2021-04-10"))
+        self.assertEqual(chunks[-1][1], "2021-12-31")
+
+class SyncWorkersTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "sync.db")
+        coordinator = sync_workers.Coordinator(self.path)
+        for index in range(60):
+            coordinator.add_user(fitbit.Tokens(f"U{index:03d}", "access", "refresh"))
+        coordinator.close()
+        self.synced = []
+
+    def sync(self, api, checkpoint):
+        self.synced.append(api.user_id)
+        checkpoint.set("rounds", checkpoint.get("rounds", 0) + 1)
+
+    def test_each_user_owned_by_one_worker(self):
+        workers = [sync_workers.Worker(self.path, self.sync, worker_id=f"w{index}") for index in range(3)]
+        shares = [set(worker.run_once()) for worker in workers]
+        self.assertEqual(sorted(self.synced), sorted(set(self.synced)))
+        self.assertEqual(len(self.synced), 60)
+        self.assertTrue(all(len(share) > 5 for share in shares))
+        # Leaving moves only the users of the worker that left
+        workers[2].leave()
+        self.synced.clear()
+        moved = [set(worker.run_once()) for worker in workers[:2]]
+        self.assertTrue(shares[0] <= moved[0] and shares[1] <= moved[1])
+        self.assertEqual(moved[0] | moved[1], shares[0] | shares[1] | shares[2])
+        self.assertEqual(workers[0].coordinator.checkpoint(next(iter(shares[0]))).get("rounds"), 2)
+
+    def test_heartbeat_during_long_sync(self):
+        seen = []
+        def sync(api, checkpoint):
+            # A sync longer than the timeout must not drop the worker from the ring or lose its lease
+            time.sleep(0.5)
+            observer = sync_workers.Coordinator(self.path, timeout=0.2)
+            seen.append(("w0" in observer.workers(), observer.acquire(api.user_id, "other", 60)))
+            observer.close()
+        coordinator = sync_workers.Coordinator(self.path)
+        for user_id in coordinator.users()[1:]:
+            coordinator.remove_user(user_id)
+        coordinator.close()
+        worker = sync_workers.Worker(self.path, sync, worker_id="w0", lease=0.3, timeout=0.2, heartbeat=0.05)
+        self.assertEqual(worker.run_once(), ["U000"])
+        worker.leave()
+        self.assertEqual(seen, [(True, False)])
+        with self.assertRaises(ValueError):
+            sync_workers.Worker(self.path, sync, timeout=10, heartbeat=10)
+
+    def test_lease_blocks_second_worker(self):
+        coordinator = sync_workers.Coordinator(self.path)
+        self.assertTrue(coordinator.acquire("U000", "a", 60))
+        self.assertFalse(coordinator.acquire("U000", "b", 60))
+        self.assertTrue(coordinator.acquire("U000", "a", 60))
+        coordinator.release("U000", "a")
+        self.assertTrue(coordinator.acquire("U000", "b", 60))
+
+class JSONStreamTestMethods(unittest.TestCase):
+
+    DOCUMENT = {"activities-heart": [{"dateTime": "2021-09-08", "value": {"restingHeartRate": 61, "zones": [{"name": "Out of \"Range\"", "max": 94.5}]}}],
+        "activities-heart-intraday": {"dataset": [{"time": f"00:{minute:02d}:00", "value": 60 + minute} for minute in range(60)],
+        "datasetInterval": 1, "datasetType": "minute"}}
+
+    def test_projection_across_chunk_boundaries(self):
+        body = json.dumps(self.DOCUMENT, indent=1).encode("utf-8")
+        for chunk_size in (1, 3, 7, 4096):
+            self.assertEqual(list(json_stream.select(body, "activities-heart-intraday.dataset.*", chunk_size)),
+                self.DOCUMENT["activities-heart-intraday"]["dataset"])
+            self.assertEqual(json_stream.first(body, "activities-heart.0.value.restingHeartRate", chunk_size=chunk_size), 61)
+            self.assertEqual(list(json_stream.select(body, "activities-heart.*.value.zones.*.max", chunk_size)), [94.5])
+        with self.assertRaises(ValueError):
+            list(json_stream.select(body[:-10], "missing"))
+
+    def test_streamed_response(self):
+        body = json.dumps(self.DOCUMENT).encode("utf-8")
+        options = {}
+        def transport(method, url, **kwargs):
+            options.update(kwargs)
+            response = requests.Response()
+            response.status_code, response.raw = 200, io.BytesIO(body)
+            return response
+        api = fitbit.API(transport=transport, user_id="ABC123", access_token="token")
+        other = fitbit.API(transport=transport, user_id="DEF456", access_token="token")
+        with api.streaming():
+            other.heart_rate_intraday("2021-09-08", "1d", "1min")
+            # Another instance used within the block still reads its responses
+            self.assertNotIn("stream", options)
+            res = api.heart_rate_intraday("2021-09-08", "1d", "1min")
+        self.assertTrue(options["stream"])
+        seconds, values = json_stream.dataset(res, "activities-heart-intraday.dataset", batch=16, chunk_size=100)
+        self.assertEqual(seconds.tolist(), [minute * 60 for minute in range(60)])
+        self.assertEqual(values.tolist(), [60 + minute for minute in range(60)])
+
+class PriorityTestMethods(unittest.TestCase):
+
+    def test_reserve_and_preemption(self):
+        order = []
+        with stub_server.StubServer(rate_limit=20) as stub:
+            tokens = stub.issue()
+            redirect = stub_server.redirect(stub.url)
+            def transport(method, url, **kwargs):
+                order.append(priority._priority.get())
+                time.sleep(0.01)
+                return redirect(method, url, **kwargs)
+            gate = priority.BudgetGate(transport, max_concurrency=1, max_wait={priority.BACKGROUND: 0.2})
+            api = fitbit.API(transport=gate, user_id=tokens.user_id, access_token=tokens.access_token, refresh_token=tokens.refresh_token)
+            def backfill():
+                with priority.background():
+                    try:
+                        while True:
+                            api.activity_summary("2021-09-08")
+                    except priority.Deferred:
+                        pass
+            with ThreadPoolExecutor(1) as executor:
+                future = executor.submit(backfill)
+                time.sleep(0.05)
+                # Queued background requests wait until the interactive one is sent
+                api.profile()
+                future.result()
+            # The background work stopped at the 20% reserve, which interactive requests can still use
+            self.assertEqual(gate.sent[priority.BACKGROUND], 15)
+            self.assertEqual(gate.deferred[priority.BACKGROUND], 1)
+            self.assertIn(priority.INTERACTIVE, order[:8])
+            for _ in range(4):
+                api.profile()
+            self.assertEqual(gate.remaining, 0)
+            self.assertEqual(order.count(priority.INTERACTIVE), 5)
+
+class PlannerTestMethods(unittest.TestCase):
+
+    def test_fewest_calls_within_budget(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = intraday_cache.IntradayCache(root)
+            for date in ("2021-09-06", "2021-09-07"):
+                cache.store("U", "steps", "1min", date, {"activities-steps-intraday": {"dataset": []}}, complete=True)
+            plan = planner.plan(["steps", "heart", "sleep"], "2021-05-01", "2021-09-08", {"steps": "1min"},
+                planner.intraday_cached(cache, "U"), budget=3)
+            cache.close()
+        # 131 days of sleep take two ranges of at most 100 days, heart rate one time series
+        self.assertEqual(plan.total_requests, 1 + 2 + 129)
+        self.assertEqual([call.method for call in plan.calls], ["heart_rate_time_series", "sleep_logs_range", "sleep_logs_range"])
+        self.assertEqual(plan.deferred[0].args, ("steps", "2021-09-08", "1d", "1min"))
+        self.assertNotIn("2021-09-07", [call.dates[0] for call in plan.deferred])
+        self.assertIn("3 requests of a budget of 3, 129 deferred", str(plan))
+
+    def test_execute(self):
+        sent = []
+        def transport(method, url, **kwargs):
+            sent.append(url[len(fitbit.API.base_url):])
+            response = requests.Response()
+            response.status_code, response._content = 200, b"{}"
+            return response
+        api = fitbit.API(transport=transport, user_id="ABC123", access_token="token")
+        plan = planner.plan(["weight", "calories"], "2021-08-01", "2021-09-08", {"weight": "1min"})
+        results = planner.execute(api, plan)
+        self.assertEqual(len(results), 3)
+        self.assertIn("/1/user/ABC123/body/log/weight/date/2021-08-01/2021-08-31.json", sent)
+        self.assertIn("/1/user/ABC123/activities/calories/date/2021-08-01/2021-09-08.json", sent)
+
+class ConcurrencyTestMethods(unittest.TestCase):
+
+    def test_aimd(self):
+        limit = concurrency.AdaptiveLimit(initial=4, maximum=6)
+        # Fully used, the limit grows by about one per round trip up to its maximum
+        for _ in range(5):
+            slots = int(limit.limit)
+            for _ in range(slots):
+                limit.acquire()
+            for _ in range(slots):
+                limit.release(0.01, True)
+        self.assertEqual(limit.limit, 6)
+        limit.acquire()
+        limit.release(0.01, False)
+        self.assertAlmostEqual(limit.limit, 4.2)
+        limit.acquire()
+        limit.release(0.01, True, remaining=2)
+        self.assertEqual(limit.limit, 2)
+
+    def test_finds_server_capacity(self):
+        # A server that slows down beyond 8 requests in flight and fails beyond 16
+        state = {"in_flight": 0, "peak": 0, "errors": 0}
+        lock = threading.Lock()
+        def transport(method, url, **kwargs):
+            with lock:
+                state["in_flight"] += 1
+                in_flight = state["in_flight"]
+                state["peak"] = max(state["peak"], in_flight)
+            time.sleep(0.005 * max(1, in_flight / 8))
+            response = requests.Response()
+            response.status_code = 503 if in_flight > 16 else 200
+            with lock:
+                state["in_flight"] -= 1
+                state["errors"] += in_flight > 16
+            return response
+        gate = concurrency.AdaptiveConcurrency(transport, user_maximum=16)
+        with ThreadPoolExecutor(48) as executor:
+            list(executor.map(lambda index: gate("GET", f"{fitbit.API.base_url}/1/user/U{index % 10}/profile.json"), range(800)))
+        self.assertLess(state["errors"], 40)
+        self.assertGreaterEqual(state["peak"], 8)
+        self.assertLess(gate.limit.limit, 24)
+        self.assertEqual(gate.limit.in_flight, 0)
+
+class ExportTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = sync_workers.Coordinator(os.path.join(self.root, "tokens.db"))
+        for user_id in ("A", "B"):
+            self.store.add_user(fitbit.Tokens(user_id, f"access-{user_id}", f"refresh-{user_id}"))
+        self.limit = 150
+        self.used = {}
+        self.forbidden = set()
+
+    def tearDown(self):
+        self.store.close()
+
+    def transport(self, method, url, **kwargs):
+        user_id = url.split("/user/")[1].split("/")[0]
+        path = url.split("/date/")
+        self.used[user_id] = self.used.get(user_id, 0) + 1
+        if "intraday" in url or url.endswith("/1min.json"):
+            body = {"activities-steps-intraday": {"dataset": [{"time": f"00:{minute:02d}:00", "value": minute} for minute in range(60)]}}
+        elif "/sleep/" in url:
+            body = {"sleep": [{"dateOfSleep": path[1][:10], "startTime": f"{path[1][:10]}T23:10:00.000", "minutesAsleep": 420}]}
+        else:
+            body = {"body-weight": [{"dateTime": path[1][:10], "value": "70.5"}]}
+        response = requests.Response()
+        response.status_code = 429 if self.used[user_id] > self.limit else 403 if user_id in self.forbidden and "1min" in url else 200
+        response.headers.update({"Fitbit-Rate-Limit-Limit": str(self.limit), "Fitbit-Rate-Limit-Remaining": str(max(0, self.limit - self.used[user_id])),
+            "Fitbit-Rate-Limit-Reset": "3600"})
+        response.raw = io.BytesIO(json.dumps(body).encode("utf-8"))
+        return response
+
+    def run_export(self, format):
+        return export.export(self.store, ["steps", "sleep", "weight"], "2021-09-01", "2021-09-08", os.path.join(self.root, format),
+            detail={"steps": "1min"}, format=format, checkpoint=os.path.join(self.root, f"{format}.json"), chunk_rows=100,
+            api_options={"transport": self.transport})
+
+    def test_resume_after_rate_limit(self):
+        formats = ["ndjson", "csv"] + (["parquet"] if arrow_export else [])
+        for format in formats:
+            self.limit, self.used = 5, {}
+            first = self.run_export(format)
+            self.assertFalse(first["A"]["complete"])
+            if format != "parquet":
+                # Rows written after the last checkpoint, as by a crash, are truncated on resume
+                with open(os.path.join(self.root, format, f"A.{format}"), "a") as file:
+                    file.write("partial row\n")
+            self.limit, self.used = 150, {}
+            second = self.run_export(format)
+            self.assertTrue(second["A"]["complete"] and second["B"]["complete"])
+            # Every call is sent once: the rows buffered when the budget ran out are written and checkpointed
+            self.assertEqual(first["A"]["requests"] + second["A"]["requests"], 8 + 1 + 1)
+            if format == "ndjson":
+                with open(os.path.join(self.root, format, "A.ndjson")) as file:
+                    lines = [json.loads(line) for line in file]
+            elif format == "csv":
+                with open(os.path.join(self.root, format, "A.csv")) as file:
+                    lines = list(csv.DictReader(file))
+            else:
+                lines = arrow_export.concat([arrow_export.pq.read_table(os.path.join(self.root, format, name))
+                    for name in sorted(os.listdir(os.path.join(self.root, format))) if name.startswith("A-")]).to_pylist()
+            self.assertEqual(len(lines), 8 * 60 + 1 + 1)
+            self.assertEqual(len({(line["resource"], str(line["date"]), line["time"]) for line in lines}), len(lines))
+
+    def test_failed_calls_do_not_stop_the_export(self):
+        # Intraday data the app may not read for user A fails its calls, but not the rest of A or B
+        self.forbidden = {"A"}
+        results = self.run_export("ndjson")
+        self.assertTrue(results["A"]["complete"] and results["B"]["complete"])
+        self.assertEqual((results["A"]["failed"], results["A"]["rows"]), (8, 2))
+        self.assertEqual((results["B"]["failed"], results["B"]["rows"]), (0, 8 * 60 + 2))
+        with open(os.path.join(self.root, "ndjson.json")) as file:
+            progress = json.load(file)
+        self.assertEqual(progress["A"]["cursor"], 10)
+        self.assertEqual({failure["status"] for failure in progress["A"]["failed"].values()}, {403})
+        # A rerun neither repeats the calls nor retries the permanent failures
+        self.used = {}
+        self.assertEqual(self.run_export("ndjson")["A"]["requests"], 0)
+        with self.assertRaises(ValueError):
+            export.export(self.store, ["steps"], "2021-09-01", "2021-09-08", self.root, users=["A", "C"])
+
+    def test_leased_users_are_skipped(self):
+        # A sync worker holds B, whose tokens it may refresh meanwhile
+        self.assertTrue(self.store.acquire("B", "sync-worker", 60))
+        results = export.export(self.store, ["weight"], "2021-09-01", "2021-09-08", os.path.join(self.root, "ndjson"),
+            api_options={"transport": self.transport}, worker_id="export")
+        self.assertTrue(results["A"]["complete"])
+        self.assertEqual(results["B"], {"skipped": True})
+        self.assertNotIn("B", self.used)
+        self.assertEqual(self.store.leases("export"), [])
+        self.assertEqual(self.store.leases("sync-worker"), ["B"])
+
+class HistoryStoreTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.store = history_store.HistoryStore(os.path.join(tempfile.mkdtemp(), "history.db"), train_after=4, dictionary_size=4096)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_round_trip_and_dedup(self):
+        days = {}
+        for day in range(1, 7):
+            date = f"2021-09-{day:02d}"
+            days[date] = {"activities-heart": [{"dateTime": date, "value": {"restingHeartRate": 60 + day}}],
+                "activities-heart-intraday": {"dataset": [{"time": f"{minute // 60:02d}:{minute % 60:02d}:00", "value": 60 + (minute * day) % 40}
+                for minute in range(0, 1440, 5)], "datasetInterval": 1, "datasetType": "minute"}}
+            self.assertTrue(self.store.put("U", "heart_rate_intraday", date, days[date]))
+        calories = {"activities-calories-intraday": {"dataset": [{"time": "00:00:00", "value": 1.1937}, {"time": "00:01:00", "value": 1.25}]}}
+        self.store.put("U", "calories", "2021-09-01", calories)
+        self.store.put("U", "activity_tcx", "21537078", "<TrainingCenterDatabase/>")
+        # The same payload for another user is stored once
+        self.assertFalse(self.store.put("V", "heart_rate_intraday", "2021-09-01", days["2021-09-01"]))
+        for date, data in days.items():
+            self.assertEqual(json.dumps(self.store.get("U", "heart_rate_intraday", date)), json.dumps(data))
+        self.assertEqual(self.store.get("U", "calories", "2021-09-01"), calories)
+        self.assertEqual(self.store.get("U", "activity_tcx", "21537078"), "<TrainingCenterDatabase/>")
+        self.assertIsNone(self.store.get("U", "heart_rate_intraday", "2021-09-30"))
+        seconds, values = self.store.dataset("U", "heart_rate_intraday", "2021-09-03")
+        self.assertEqual(seconds[:3].tolist(), [0, 300, 600])
+        self.assertEqual(values[:3].tolist(), [60, 75, 90])
+        self.assertEqual(self.store.dates("U", "heart_rate_intraday", "2021-09-02", "2021-09-04"), ["2021-09-02", "2021-09-03", "2021-09-04"])
+        stats = self.store.stats()
+        self.assertEqual((stats["entries"], stats["blocks"]), (9, 8))
+        self.assertLess(stats["stored_bytes"] * 5, sum(len(json.dumps(data)) for data in days.values()))
+        # A block is deleted with the last entry referring to it
+        self.store.delete("U", "heart_rate_intraday", "2021-09-01")
+        self.assertEqual(self.store.stats()["blocks"], 8)
+        self.store.delete("V", "heart_rate_intraday", "2021-09-01")
+        self.assertEqual(self.store.stats()["blocks"], 7)
+
+    def test_floats_and_unchanged_payloads(self):
+        values = [1.1937, 1.25, 1.25, 0.0, -3.5e-7, 1e300, float("inf")]
+        calories = {"activities-calories-intraday": {"dataset": [{"time": f"00:{minute:02d}:00", "value": value}
+            for minute, value in enumerate(values)]}}
+        self.store.put("U", "calories", "2021-09-01", calories)
+        self.assertEqual(self.store.dataset("U", "calories", "2021-09-01")[1].tolist(), values)
+        self.assertEqual(self.store.get("U", "calories", "2021-09-01"), calories)
+        # Storing the same payload again keeps the entry as it was, so entries(since) skips it
+        stored = self.store.entries()[0][3]
+        self.assertFalse(self.store.put("U", "calories", "2021-09-01", json.loads(json.dumps(calories))))
+        self.assertEqual(self.store.entries(), [("U", "calories", "2021-09-01", stored)])
+        self.assertEqual(self.store.entries(stored), [])
+
+class QueryEngineTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), "history.db")
+        self.store = history_store.HistoryStore(path)
+        self.engine = query_engine.QueryEngine(path)
+        # 2021-06-28 is a Monday
+        dates = ["2021-06-26", "2021-06-27", "2021-06-28", "2021-06-29", "2021-07-01"]
+        for index, user_id in enumerate(["A", "B", "C"]):
+            self.store.put(user_id, "activity_time_series", "2021-07-01", {"activities-steps": [{"dateTime": date, "value": str(1000 * (index + 1) * day)}
+                for day, date in enumerate(dates, 1)]})
+        self.store.put("A", "sleep_logs_range", "2021-06-28", {"sleep": [
+            {"dateOfSleep": "2021-06-28", "isMainSleep": True, "minutesAsleep": 400, "efficiency": 90},
+            {"dateOfSleep": "2021-06-28", "isMainSleep": False, "minutesAsleep": 30, "efficiency": 70}]})
+        self.store.put("A", "body_logs", "2021-06-28", {"weight": [{"date": "2021-06-28", "time": "08:00:00", "weight": 70.5, "bmi": 22.1}]})
+        self.engine.add_cohort("X", ["A", "B"])
+
+    def tearDown(self):
+        self.engine.close()
+        self.store.close()
+
+    def test_index_and_query(self):
+        self.assertEqual(self.engine.index(self.store), 3 * 5 + 2 + 2)
+        self.assertEqual(self.engine.index(self.store), 0)
+        self.assertEqual(self.engine.resources(), ["bmi", "efficiency", "minutesAsleep", "steps", "weight"])
+        # Weekdays of cohort X: A has 3000, 4000, 5000 and B twice that
+        self.assertEqual(self.engine.query("steps", cohort="X", weekdays=range(5)), 6000)
+        self.assertEqual(self.engine.query("steps", "2021-06-28", "2021-06-30", by="user", aggregate="sum"), {"A": 7000, "B": 14000, "C": 21000})
+        self.assertEqual(self.engine.query("steps", by=("month", "user"), aggregate="max", users=["A"]),
+            {("2021-06", "A"): 4000, ("2021-07", "A"): 5000})
+        self.assertEqual(self.engine.query("steps", by="quarter", aggregate="count"), {"2021-Q2": 12, "2021-Q3": 3})
+        self.assertEqual(self.engine.query("steps", by="weekday", aggregate="median", users=["A", "B"]),
+            {0: 4500, 1: 6000, 3: 7500, 5: 1500, 6: 3000})
+        self.assertEqual(self.engine.query("minutesAsleep"), 430)
+        self.assertEqual(self.engine.query("efficiency"), 90)
+        self.assertIsNone(self.engine.query("steps", "2022-01-01"))
+        with self.assertRaises(ValueError):
+            self.engine.query("steps", by="week")
+
+    def test_writes_of_other_connections_and_filters(self):
+        self.engine.index(self.store)
+        self.assertEqual(self.engine.query("weight"), 70.5)
+        # A payload fetched again unchanged is not ingested again
+        self.store.put("A", "body_logs", "2021-06-28", {"weight": [{"date": "2021-06-28", "time": "08:00:00", "weight": 70.5, "bmi": 22.1}]})
+        self.assertEqual(self.engine.index(self.store), 0)
+        # Another engine on the same file changes a resource whose columns the first one has loaded
+        other = query_engine.QueryEngine(self.engine.db.execute("PRAGMA database_list").fetchone()[2])
+        other.ingest("B", {"weight": [{"date": "2021-06-28", "weight": 80.5}]})
+        other.close()
+        self.assertEqual(self.engine.query("weight", by="user"), {"A": 70.5, "B": 80.5})
+        # Users and a cohort together select the users in both
+        self.assertEqual(self.engine.query("steps", "2021-06-28", "2021-06-28", users=["B", "C"], cohort="X", by="user"), {"B": 6000})
+
+class SubscriptionsTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.store_path = os.path.join(root, "tokens.db")
+        self.store = sync_workers.Coordinator(self.store_path)
+        self.users = [f"U{index:02d}" for index in range(30)]
+        for user_id in self.users:
+            self.store.add_user(fitbit.Tokens(user_id, f"access-{user_id}", f"refresh-{user_id}"))
+        # What Fitbit holds, by user and collection type; U00 has an unwanted subscription under another ID
+        self.remote = {user_id: {} for user_id in self.users}
+        self.remote["U00"]["sleep"] = "legacy-1"
+        self.calls = []
+        self.expired = set()
+        self.lock = threading.Lock()
+        self.reconciler = subscriptions.Reconciler(os.path.join(root, "subscriptions.db"), self.store, api_options={"transport": self.transport})
+
+    def tearDown(self):
+        self.reconciler.close()
+        self.store.close()
+
+    def transport(self, method, url, **kwargs):
+        response = requests.Response()
+        if url == fitbit.API.token_url:
+            response.status_code = 400
+            response._content = json.dumps({"errors": [{"errorType": "invalid_grant", "message": "Refresh token invalid"}]}).encode("utf-8")
+            return response
+        path = url[len(fitbit.API.base_url):].split("/")
+        user_id = path[3]
+        if user_id in self.expired:
+            response.status_code = 401
+            response._content = json.dumps({"errors": [{"errorType": "expired_token", "message": "Access token expired"}]}).encode("utf-8")
+            return response
+        collection = path[4] if path[4] != "apiSubscriptions.json" and not path[4].startswith("apiSubscriptions") else "user"
+        with self.lock:
+            self.calls.append(method)
+            subscribed = self.remote[user_id]
+            if method == "GET":
+                response.status_code = 200
+                response._content = json.dumps({"apiSubscriptions": [{"collectionType": collection, "ownerId": user_id, "ownerType": "user",
+                    "subscriberId": "1", "subscriptionId": id} for collection, id in subscribed.items()]}).encode("utf-8")
+                return response
+            id = path[-1][:-len(".json")]
+            if method == "POST":
+                response.status_code = 409 if collection in subscribed and subscribed[collection] != id else 200 if collection in subscribed else 201
+                subscribed.setdefault(collection, id)
+            else:
+                response.status_code = 204 if subscribed.pop(collection, None) == id else 404
+        response._content = b""
+        return response
+
+    def test_bulk_onboarding_and_drift(self):
+        self.reconciler.desire(self.users, ["activities", "sleep"])
+        totals = self.reconciler.reconcile()
+        self.assertEqual(totals, {"checked": 30, "deleted": 1, "added": 60, "in_sync": 30, "skipped": 0, "revoked": 0, "failed": 0})
+        self.assertEqual(self.remote["U00"], {"activities": "U00-activities", "sleep": "U00-sleep"})
+        self.assertEqual(self.reconciler.out_of_sync(), [])
+        # Nothing changes while every user is in sync, and recently checked users are skipped
+        self.calls.clear()
+        self.assertEqual(self.reconciler.reconcile()["deleted"] + self.reconciler.reconcile()["added"], 0)
+        self.assertEqual(self.calls, ["GET"] * 60)
+        self.assertEqual(self.reconciler.reconcile(max_age=3600)["checked"], 0)
+        # Drift: a subscription disappears on Fitbit's side, and a user moves to all collections
+        del self.remote["U05"]["sleep"]
+        self.reconciler.desire(["U07"])
+        self.calls.clear()
+        self.assertEqual(self.reconciler.reconcile(max_age=3600), {"checked": 1, "deleted": 2, "added": 1, "in_sync": 1, "skipped": 0, "revoked": 0, "failed": 0})
+        self.assertEqual(self.reconciler.reconcile(), {"checked": 30, "deleted": 0, "added": 1, "in_sync": 30, "skipped": 0, "revoked": 0, "failed": 0})
+        self.assertEqual(self.remote["U05"]["sleep"], "U05-sleep")
+        self.assertEqual(self.remote["U07"], {"user": "U07-all"})
+
+    def test_leased_and_revoked_users(self):
+        self.reconciler.desire(self.users[:3], ["sleep"])
+        # A sync worker holds U01, and U02's refresh token was revoked
+        self.assertTrue(self.store.acquire("U01", "sync-worker", 60))
+        self.expired.add("U02")
+        totals = self.reconciler.reconcile()
+        self.assertEqual(totals, {"checked": 1, "deleted": 1, "added": 1, "in_sync": 1, "skipped": 1, "revoked": 1, "failed": 0})
+        self.assertEqual(self.remote["U01"], {})
+        self.assertEqual(list(self.reconciler.revoked), ["U02"])
+        self.assertEqual(self.reconciler.errors, {})
+        self.assertNotIn("U02", self.store.users())
+        # The reconciler's own leases are released, and revoked users are not tried again
+        self.assertEqual(self.store.leases(self.reconciler.worker_id), [])
+        self.store.release("U01", "sync-worker")
+        self.calls.clear()
+        self.assertEqual(self.reconciler.reconcile(["U01", "U02"]),
+            {"checked": 1, "deleted": 0, "added": 1, "in_sync": 1, "skipped": 0, "revoked": 1, "failed": 0})
+        self.assertEqual(self.calls, ["GET", "POST"])
+
+    def test_alongside_sync_worker(self):
+        self.reconciler.desire(self.users, ["sleep"])
+        during_sync = []
+        def sync(api, checkpoint):
+            if api.user_id == "U03":
+                during_sync.append(self.reconciler.reconcile_user("U03")["skipped"])
+        worker = sync_workers.Worker(self.store_path, sync, worker_id="w0", api_options={"transport": self.transport})
+        try:
+            self.assertEqual(len(worker.run_once()), 30)
+            # A user is only held while it syncs, so the reconciler gets every user between two rounds
+            self.assertEqual(during_sync, [True])
+            self.assertEqual(self.store.leases("w0"), [])
+        finally:
+            worker.leave()
+        totals = self.reconciler.reconcile()
+        self.assertEqual((totals["checked"], totals["skipped"], totals["added"]), (30, 0, 30))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,309 @@
+"""
+Durable write-ahead queue for mutating API calls
+
+Mutations are appended to a SQLite database and acknowledged as soon as they are committed locally.
+A background drainer replays them against the API in the order they were submitted, waits out the
+rate limit reported by the API, backs off while Fitbit or the network is unavailable, and refreshes
+the access token when it has expired.
+
+Arguments are bound to the method's signature and validated against endpoints.ENDPOINTS when a
+mutation is submitted, so a bad entry is rejected before it is queued instead of failing in the
+drainer. A mutation whose outcome is unknown, because the connection failed or the server answered
+with a 5xx after possibly applying it, is reconciled before it is sent again: the day's logs are
+looked up, and a matching log that no other entry of the queue created counts as the mutation's
+result instead of logging it twice.
+"""
+import json, time, uuid, sqlite3, inspect, datetime, threading
+import requests
+import endpoints
+
+MUTATIONS = {
+  "log_activity", "log_body", "log_food", "log_sleep", "log_water", "add_alarm",
+  "update_activity_goals", "update_body_fat_goal", "update_body_weight_goal", "update_food_goal",
+  "update_sleep_goal", "update_water_goal",
+}
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+def _number(value) -> float:
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+def _next_day(date: str) -> str:
+  return (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+
+# For each mutation that creates a log, given the call's arguments by parameter name: the call listing
+# the logs it may have created, the logs in that call's body and whether a listed log matches the
+# mutation. Updates of goals are idempotent and are simply sent again.
+RECONCILE = {
+  "log_water": (lambda api, a: api.water_logs(a["date"]), lambda body, a: body.get("water", []),
+    lambda a, log: _number(log.get("amount")) == _number(a["amount"])),
+  "log_food": (lambda api, a: api.food_logs(a["date"]), lambda body, a: body.get("foods", []),
+    lambda a, log: str(log.get("loggedFood", {}).get("foodId" if a["id_type"] == "id" else "name")) == str(a["food_id_or_name"])
+      and str(log["loggedFood"].get("mealTypeId")) == str(a["meal_type_id"])
+      and _number(log["loggedFood"].get("amount")) == _number(a["amount"])),
+  "log_activity": (lambda api, a: api.activity_summary(a["date"]), lambda body, a: body.get("activities", []),
+    lambda a, log: log.get("startTime") == a["start_time"][:5] and _number(log.get("duration")) == _number(a["duration_millis"])),
+  "log_body": (lambda api, a: api.body_logs(a["resource_path"], a["date"]), lambda body, a: body.get(a["resource_path"], []),
+    lambda a, log: _number(log.get(a["resource_path"])) == _number(a["measurement"]) and log.get("time", "")[:5] == a["time"][:5]),
+  "log_sleep": (lambda api, a: api.sleep_logs_range(a["date"], _next_day(a["date"])), lambda body, a: body.get("sleep", []),
+    lambda a, log: log.get("startTime", "").startswith(f"{a['date']}T{a['start_time'][:5]}") and _number(log.get("duration")) == _number(a["duration"])),
+  "add_alarm": (lambda api, a: api.alarms(a["tracker_id"]), lambda body, a: body.get("trackerAlarms", []),
+    lambda a, log: log.get("time") == a["time"] and set(log.get("weekDays", [])) == set(str(a["week_days"]).split(","))),
+}
+
+def _log_id(body):
+  """Returns the logId or alarmId in a mutation's response or a listed log, or None"""
+  if isinstance(body, dict):
+    for key in ("logId", "alarmId"):
+      if key in body:
+        return body[key]
+    body = list(body.values())
+  if isinstance(body, list):
+    for value in body:
+      found = _log_id(value)
+      if found is not None:
+        return found
+  return None
+
+class WriteQueue:
+
+  def __init__(self, api, path: str, *, reserve: int = 5, max_backoff: float = 900.0, max_attempts: int = None):
+    """
+    Parameters:
+      api: The fitbit.API instance the mutations are replayed against
+      path: The SQLite database file holding the queue; it can be shared by the queues of several users
+      reserve: (optional) Requests of the hourly rate limit left for other callers before the drainer waits for the reset
+      max_backoff: (optional) The longest wait in seconds between two attempts of the same entry
+      max_attempts: (optional) Attempts after which an entry is marked failed; by default entries are retried until they succeed
+    """
+    self.api = api
+    self.path = path
+    self.reserve = reserve
+    self.max_backoff = max_backoff
+    self.max_attempts = max_attempts
+    self.error = None
+    self.__lock = threading.Lock()
+    self.__wake = threading.Event()
+    self.__stop = threading.Event()
+    self.__drainer = None
+    self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.__db.execute("PRAGMA journal_mode=WAL")
+    self.__db.execute("PRAGMA synchronous=FULL")
+    self.__db.execute("""CREATE TABLE IF NOT EXISTS entries (
+      id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, user_id TEXT NOT NULL, method TEXT NOT NULL,
+      args TEXT NOT NULL, kwargs TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt REAL NOT NULL DEFAULT 0, created REAL NOT NULL, result TEXT, error TEXT, uncertain INTEGER NOT NULL DEFAULT 0)""")
+    self.__db.execute("CREATE INDEX IF NOT EXISTS entries_pending ON entries (user_id, status, id)")
+
+  def submit(self, method: str, *args, key: str = None, **kwargs) -> int:
+    """
+    Appends a mutation to the queue and returns its entry id once it is durably stored. Raises TypeError
+    if the arguments do not fit the method and ValueError if they are not valid for its endpoint.
+
+    Parameters:
+      method: The name of the fitbit.API mutation method, e.g. log_water
+      args: The positional arguments of the method
+      key: (optional) A deduplication key; submitting a key that is already queued returns the existing entry
+      kwargs: The keyword arguments of the method
+    """
+    if method not in MUTATIONS:
+      raise ValueError(f"{method} is not a queueable mutation, expected one of {sorted(MUTATIONS)}")
+    self.__bind(method, args, kwargs)
+    args, kwargs = json.dumps(args), json.dumps(kwargs)
+    key = key or uuid.uuid4().hex
+    with self.__lock:
+      self.__db.execute(
+        "INSERT OR IGNORE INTO entries (key, user_id, method, args, kwargs, status, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, self.api.user_id, method, args, kwargs, PENDING, time.time()))
+      entry_id = self.__db.execute("SELECT id FROM entries WHERE key = ?", (key,)).fetchone()[0]
+    self.__wake.set()
+    return entry_id
+
+  def __bind(self, method: str, args: tuple, kwargs: dict) -> dict:
+    """Returns the arguments of a call by parameter name, defaults included, after validating them"""
+    bound = inspect.signature(getattr(self.api, method)).bind(*args, **kwargs)
+    bound.apply_defaults()
+    endpoint = endpoints.ENDPOINTS.get(method)
+    if endpoint is not None:
+      endpoint.validate(bound.arguments)
+    return dict(bound.arguments)
+
+  def __getattr__(self, name: str):
+    if name in MUTATIONS:
+      return lambda *args, **kwargs: self.submit(name, *args, **kwargs)
+    raise AttributeError(name)
+
+  def status(self, entry_id: int) -> dict:
+    """
+    Returns the status, attempts, result and last error of an entry
+
+    Parameters:
+      entry_id: The id returned by submit
+    """
+    with self.__lock:
+      row = self.__db.execute("SELECT status, attempts, result, error FROM entries WHERE id = ?", (entry_id,)).fetchone()
+    if row is None:
+      raise KeyError(entry_id)
+    return {"status": row[0], "attempts": row[1], "result": json.loads(row[2]) if row[2] else None, "error": row[3]}
+
+  def pending(self) -> int:
+    """Returns the number of entries of the API's user that have not been replayed yet"""
+    with self.__lock:
+      return self.__db.execute("SELECT COUNT(*) FROM entries WHERE user_id = ? AND status = ?",
+        (self.api.user_id, PENDING)).fetchone()[0]
+
+  def __head(self) -> tuple:
+    with self.__lock:
+      return self.__db.execute(
+        "SELECT id, method, args, kwargs, attempts, next_attempt, uncertain FROM entries WHERE user_id = ? AND status = ? ORDER BY id LIMIT 1",
+        (self.api.user_id, PENDING)).fetchone()
+
+  def __finish(self, entry_id: int, status: str, attempts: int, *, result=None, error: str = None, next_attempt: float = 0,
+      uncertain: bool = False) -> None:
+    with self.__lock:
+      self.__db.execute("UPDATE entries SET status = ?, attempts = ?, result = ?, error = ?, next_attempt = ?, uncertain = ? WHERE id = ?",
+        (status, attempts, json.dumps(result) if result is not None else None, error, next_attempt, int(uncertain), entry_id))
+
+  def __classify(self, res) -> tuple:
+    """
+    Returns (outcome, body) for a method's return value; outcome is done, retry, unsure, refresh or
+    failed, where unsure is a retry after a response that does not tell whether the mutation was applied
+    """
+    if self.api.debug:
+      status = res.status_code
+      try:
+        body = res.json()
+      except ValueError:
+        body = res.text
+      if status < 300:
+        return "done", body
+      if status == 401:
+        return "refresh", body
+      return ("retry" if status == 429 else "unsure" if status >= 500 else "failed"), body
+    if isinstance(res, dict) and res.get("errors"):
+      error_type = res["errors"][0].get("errorType")
+      if error_type in ("expired_token", "invalid_token"):
+        return "refresh", res
+      if error_type in ("system", "request"):
+        # Without the status, an exhausted budget is what tells a 429 from a server error
+        rate_limit = self.api.rate_limit
+        return ("retry" if rate_limit is not None and rate_limit["remaining"] == 0 else "unsure"), res
+      return "failed", res
+    return "done", res
+
+  def __reconcile(self, method: str, arguments: dict) -> tuple:
+    """
+    Looks for a listed log that matches a mutation and that no other entry of the queue created, and
+    returns (outcome, log) with log None if there is none, or the outcome of a failed lookup
+    """
+    if method not in RECONCILE:
+      return "done", None
+    lookup, logs, matches = RECONCILE[method]
+    outcome, body = self.__classify(lookup(self.api, arguments))
+    if outcome != "done":
+      return outcome, body
+    with self.__lock:
+      results = self.__db.execute("SELECT result FROM entries WHERE user_id = ? AND method = ? AND status = ? AND result IS NOT NULL",
+        (self.api.user_id, method, DONE)).fetchall()
+    claimed = {_log_id(json.loads(row[0])) for row in results}
+    for log in logs(body, arguments):
+      if matches(arguments, log) and _log_id(log) not in claimed:
+        return "done", log
+    return "done", None
+
+  def __wait_for_budget(self) -> None:
+    rate_limit = self.api.rate_limit
+    if rate_limit is not None and rate_limit["remaining"] <= self.reserve:
+      with self.api.span("rate_limit.wait", remaining=rate_limit["remaining"]):
+        self.__stop.wait(max(0.0, rate_limit["reset"] - time.time()))
+
+  def drain_once(self) -> bool:
+    """
+    Replays the oldest pending entry if it is due and returns whether an entry was attempted
+    """
+    head = self.__head()
+    if head is None or head[5] > time.time():
+      return False
+    entry_id, method, args, kwargs, attempts, _, uncertain = head
+    with self.api.span("write_queue.replay", method=method, entry=entry_id, retries=attempts) as span:
+      outcome = self.__replay(entry_id, method, args, kwargs, attempts, uncertain)
+      if span is not None:
+        span.set("outcome", outcome)
+    return True
+
+  def __replay(self, entry_id: int, method: str, args: str, kwargs: str, attempts: int, uncertain: bool) -> str:
+    self.__wait_for_budget()
+    attempts += 1
+    access_token = self.api.access_token
+    args, kwargs = json.loads(args), json.loads(kwargs)
+    try:
+      # Sent again only once a lookup shows that an earlier attempt with an unknown outcome left no log
+      outcome, body = self.__reconcile(method, self.__bind(method, args, kwargs)) if uncertain else ("done", None)
+      if outcome == "done" and body is None:
+        outcome, body = self.__classify(getattr(self.api, method)(*args, **kwargs))
+      error = None if outcome == "done" else json.dumps(body)
+    except requests.RequestException as exception:
+      # The request may have been applied before the connection failed
+      outcome, body, error = "unsure", None, repr(exception)
+    except Exception as exception:
+      # Invalid arguments and other errors that sending again cannot fix
+      outcome, body, error = "failed", None, repr(exception)
+    if outcome == "unsure":
+      outcome, uncertain = "retry", True
+    backoff = min(self.max_backoff, 2 ** attempts)
+    if outcome == "refresh":
+      try:
+        self.api.refresh_if_stale(access_token)
+        outcome, backoff = "retry", 0
+      except Exception as exception:
+        outcome, error = "failed", repr(exception)
+    if outcome == "done":
+      self.__finish(entry_id, DONE, attempts, result=body)
+    elif outcome == "retry" and (self.max_attempts is None or attempts < self.max_attempts):
+      self.__finish(entry_id, PENDING, attempts, error=error, next_attempt=time.time() + backoff, uncertain=uncertain)
+    else:
+      self.__finish(entry_id, FAILED, attempts, error=error, uncertain=uncertain)
+    return outcome
+
+  def drain(self) -> None:
+    """Replays pending entries in order until the queue is empty or the head entry is backing off"""
+    while self.drain_once():
+      pass
+
+  def start(self, poll_interval: float = 5.0) -> None:
+    """
+    Starts the background drainer thread. An unexpected error, e.g. of the database, is kept in error
+    and the drainer carries on after the poll interval.
+
+    Parameters:
+      poll_interval: (optional) The longest time in seconds the drainer sleeps before checking for due entries
+    """
+    if self.__drainer is not None and self.__drainer.is_alive():
+      return
+    self.__stop.clear()
+    def run():
+      while not self.__stop.is_set():
+        try:
+          self.drain()
+        except Exception as error:
+          self.error = error
+        self.__wake.wait(poll_interval)
+        self.__wake.clear()
+    self.__drainer = threading.Thread(target=run, name="write-queue-drainer", daemon=True)
+    self.__drainer.start()
+
+  def stop(self) -> None:
+    """Stops the background drainer; entries that are still pending stay in the database"""
+    self.__stop.set()
+    self.__wake.set()
+    if self.__drainer is not None:
+      self.__drainer.join()
+      self.__drainer = None
+
+  def close(self) -> None:
+    """Stops the drainer and closes the database"""
+    self.stop()
+    self.__db.close()